@@ -0,0 +1,49 @@
+import os
+import tempfile
+import traceback
+
+import cli.log
+
+from benchmarks.synthetic_plate import SyntheticPlate
+from models.dataflow import DirectoryIndex
+
+def indexed_paths(directory_index, fields):
+  return { str(field): [str(path) for path in directory_index.paths(field)] for field in fields }
+
+@cli.log.LoggingApp
+def directory_index_benchmark_cli(app):
+  # image filename parsing is fixed per process by FILE_TYPE, so the plate is written in that same file type
+  try:
+    file_type = os.environ.get("FILE_TYPE")
+    with tempfile.TemporaryDirectory() as workdir:
+      plate = SyntheticPlate(
+        workdir,
+        file_type=file_type,
+        wells_count=app.params.wells_count,
+        fields_count=app.params.fields_count,
+        z_count=2,
+        image_size=256
+      ).write()
+      directory_index = DirectoryIndex(plate.root)
+      fields = directory_index.fields
+      expected_paths = indexed_paths(directory_index, fields)
+      mismatches = 0 if len(fields) == plate.wells_count * plate.fields_count else 1
+      # a job handed some of the fields should see exactly those fields, with the same files
+      for field in fields:
+        field_directory_index = DirectoryIndex(plate.root, [field])
+        if field_directory_index.fields != [field] or indexed_paths(field_directory_index, [field])[str(field)] != expected_paths[str(field)]:
+          mismatches += 1
+      all_fields_directory_index = DirectoryIndex(plate.root, fields)
+      if indexed_paths(all_fields_directory_index, all_fields_directory_index.fields) != expected_paths:
+        mismatches += 1
+      print("%s: %i fields, %i mismatches" % (file_type, len(fields), mismatches))
+      return 1 if mismatches > 0 else 0
+  except Exception as exception:
+    traceback.print_exc()
+    return 1
+
+directory_index_benchmark_cli.add_param("--wells_count", type=int, default=2)
+directory_index_benchmark_cli.add_param("--fields_count", type=int, default=2)
+
+if __name__ == "__main__":
+  directory_index_benchmark_cli.run()
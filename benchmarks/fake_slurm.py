@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# a local stand-in for swarm, sbatch and squeue: jobs wait for their dependencies in a detached runner process
+# and run their commands on this machine, so chained submissions can be exercised without a cluster.
+#   python benchmarks/fake_slurm.py install DIRECTORY   writes swarm, sbatch and squeue wrappers into DIRECTORY
+import argparse
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+from time import sleep
+
+STATE_DIRECTORY = Path(os.environ.get("FAKE_SLURM_DIRECTORY", "/tmp/fake_slurm"))
+POLL_SECONDS = 0.5
+COMMANDS = ["swarm", "sbatch", "squeue"]
+
+def job_path(job_id):
+  return STATE_DIRECTORY / ("%s.json" % job_id)
+
+def load_job(job_id):
+  with job_path(job_id).open() as job_file:
+    return json.load(job_file)
+
+def save_job(job):
+  temporary_path = STATE_DIRECTORY / ("%s.json.tmp" % job["id"])
+  with temporary_path.open("w") as job_file:
+    json.dump(job, job_file)
+  os.replace(temporary_path, job_path(job["id"]))
+
+def next_job_id():
+  STATE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+  with (STATE_DIRECTORY / "next_job_id").open("a+") as counter_file:
+    fcntl.flock(counter_file, fcntl.LOCK_EX)
+    counter_file.seek(0)
+    job_id = int(counter_file.read() or 1000)
+    counter_file.seek(0)
+    counter_file.truncate()
+    counter_file.write(str(job_id + 1))
+  return str(job_id)
+
+def dependency_job_ids(dependency):
+  if dependency == None:
+    return []
+  kind, _separator, job_ids = dependency.partition(":")
+  if kind != "afterok":
+    raise Exception("only afterok dependencies are supported, not %s" % kind)
+  return [job_id for job_id in job_ids.split(":") if job_id != ""]
+
+def exported_environment(sbatch_arguments):
+  # swarm passes sbatch options through as one quoted string, e.g. "--export=MKL_NUM_THREADS=2,FILE_TYPE="CV""
+  match = re.search(r"--export=([^\s]+)", (sbatch_arguments or "").replace('\\"', "").replace('"', ""))
+  if match == None:
+    return {}
+  return dict(variable.split("=", 1) for variable in match.group(1).split(",") if "=" in variable)
+
+def submit(name, commands, dependency, environment, logdir):
+  job = {
+    "id": next_job_id(),
+    "name": name,
+    "commands": commands,
+    "dependencies": dependency_job_ids(dependency),
+    "environment": environment,
+    "states": ["PENDING" for _command in commands]
+  }
+  save_job(job)
+  log_path = Path(logdir or STATE_DIRECTORY) / ("%s_%s.o" % (name, job["id"]))
+  log_path.parent.mkdir(parents=True, exist_ok=True)
+  with log_path.open("w") as log_file:
+    subprocess.Popen(
+      [sys.executable, __file__, "run", job["id"]],
+      stdin=subprocess.DEVNULL,
+      stdout=log_file,
+      stderr=subprocess.STDOUT,
+      start_new_session=True
+    )
+  print(job["id"])
+
+def run(job_id):
+  job = load_job(job_id)
+  while True:
+    dependency_states = [set(load_job(dependency)["states"]) for dependency in job["dependencies"]]
+    if any(states & set(["FAILED", "CANCELLED"]) for states in dependency_states):
+      job["states"] = ["CANCELLED" for _command in job["commands"]]
+      save_job(job)
+      return
+    if all(states == set(["COMPLETED"]) for states in dependency_states):
+      break
+    sleep(POLL_SECONDS)
+  environment = { **os.environ, **job["environment"] }
+  for index, command in enumerate(job["commands"]):
+    job["states"][index] = "RUNNING"
+    save_job(job)
+    print(command, flush=True)
+    returncode = subprocess.run(command, shell=True, env=environment).returncode
+    job["states"][index] = "COMPLETED" if returncode == 0 else "FAILED"
+    save_job(job)
+
+def swarm(arguments):
+  parser = argparse.ArgumentParser(prog="swarm")
+  parser.add_argument("-f", dest="file", required=True)
+  parser.add_argument("--job-name", required=True)
+  parser.add_argument("--dependency")
+  parser.add_argument("--sbatch")
+  parser.add_argument("--logdir")
+  parser.add_argument("--module")
+  parser.add_argument("-g")
+  parser.add_argument("-t")
+  parser.add_argument("-b")
+  params = parser.parse_args(arguments)
+  with open(params.file) as swarm_file:
+    commands = [line.strip() for line in swarm_file if line.strip() != ""]
+  submit(params.job_name, commands, params.dependency, exported_environment(params.sbatch), params.logdir)
+
+def sbatch(arguments):
+  parser = argparse.ArgumentParser(prog="sbatch")
+  parser.add_argument("--job-name", required=True)
+  parser.add_argument("--dependency")
+  parser.add_argument("--export")
+  parser.add_argument("--wrap", required=True)
+  parser.add_argument("--parsable", action="store_true")
+  params, _unknown_arguments = parser.parse_known_args(arguments)
+  environment = exported_environment("--export=%s" % params.export) if params.export != None else {}
+  submit(params.job_name, [params.wrap], params.dependency, environment, None)
+
+def squeue(arguments):
+  parser = argparse.ArgumentParser(prog="squeue", add_help=False)
+  parser.add_argument("-n", dest="name", required=True)
+  parser.add_argument("-o")
+  parser.add_argument("-t")
+  parser.add_argument("-h", action="store_true")
+  params = parser.parse_args(arguments)
+  for path in sorted(STATE_DIRECTORY.glob("*.json")):
+    try:
+      job = load_job(path.stem)
+    except (FileNotFoundError, json.JSONDecodeError):
+      continue
+    if job["name"] == params.name:
+      for state in job["states"]:
+        print(state)
+
+def install(directory):
+  directory = Path(directory)
+  directory.mkdir(parents=True, exist_ok=True)
+  for command in COMMANDS:
+    wrapper_path = directory / command
+    wrapper_path.write_text("#!/bin/sh\nexec %s %s %s \"$@\"\n" % (sys.executable, Path(__file__).resolve(), command))
+    wrapper_path.chmod(0o755)
+
+def main(arguments):
+  command, command_arguments = arguments[0], arguments[1:]
+  if command == "install":
+    install(command_arguments[0])
+  elif command == "run":
+    run(command_arguments[0])
+  elif command in COMMANDS:
+    globals()[command](command_arguments)
+  else:
+    print("usage: %s install DIRECTORY | swarm ... | sbatch ... | squeue ..." % Path(__file__).name)
+    return 2
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
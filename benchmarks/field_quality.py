@@ -0,0 +1,54 @@
+import traceback
+from time import perf_counter
+
+import cli.log
+import numpy
+
+from models.field_quality import MIN_FOREGROUND_FRACTION, FieldQuality, FieldQualityFilter
+
+COVERAGES = [0.0, 0.05, 0.2, 0.44, 0.58, 0.75, 0.9]
+BACKGROUND = 100
+NUCLEUS_INTENSITY = 1000
+NOISE = 10
+
+def synthetic_field(coverage, image_size, nucleus_radius, random):
+  # nuclei are placed at random, overlapping or not, until they cover the asked for fraction of the field
+  disc_rows, disc_columns = numpy.mgrid[-nucleus_radius:nucleus_radius + 1, -nucleus_radius:nucleus_radius + 1]
+  disc = disc_rows ** 2 + disc_columns ** 2 < nucleus_radius ** 2
+  padded_nuclei = numpy.zeros((image_size + 2 * nucleus_radius, image_size + 2 * nucleus_radius), dtype=bool)
+  nuclei = padded_nuclei[nucleus_radius:-nucleus_radius, nucleus_radius:-nucleus_radius]
+  while nuclei.mean() < coverage:
+    for center_row, center_column in random.integers(0, image_size, size=(16, 2)):
+      padded_nuclei[center_row:center_row + disc.shape[0], center_column:center_column + disc.shape[1]] |= disc
+  intensity = NUCLEUS_INTENSITY * random.uniform(0.5, 1.5)
+  return BACKGROUND + intensity * nuclei + random.normal(0, NOISE, size=(image_size, image_size))
+
+@cli.log.LoggingApp
+def field_quality_benchmark_cli(app):
+  try:
+    random = numpy.random.default_rng(app.params.seed)
+    field_quality_filter = FieldQualityFilter()
+    mistakes = 0
+    print("%8s %10s %10s %8s" % ("coverage", "foreground", "seconds", "passed"))
+    for coverage in COVERAGES:
+      field = synthetic_field(coverage, app.params.image_size, app.params.nucleus_radius, random)
+      start_time = perf_counter()
+      field_quality_params = FieldQuality(None, field).to_json_params()
+      seconds = perf_counter() - start_time
+      passed = len(field_quality_filter.reasons(field_quality_params)) == 0
+      # only the empty field should be taken for empty, however crowded the others are
+      if passed != (coverage > 0):
+        mistakes += 1
+      print("%8.2f %10.4f %10.4f %8s" % (coverage, field_quality_params["foreground_fraction"], seconds, passed))
+    print("%i mistakes at a minimum foreground fraction of %.4f" % (mistakes, MIN_FOREGROUND_FRACTION))
+    return 1 if mistakes > 0 else 0
+  except Exception as exception:
+    traceback.print_exc()
+    return 1
+
+field_quality_benchmark_cli.add_param("--image_size", type=int, default=1024)
+field_quality_benchmark_cli.add_param("--nucleus_radius", type=int, default=20)
+field_quality_benchmark_cli.add_param("--seed", type=int, default=0)
+
+if __name__ == "__main__":
+  field_quality_benchmark_cli.run()
@@ -0,0 +1,298 @@
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import traceback
+import types
+from pathlib import Path
+from time import perf_counter
+
+import cli.log
+
+from benchmarks.synthetic_plate import SyntheticPlate
+from models.thread_budget import allocated_cores, limit_threads
+
+LOGGER = logging.getLogger()
+FILE_TYPES = ["CV", "LSM"]
+DAPI_CHANNEL = 1
+DIAMETER = 50
+
+# the stage a thread split runs; forked workers inherit it, so its lambdas never need pickling
+SPLIT_STAGE = None
+
+def stub_cellpose():
+  try:
+    import cellpose
+  except ImportError:
+    cellpose = types.ModuleType("cellpose")
+    for submodule_name in ["models", "plot", "transforms"]:
+      submodule = types.ModuleType("cellpose.%s" % submodule_name)
+      setattr(cellpose, submodule_name, submodule)
+      sys.modules["cellpose.%s" % submodule_name] = submodule
+    sys.modules["cellpose"] = cellpose
+
+def stubbed_nuclear_segmentation_job_class():
+  import skimage.filters
+  import skimage.measure
+  from generate_nuclear_segmentation import GenerateNuclearSegmentationJob
+
+  class StubbedNuclearSegmentationJob(GenerateNuclearSegmentationJob):
+    @property
+    def cellpose_result(self):
+      if not hasattr(self, "_cellpose_result"):
+        foreground = self.image > skimage.filters.threshold_otsu(self.image)
+        self._cellpose_result = (skimage.measure.label(foreground), None, None, None)
+      return self._cellpose_result
+
+  return StubbedNuclearSegmentationJob
+
+def run_split_item(index):
+  run, items = SPLIT_STAGE
+  run(items[index])
+
+def run_split(run, items, workers_count, threads):
+  # workers_count processes of threads threads each share the stage's items
+  global SPLIT_STAGE
+  SPLIT_STAGE = (run, items)
+  with multiprocessing.get_context("fork").Pool(workers_count, initializer=limit_threads, initargs=(threads,)) as pool:
+    pool.map(run_split_item, range(len(items)), chunksize=1)
+  SPLIT_STAGE = None
+
+class PipelineBenchmark:
+  def __init__(self, root, plate, thread_splits=[], cores=None):
+    self.root = Path(root)
+    self.plate = plate
+    self.thread_splits = thread_splits
+    self.cores = cores if cores != None else allocated_cores()
+    self.results = []
+
+  def run(self):
+    self.measure("synthesize_plate", self.plate.images_count, self.plate.write)
+    for stage_name, stage in self.stages:
+      planner = stage["planner"]()
+      self.measure("plan_%s" % stage_name, None, lambda: planner.jobs)
+      items = list(stage["items"](planner))
+      self.measure(stage_name, len(items), lambda: [stage["run"](item) for item in items])
+      for threads in self.thread_splits:
+        # each split reruns the stage over the outputs of the sequential run, which it rewrites unchanged
+        workers_count = max(1, self.cores // threads)
+        self.measure(
+          stage_name,
+          len(items),
+          lambda: run_split(stage["run"], items, workers_count, threads),
+          split=(workers_count, threads)
+        )
+    self.measure("generate_spot_results_file", None, self.run_spot_results_file)
+    return self.results
+
+  def measure(self, name, items_count, function, split=None):
+    start_time = perf_counter()
+    function()
+    seconds = perf_counter() - start_time
+    result = {
+      "file_type": self.plate.file_type,
+      "fields_count": self.plate.fields_count,
+      "stage": name,
+      "items_count": items_count,
+      "seconds": seconds
+    }
+    if split != None:
+      result["workers_count"], result["threads"] = split
+    self.results.append(result)
+    LOGGER.warning("%s %s%s fields=%i: %.3fs", self.plate.file_type, name, split_label(result), self.plate.fields_count, seconds)
+
+  def directory(self, name):
+    return str(self.root / name)
+
+  @property
+  def stages(self):
+    from generate_all_cropped_cell_images import GenerateAllCroppedCellImagesJob
+    from generate_all_distance_transforms import GenerateAllDistanceTransformsJob
+    from generate_all_maximum_projections import GenerateAllMaximumProjectionsJob
+    from generate_all_nuclear_masks import GenerateAllNuclearMasksJob
+    from generate_all_nuclear_segmentations import GenerateAllNuclearSegmentationsJob
+    from generate_all_spot_positions import GenerateAllSpotPositionsJob
+    from generate_all_spot_result_lines import GenerateAllSpotResultLinesJob
+    from generate_cropped_cell_image import GenerateCroppedCellImageJob
+    from generate_distance_transform import GenerateDistanceTransformJob
+    from generate_maximum_projection import GenerateMaximumProjectionJob
+    from generate_nuclear_masks import GenerateNuclearMasksJob
+    from generate_spot_positions import GenerateSpotPositionsJob
+    from generate_spot_result_line import GenerateSpotResultLineJob
+    StubbedNuclearSegmentationJob = stubbed_nuclear_segmentation_job_class()
+    logs = self.directory("logs")
+
+    return [
+      ("generate_maximum_projections", {
+        "planner": lambda: GenerateAllMaximumProjectionsJob(self.directory("images"), self.directory("mips"), logs),
+        "items": lambda planner: planner.distinct_image_filename_globs,
+        "run": lambda image_filename_glob: GenerateMaximumProjectionJob(
+          self.directory("images"), str(image_filename_glob), self.directory("mips")
+        ).run()
+      }),
+      ("generate_nuclear_segmentations", {
+        "planner": lambda: GenerateAllNuclearSegmentationsJob(
+          self.directory("mips"), self.directory("segmentations"), logs, DIAMETER, DAPI_CHANNEL
+        ),
+        "items": lambda planner: planner.source_filenames,
+        "run": lambda source: StubbedNuclearSegmentationJob(
+          source, self.directory("segmentations"), self.directory("mips"), DIAMETER
+        ).run()
+      }),
+      ("generate_nuclear_masks", {
+        "planner": lambda: GenerateAllNuclearMasksJob(self.directory("segmentations"), self.directory("masks"), logs),
+        "items": lambda planner: planner.source_filenames,
+        "run": lambda source: GenerateNuclearMasksJob(source, self.directory("masks"), self.directory("segmentations")).run()
+      }),
+      ("generate_distance_transforms", {
+        "planner": lambda: GenerateAllDistanceTransformsJob(self.directory("masks"), self.directory("distance_transforms"), logs),
+        "items": lambda planner: planner.nuclear_mask_paths,
+        "run": lambda source: GenerateDistanceTransformJob(
+          source, self.directory("distance_transforms"), self.directory("masks")
+        ).run()
+      }),
+      ("generate_cropped_cell_images", {
+        "planner": lambda: GenerateAllCroppedCellImagesJob(
+          self.directory("mips"), self.directory("masks"), self.directory("crops"), logs, DAPI_CHANNEL
+        ),
+        "items": lambda planner: [
+          (source_image_path, source_mask_path)
+          for source_image_path in planner.source_image_paths
+          for source_mask_path in planner.source_mask_paths_for_source_image_path(source_image_path)
+        ],
+        "run": lambda image_and_mask: GenerateCroppedCellImageJob(
+          image_and_mask[0], image_and_mask[1], self.directory("crops"), self.directory("mips"), self.directory("masks")
+        ).run()
+      }),
+      ("generate_spot_positions", {
+        "planner": lambda: GenerateAllSpotPositionsJob(self.directory("crops"), self.directory("spots"), logs),
+        "items": lambda planner: planner.nuclear_mask_paths,
+        "run": lambda source: GenerateSpotPositionsJob(source, self.directory("spots"), self.directory("crops")).run()
+      }),
+      ("generate_spot_result_lines", {
+        "planner": lambda: GenerateAllSpotResultLinesJob(
+          self.directory("spots"),
+          self.directory("crops"),
+          self.directory("distance_transforms"),
+          self.directory("masks"),
+          self.directory("result_lines"),
+          logs
+        ),
+        "items": lambda planner: planner.spot_source_paths,
+        "run": lambda source: GenerateSpotResultLineJob(
+          source,
+          self.directory("spots"),
+          self.directory("crops"),
+          self.directory("distance_transforms"),
+          self.directory("masks"),
+          self.directory("result_lines")
+        ).run()
+      })
+    ]
+
+  def run_spot_results_file(self):
+    from generate_spot_results_file import GenerateSpotResultsFileJob
+    GenerateSpotResultsFileJob(self.directory("result_lines"), self.directory("results")).run()
+
+def split_label(result):
+  if not "threads" in result:
+    return ""
+  return " %ix%i" % (result["workers_count"], result["threads"])
+
+def run_file_type_benchmarks(file_type, plate_sizes, z_count, image_size, workdir, thread_splits=[]):
+  os.environ["FILE_TYPE"] = file_type
+  stub_cellpose()
+  results = []
+  for fields_count in plate_sizes:
+    with tempfile.TemporaryDirectory(dir=workdir) as root:
+      plate = SyntheticPlate(
+        Path(root) / "images",
+        file_type=file_type,
+        fields_count=fields_count,
+        z_count=z_count,
+        image_size=image_size,
+        DAPI_channel=DAPI_CHANNEL
+      )
+      results += PipelineBenchmark(root, plate, thread_splits).run()
+  return results
+
+def print_results(results):
+  print("%-5s %6s %-36s %8s %10s %12s" % ("type", "fields", "stage", "items", "seconds", "items/s"))
+  for result in results:
+    items_count = result["items_count"]
+    print("%-5s %6i %-36s %8s %10.3f %12s" % (
+      result["file_type"],
+      result["fields_count"],
+      result["stage"] + split_label(result),
+      "" if items_count == None else items_count,
+      result["seconds"],
+      "" if not items_count or result["seconds"] == 0 else "%.1f" % (items_count / result["seconds"])
+    ))
+
+def print_best_splits(results):
+  # the fastest workers x threads split of each stage, per file type and plate size
+  best_splits = {}
+  for result in results:
+    if not "threads" in result:
+      continue
+    key = (result["file_type"], result["fields_count"], result["stage"])
+    if not key in best_splits or result["seconds"] < best_splits[key]["seconds"]:
+      best_splits[key] = result
+  print("%-5s %6s %-36s %8s %8s" % ("type", "fields", "best split", "workers", "threads"))
+  for (file_type, fields_count, stage), result in best_splits.items():
+    print("%-5s %6i %-36s %8i %8i" % (file_type, fields_count, stage, result["workers_count"], result["threads"]))
+
+@cli.log.LoggingApp
+def run_benchmarks_cli(app):
+  try:
+    plate_sizes = [int(plate_size) for plate_size in app.params.plate_sizes.split(",")]
+    thread_splits = [int(threads) for threads in app.params.thread_splits.split(",")] if app.params.thread_splits != None else []
+    file_types = FILE_TYPES if app.params.file_type == "both" else [app.params.file_type]
+    results = []
+    for file_type in file_types:
+      if len(file_types) == 1:
+        results += run_file_type_benchmarks(
+          file_type,
+          plate_sizes,
+          app.params.z_count,
+          app.params.image_size,
+          app.params.workdir,
+          thread_splits
+        )
+        continue
+      # image filename parsing is fixed per process by FILE_TYPE, so each file type runs in its own interpreter
+      with tempfile.NamedTemporaryFile(suffix=".json") as file_type_results_file:
+        subprocess.run([
+          sys.executable, "-m", "benchmarks.run_benchmarks",
+          "--file_type=%s" % file_type,
+          "--plate_sizes=%s" % app.params.plate_sizes,
+          "--z_count=%i" % app.params.z_count,
+          "--image_size=%i" % app.params.image_size,
+          "--destination=%s" % file_type_results_file.name,
+          *(["--workdir=%s" % app.params.workdir] if app.params.workdir != None else []),
+          *(["--thread_splits=%s" % app.params.thread_splits] if app.params.thread_splits != None else [])
+        ], stdout=subprocess.DEVNULL).check_returncode()
+        with open(file_type_results_file.name) as results_json_file:
+          results += json.load(results_json_file)
+    print_results(results)
+    if len(thread_splits) > 0:
+      print_best_splits(results)
+    if app.params.destination != None:
+      with open(app.params.destination, "w") as destination_file:
+        json.dump(results, destination_file, indent=2)
+  except Exception as exception:
+    traceback.print_exc()
+
+run_benchmarks_cli.add_param("--file_type", default="both", choices=["CV", "LSM", "both"])
+run_benchmarks_cli.add_param("--plate_sizes", default="1,4")
+run_benchmarks_cli.add_param("--z_count", type=int, default=5)
+run_benchmarks_cli.add_param("--image_size", type=int, default=512)
+run_benchmarks_cli.add_param("--workdir")
+run_benchmarks_cli.add_param("--destination")
+run_benchmarks_cli.add_param("--thread_splits", help="threads per worker to try for each stage, e.g. 1,2,4")
+
+if __name__ == "__main__":
+  run_benchmarks_cli.run()
@@ -0,0 +1,109 @@
+import traceback
+from time import perf_counter
+
+import cli.log
+import numpy
+
+from models.spot_detection import crop_backgrounds, detect_spots, detect_spots_batch
+
+LOCAL_CONTRAST_THRESHOLDS = [1.5, 2.75, 4]
+PEAK_RADII = [1, 2, 3]
+GLOBAL_CONTRAST_THRESHOLDS = [0, 0.3, 0.6]
+
+def blob_log_spots(image, peak_radius, threshold, global_contrast_threshold):
+  import skimage.feature
+  import skimage.filters
+  filtered_image = skimage.filters.gaussian(image, sigma=peak_radius)
+  raw_spots = skimage.feature.blob_log(filtered_image, min_sigma=0.3, max_sigma=0.3, threshold=threshold)
+  return [
+    (int(x), int(y))
+    for x, y, _sigma
+    in raw_spots
+    if image[int(x), int(y)] > global_contrast_threshold
+  ]
+
+def synthetic_crops(crops_count, seed):
+  random = numpy.random.default_rng(seed)
+  for _ in range(crops_count):
+    rows_count, columns_count = random.integers(40, 120, size=2)
+    rows, columns = numpy.mgrid[0:rows_count, 0:columns_count]
+    nucleus = ((rows - rows_count / 2) / (rows_count / 2)) ** 2 + ((columns - columns_count / 2) / (columns_count / 2)) ** 2 < 1
+    crop = random.normal(0.2, 0.05, size=(rows_count, columns_count))
+    for spot_row, spot_column in zip(random.uniform(0, rows_count, 6), random.uniform(0, columns_count, 6)):
+      crop += random.uniform(0.3, 1) * numpy.exp(-((rows - spot_row) ** 2 + (columns - spot_column) ** 2) / (2 * random.uniform(0.7, 2) ** 2))
+    crop = numpy.clip(crop, 0, None) * nucleus
+    yield crop / crop.max()
+
+def compare(crops):
+  mismatches = 0
+  comparisons = 0
+  reference_seconds = 0.0
+  detector_seconds = 0.0
+  for crop in crops:
+    image_background = numpy.percentile(crop, 75)
+    for peak_radius in PEAK_RADII:
+      for local_contrast_threshold in LOCAL_CONTRAST_THRESHOLDS:
+        for global_contrast_threshold in GLOBAL_CONTRAST_THRESHOLDS:
+          threshold = image_background * local_contrast_threshold
+          start_time = perf_counter()
+          reference_spots = blob_log_spots(crop, peak_radius, threshold, global_contrast_threshold)
+          reference_seconds += perf_counter() - start_time
+          start_time = perf_counter()
+          spots = detect_spots(crop, peak_radius, threshold, global_contrast_threshold)
+          detector_seconds += perf_counter() - start_time
+          comparisons += 1
+          if spots != reference_spots:
+            mismatches += 1
+  return comparisons, mismatches, reference_seconds, detector_seconds
+
+def compare_batched(crops, batch_size):
+  mismatches = 0
+  detector_seconds = 0.0
+  batch_seconds = 0.0
+  crops = sorted(crops, key=lambda crop: crop.shape[0])
+  for peak_radius in PEAK_RADII:
+    for local_contrast_threshold in LOCAL_CONTRAST_THRESHOLDS:
+      for global_contrast_threshold in GLOBAL_CONTRAST_THRESHOLDS:
+        start_time = perf_counter()
+        crops_spots = [
+          detect_spots(crop, peak_radius, numpy.percentile(crop, 75) * local_contrast_threshold, global_contrast_threshold)
+          for crop in crops
+        ]
+        detector_seconds += perf_counter() - start_time
+        start_time = perf_counter()
+        batched_crops_spots = []
+        for batch_start in range(0, len(crops), batch_size):
+          batch = crops[batch_start:batch_start + batch_size]
+          batched_crops_spots += detect_spots_batch(
+            batch,
+            peak_radius,
+            crop_backgrounds(batch) * local_contrast_threshold,
+            [global_contrast_threshold] * len(batch)
+          )
+        batch_seconds += perf_counter() - start_time
+        mismatches += sum(spots != batched_spots for spots, batched_spots in zip(crops_spots, batched_crops_spots))
+  return mismatches, detector_seconds, batch_seconds
+
+@cli.log.LoggingApp
+def spot_detection_benchmark_cli(app):
+  try:
+    crops = list(synthetic_crops(app.params.crops_count, app.params.seed))
+    comparisons, mismatches, reference_seconds, detector_seconds = compare(crops)
+    print("%i comparisons, %i mismatches" % (comparisons, mismatches))
+    print("blob_log: %.4fs per crop" % (reference_seconds / comparisons))
+    print("detect_spots: %.4fs per crop (%.1fx)" % (detector_seconds / comparisons, reference_seconds / detector_seconds))
+    batch_mismatches, detector_seconds, batch_seconds = compare_batched(crops, app.params.batch_size)
+    print("%i batched mismatches" % batch_mismatches)
+    print("detect_spots with percentile: %.4fs per crop" % (detector_seconds / comparisons))
+    print("detect_spots_batch: %.4fs per crop (%.1fx)" % (batch_seconds / comparisons, detector_seconds / batch_seconds))
+    return 1 if mismatches + batch_mismatches > 0 else 0
+  except Exception as exception:
+    traceback.print_exc()
+    return 1
+
+spot_detection_benchmark_cli.add_param("--crops_count", type=int, default=50)
+spot_detection_benchmark_cli.add_param("--seed", type=int, default=0)
+spot_detection_benchmark_cli.add_param("--batch_size", type=int, default=16)
+
+if __name__ == "__main__":
+  spot_detection_benchmark_cli.run()
@@ -0,0 +1,96 @@
+from pathlib import Path
+
+import numpy
+import skimage.io
+
+from models.image_name_dictionaries.image_filename_CV import CVImageFilename
+from models.image_name_dictionaries.image_filename_LSM import LSMImageFilename
+
+LSM_TIMESTAMP = "2021_07_14__12_03_10"
+
+class SyntheticPlate:
+  def __init__(
+    self,
+    root,
+    file_type="CV",
+    experiment="SyntheticPlate",
+    wells_count=1,
+    fields_count=1,
+    channels_count=2,
+    z_count=5,
+    image_size=512,
+    nuclei_count=8,
+    nucleus_radius=24,
+    spots_per_nucleus=4,
+    DAPI_channel=1,
+    seed=0
+  ):
+    self.root = Path(root)
+    self.file_type = file_type
+    self.experiment = experiment
+    self.wells_count = wells_count
+    self.fields_count = fields_count
+    self.channels_count = channels_count
+    self.z_count = z_count
+    self.image_size = image_size
+    self.nuclei_count = nuclei_count
+    self.nucleus_radius = nucleus_radius
+    self.spots_per_nucleus = spots_per_nucleus
+    self.DAPI_channel = DAPI_channel
+    self.random = numpy.random.default_rng(seed)
+
+  def write(self):
+    for well in self.wells:
+      for f in range(1, self.fields_count + 1):
+        nuclei_centers = self.random_nuclei_centers()
+        for c in range(1, self.channels_count + 1):
+          stack = self.field_stack(nuclei_centers, spots=(c != self.DAPI_channel))
+          for z in range(1, self.z_count + 1):
+            path = self.root / str(self.image_filename(well, f, z, c))
+            if not path.parent.exists():
+              Path.mkdir(path.parent, parents=True)
+            skimage.io.imsave(str(path), stack[z - 1], check_contrast=False)
+    return self
+
+  @property
+  def wells(self):
+    return ["%s%02i" % ("ABCDEFGHIJKLMNOP"[index // 24], index % 24 + 1) for index in range(self.wells_count)]
+
+  @property
+  def images_count(self):
+    return self.wells_count * self.fields_count * self.channels_count * self.z_count
+
+  def image_filename(self, well, f, z, c):
+    if self.file_type == "LSM":
+      return LSMImageFilename(self.experiment, well, LSM_TIMESTAMP, f, z, c, "", "tif")
+    return CVImageFilename(self.experiment, well, 1, f, 1, 1, z, c, "", "tif")
+
+  def random_nuclei_centers(self):
+    margin = 2 * self.nucleus_radius
+    return self.random.integers(margin, self.image_size - margin, size=(self.nuclei_count, 2))
+
+  def field_stack(self, nuclei_centers, spots):
+    rows, columns = numpy.mgrid[0:self.image_size, 0:self.image_size]
+    plane = numpy.zeros((self.image_size, self.image_size))
+    for center_row, center_column in nuclei_centers:
+      squared_distances = (rows - center_row) ** 2 + (columns - center_column) ** 2
+      if spots:
+        plane += 0.1 * numpy.exp(-squared_distances / (2 * self.nucleus_radius ** 2))
+        for spot_row, spot_column in self.random_spots_in_nucleus(center_row, center_column):
+          plane += numpy.exp(-((rows - spot_row) ** 2 + (columns - spot_column) ** 2) / 2.0)
+      else:
+        plane += numpy.exp(-squared_distances / (2 * (self.nucleus_radius / 2) ** 2))
+
+    # intensity peaks at the middle slice so that the z center is well defined
+    z_profile = numpy.exp(-((numpy.arange(self.z_count) - (self.z_count - 1) / 2) ** 2) / (2 * max(1, self.z_count / 4) ** 2))
+    stack = plane[numpy.newaxis, :, :] * z_profile[:, numpy.newaxis, numpy.newaxis] * 4000
+    stack += self.random.normal(100, 10, size=stack.shape)
+    return numpy.clip(stack, 0, 65535).astype(numpy.uint16)
+
+  def random_spots_in_nucleus(self, center_row, center_column):
+    angles = self.random.uniform(0, 2 * numpy.pi, self.spots_per_nucleus)
+    distances = self.random.uniform(0, self.nucleus_radius / 2, self.spots_per_nucleus)
+    return numpy.stack([
+      numpy.round(center_row + distances * numpy.sin(angles)),
+      numpy.round(center_column + distances * numpy.cos(angles))
+    ], axis=1)
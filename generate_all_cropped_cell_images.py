@@ -7,11 +7,15 @@ import cli.log
 from generate_cropped_cell_image import generate_cropped_cell_image_cli_str
 from models.image_filename import ImageFilename
 from models.image_filename_glob import ImageFilenameGlob
+from models.failure_manifest import failures_path, retrying_failures
+from models.instrumentation import instrumented_shard, timed
 from models.paths import *
-from models.swarm_job import shard_job_params, SwarmJob
+from models.shard_manifest import write_shard_manifests
+from models.swarm_job import SwarmJob, stream_job_params
 
 FILES_PER_CALL_COUNT = 20000
 MEMORY = 1.5
+THREADS = 1
 
 class GenerateAllCroppedCellImagesJob:
   def __init__(self, source_images, source_masks, destination, log, DAPI_channel):
@@ -23,28 +27,56 @@ class GenerateAllCroppedCellImagesJob:
     self.DAPI_channel = DAPI_channel
   
   def run(self):
-    SwarmJob(
-      self.source_images,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL_COUNT
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_cropped_cell_images") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_cropped_cell_images"):
+      with timed("run"):
+        SwarmJob(
+          self.source_images,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL_COUNT,
+          threads=THREADS
+        ).run()
 
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      masks = [
-        (source_image_path, source_mask_path)
-        for source_image_path in self.source_image_paths
-        for source_mask_path in self.source_mask_paths_for_source_image_path(source_image_path)
-      ]
-      shards = shard_job_params(masks, FILES_PER_CALL_COUNT)
-      self._jobs = [generate_cropped_cell_image_cli_str(shard, self.destination_path, self.source_images, self.source_masks) for shard in shards]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    masks = (
+      (source_image_path, source_mask_path)
+      for source_image_path in self.source_image_paths
+      for source_mask_path in self.source_mask_paths_for_source_image_path(source_image_path)
+    )
+    return self.shard_jobs(masks)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL_COUNT))
+    return (
+      generate_cropped_cell_image_cli_str(
+        shard,
+        self.destination_path,
+        self.source_images,
+        self.source_masks,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def job_name(self):
     if not hasattr(self, "_job_name"):
@@ -95,17 +127,23 @@ class GenerateAllCroppedCellImagesJob:
 @cli.log.LoggingApp
 def generate_all_cropped_cell_images_cli(app):
   try:
-    GenerateAllCroppedCellImagesJob(
+    job = GenerateAllCroppedCellImagesJob(
       app.params.source_images,
       app.params.source_masks,
       app.params.destination,
-    ).run()
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
 generate_all_cropped_cell_images_cli.add_param("source_images")
 generate_all_cropped_cell_images_cli.add_param("source_masks")
 generate_all_cropped_cell_images_cli.add_param("destination")
+generate_all_cropped_cell_images_cli.add_param("--retry", action="store_true")
+generate_all_cropped_cell_images_cli.add_param("--memory", type=float)
 
 if __name__ == "__main__":
    generate_all_cropped_cell_images_cli.run()
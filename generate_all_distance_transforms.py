@@ -5,11 +5,15 @@ import logging
 
 from generate_distance_transform import generate_distance_transform_cli_str
 
+from models.failure_manifest import failures_path, retrying_failures
+from models.instrumentation import instrumented_shard, timed
 from models.paths import *
-from models.swarm_job import SwarmJob, shard_job_params
+from models.shard_manifest import write_shard_manifests
+from models.swarm_job import SwarmJob, stream_job_params
 
 FILES_PER_CALL_COUNT = 50000
 MEMORY = 1.5
+THREADS = 1
 
 class GenerateAllDistanceTransformsJob:
   def __init__(self, source, destination, log):
@@ -19,25 +23,50 @@ class GenerateAllDistanceTransformsJob:
     self.logger = logging.getLogger()
 
   def run(self):
-    SwarmJob(
-      self.source,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL_COUNT
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_distance_transforms") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_distance_transforms"):
+      with timed("run"):
+        SwarmJob(
+          self.source,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL_COUNT,
+          threads=THREADS
+        ).run()
 
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      shards = shard_job_params(self.nuclear_mask_paths, FILES_PER_CALL_COUNT)
-      self._jobs = [
-        generate_distance_transform_cli_str(shard, self.destination, self.source) for shard in shards
-      ]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    return self.shard_jobs(self.nuclear_mask_paths)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL_COUNT))
+    return (
+      generate_distance_transform_cli_str(
+        shard,
+        self.destination,
+        self.source,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def job_name(self):
     if not hasattr(self, "_job_name"):
@@ -63,15 +92,21 @@ class GenerateAllDistanceTransformsJob:
 @cli.log.LoggingApp
 def generate_all_distance_transforms_cli(app):
   try:
-    GenerateAllDistanceTransformsJob(
+    job = GenerateAllDistanceTransformsJob(
       app.params.source,
       app.params.destination,
-    ).run()
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
 generate_all_distance_transforms_cli.add_param("source")
 generate_all_distance_transforms_cli.add_param("destination")
+generate_all_distance_transforms_cli.add_param("--retry", action="store_true")
+generate_all_distance_transforms_cli.add_param("--memory", type=float)
 
 if __name__ == "__main__":
    generate_all_distance_transforms_cli.run()
@@ -12,46 +12,70 @@ import cli.log
 from generate_maximum_projection import generate_maximum_projection_cli_str
 from models.image_filename import *
 from models.image_filename_glob import *
+from models.failure_manifest import failures_path, retrying_failures
+from models.instrumentation import instrumented_shard, timed
 from models.paths import *
-from models.swarm_job import SwarmJob, shard_job_params
+from models.shard_manifest import write_shard_manifests
+from models.swarm_job import SwarmJob, stream_job_params
 
 FILES_PER_CALL_COUNT = 2000
 MEMORY = 2
+THREADS = 2
 
 class GenerateAllMaximumProjectionsJob:
-  def __init__(self, source, destination, log):
+  def __init__(self, source, destination, log, tile_size=None):
     self.source = source
     self.destination = destination
     self.logdir = log
+    self.tile_size = tile_size
     self.logger = logging.getLogger()
   
   def run(self):
-    SwarmJob(
-      self.source,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL_COUNT
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_maximum_projections") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_maximum_projections"):
+      with timed("run"):
+        SwarmJob(
+          self.source,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL_COUNT,
+          threads=THREADS
+        ).run()
 
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      image_filename_constraints_shards = shard_job_params(
-        self.distinct_image_filename_globs,
-        FILES_PER_CALL_COUNT
-      )
-      self._jobs = [
-        generate_maximum_projection_cli_str(
-          self.source,
-          image_filename_constraints_shard,
-          self.destination
-        ) for image_filename_constraints_shard in image_filename_constraints_shards
-      ]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    return self.shard_jobs(self.distinct_image_filename_glob_stream)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL_COUNT))
+    return (
+      generate_maximum_projection_cli_str(
+        self.source,
+        shard,
+        self.destination,
+        tile_size=self.tile_size,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def job_name(self):
     if not hasattr(self, "_job_name"):
@@ -82,24 +106,39 @@ class GenerateAllMaximumProjectionsJob:
   @property
   def distinct_image_filename_globs(self):
     if not hasattr(self, "_distinct_image_filename_globs"):
-      self._distinct_image_filename_globs = set((
-        ImageFilenameGlob.from_image_filename(image_filename, excluding_keys=["z"])
-        for image_filename in self.image_filenames
-      ))
+      self._distinct_image_filename_globs = set(self.distinct_image_filename_glob_stream)
     return self._distinct_image_filename_globs
 
+  @property
+  def distinct_image_filename_glob_stream(self):
+    # each projection is yielded at its first slice, so shards fill while the rest of the plate is listed
+    seen_image_filename_globs = set()
+    for image_filename in self.image_filenames:
+      image_filename_glob = ImageFilenameGlob.from_image_filename(image_filename, excluding_keys=["z"])
+      if not image_filename_glob in seen_image_filename_globs:
+        seen_image_filename_globs.add(image_filename_glob)
+        yield image_filename_glob
+
 @cli.log.LoggingApp
 def generate_all_maximum_projections_cli(app):
   try:
-    GenerateAllMaximumProjectionsJob(
+    job = GenerateAllMaximumProjectionsJob(
       app.params.source,
-      app.params.destination
-    ).run()
+      app.params.destination,
+      tile_size=app.params.tile_size
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
 generate_all_maximum_projections_cli.add_param("source")
 generate_all_maximum_projections_cli.add_param("destination")
+generate_all_maximum_projections_cli.add_param("--tile_size", type=int)
+generate_all_maximum_projections_cli.add_param("--retry", action="store_true")
+generate_all_maximum_projections_cli.add_param("--memory", type=float)
 
 if __name__ == "__main__":
   generate_all_maximum_projections_cli.run()
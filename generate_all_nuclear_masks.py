@@ -5,29 +5,47 @@ from datetime import datetime
 import cli.log
 
 from generate_nuclear_masks import generate_nuclear_masks_cli_str
+from models.failure_manifest import failures_path, retrying_failures
+from models.instrumentation import instrumented_shard, timed
 from models.paths import *
-from models.swarm_job import SwarmJob, shard_job_params
+from models.shard_manifest import write_shard_manifests
+from models.swarm_job import SwarmJob, stream_job_params
 
 FILES_PER_CALL_COUNT = 5000
 MEMORY = 1.5
+THREADS = 1
 
 class GenerateAllNuclearMasksJob:
-  def __init__(self, source, destination, log):
+  def __init__(self, source, destination, log, min_area=None, max_area=None):
     self.source = source
     self.destination = destination
     self.logdir = log
+    self.min_area = min_area
+    self.max_area = max_area
     self.logger = logging.getLogger()
 
   def run(self):
-    SwarmJob(
-      self.source,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL_COUNT
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_nuclear_masks") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_nuclear_masks"):
+      with timed("run"):
+        SwarmJob(
+          self.source,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL_COUNT,
+          threads=THREADS
+        ).run()
 
   @property
   def job_name(self):
@@ -52,29 +70,54 @@ class GenerateAllNuclearMasksJob:
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      source_filenames_shards = shard_job_params(self.source_filenames, FILES_PER_CALL_COUNT)
-      self._jobs = [
-        generate_nuclear_masks_cli_str(source_filenames_shard, self.destination, self.source)
-        for source_filenames_shard in source_filenames_shards
-      ]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    return self.shard_jobs(self.source_filenames)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL_COUNT))
+    return (
+      generate_nuclear_masks_cli_str(
+        shard,
+        self.destination,
+        self.source,
+        self.min_area,
+        self.max_area,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def source_filenames(self):
-    return self.source_path.rglob("*_nuclear_segmentation.npy")
+    # segmentations are .npy label matrices or .npz run length encodings
+    return self.source_path.rglob("*_nuclear_segmentation.np[yz]")
 
 @cli.log.LoggingApp
 def generate_all_nuclear_masks(app):
   try:
-    GenerateAllNuclearMasksJob(
+    job = GenerateAllNuclearMasksJob(
       app.params.source,
       app.params.destination,
-    ).run()
+      min_area=app.params.min_area,
+      max_area=app.params.max_area
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
 generate_all_nuclear_masks.add_param("source")
 generate_all_nuclear_masks.add_param("destination")
+generate_all_nuclear_masks.add_param("--min_area", type=int)
+generate_all_nuclear_masks.add_param("--max_area", type=int)
+generate_all_nuclear_masks.add_param("--retry", action="store_true")
+generate_all_nuclear_masks.add_param("--memory", type=float)
 
 if __name__ == "__main__":
   generate_all_nuclear_masks.run()
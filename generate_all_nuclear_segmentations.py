@@ -6,43 +6,77 @@ import logging
 
 from generate_nuclear_segmentation import generate_nuclear_segmentation_cli_str
 
+from models.failure_manifest import failures_path, retrying_failures
+from models.field_quality import ESTIMATED_SEGMENTATION_SECONDS, MIN_FOREGROUND_FRACTION, PREFILTER_MODES, FieldQualityFilter
+from models.instrumentation import instrumented_shard, timed
+from models.label_encoding import LABEL_ENCODINGS
 from models.paths import *
-from models.swarm_job import SwarmJob, shard_job_params
+from models.shard_manifest import write_shard_manifests
+from models.swarm_job import SwarmJob, stream_job_params
 from models.image_filename_glob import ImageFilenameGlob
 
 FILES_PER_CALL_COUNT = 10
 MEMORY = 8
+THREADS = 4
 
 class GenerateAllNuclearSegmentationsJob:
-  def __init__(self, source, destination, log, diameter, DAPI_channel=1):
+  def __init__(self, source, destination, log, diameter, DAPI_channel=1, encoding="npy", field_quality_filter=None):
     self.source = source
     self.destination = destination
     self.diameter = diameter
     self.logdir = log
     self.DAPI = DAPI_channel
+    self.encoding = encoding
+    self.field_quality_filter = field_quality_filter
     self.logger = logging.getLogger()
 
   def run(self):
-    SwarmJob(
-      self.source,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL_COUNT
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_nuclear_segmentations") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_nuclear_segmentations"):
+      with timed("run"):
+        SwarmJob(
+          self.source,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL_COUNT,
+          threads=THREADS
+        ).run()
 
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      source_filenames_shards = shard_job_params(self.source_filenames, FILES_PER_CALL_COUNT)
-      self._jobs = [
-        generate_nuclear_segmentation_cli_str(source_filenames_shard, self.destination, self.source, self.diameter)
-        for source_filenames_shard in source_filenames_shards
-      ]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    return self.shard_jobs(self.prefiltered_source_filenames)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL_COUNT))
+    return (
+      generate_nuclear_segmentation_cli_str(
+        shard,
+        self.destination,
+        self.source,
+        self.diameter,
+        self.encoding,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def job_name(self):
     if not hasattr(self, "_job_name"):
@@ -61,6 +95,12 @@ class GenerateAllNuclearSegmentationsJob:
   def source_filenames(self):
     return self.source_path.rglob(str(ImageFilenameGlob(c=self.DAPI, suffix="_maximum_projection", extension="tif")))
 
+  @property
+  def prefiltered_source_filenames(self):
+    if self.field_quality_filter == None:
+      return self.source_filenames
+    return self.field_quality_filter.filter(self.source_filenames, self.destination_path, self.job_name)
+
   @property
   def destination_path(self):
     if not hasattr(self, "_destination_path"):
@@ -70,17 +110,35 @@ class GenerateAllNuclearSegmentationsJob:
 @cli.log.LoggingApp
 def generate_all_nuclear_segmentations(app):
   try:
-    GenerateAllNuclearSegmentationsJob(
+    job = GenerateAllNuclearSegmentationsJob(
       app.params.source,
       app.params.destination,
-      app.params.diameter
-    ).run()
+      app.params.diameter,
+      encoding=app.params.encoding,
+      field_quality_filter=FieldQualityFilter(
+        mode=app.params.prefilter,
+        min_foreground_fraction=app.params.min_foreground_fraction,
+        min_focus=app.params.min_focus,
+        estimated_segmentation_seconds=app.params.segmentation_seconds
+      ) if app.params.prefilter != None else None
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
 generate_all_nuclear_segmentations.add_param("source")
 generate_all_nuclear_segmentations.add_param("destination")
 generate_all_nuclear_segmentations.add_param("--diameter", type=int)
+generate_all_nuclear_segmentations.add_param("--encoding", choices=LABEL_ENCODINGS, default="npy")
+generate_all_nuclear_segmentations.add_param("--prefilter", choices=PREFILTER_MODES)
+generate_all_nuclear_segmentations.add_param("--min_foreground_fraction", type=float, default=MIN_FOREGROUND_FRACTION)
+generate_all_nuclear_segmentations.add_param("--min_focus", type=float)
+generate_all_nuclear_segmentations.add_param("--segmentation_seconds", type=float, default=ESTIMATED_SEGMENTATION_SECONDS)
+generate_all_nuclear_segmentations.add_param("--retry", action="store_true")
+generate_all_nuclear_segmentations.add_param("--memory", type=float)
 
 if __name__ == "__main__":
   generate_all_nuclear_segmentations.run()
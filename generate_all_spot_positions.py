@@ -5,13 +5,17 @@ import logging
 
 from generate_spot_positions import generate_spot_positions_cli_str
 
+from models.failure_manifest import failures_path, retrying_failures
+from models.instrumentation import instrumented_shard, timed
 from models.paths import *
-from models.swarm_job import SwarmJob, shard_job_params
+from models.shard_manifest import write_shard_manifests
+from models.swarm_job import SwarmJob, stream_job_params
 from models.image_filename import ImageFilename
 from models.image_filename_glob import ImageFilenameGlob
 
 FILES_PER_CALL = 20000
 MEMORY = 2
+THREADS = 2
 
 class GenerateAllSpotPositionsJob:
   def __init__(self, source, destination, log, config=None):
@@ -22,26 +26,51 @@ class GenerateAllSpotPositionsJob:
     self.logger = logging.getLogger()
 
   def run(self):
-    SwarmJob(
-      self.source,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_spot_positions") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_spot_positions"):
+      with timed("run"):
+        SwarmJob(
+          self.source,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL,
+          threads=THREADS
+        ).run()
 
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      nuclear_mask_paths_shards = shard_job_params(self.nuclear_mask_paths, FILES_PER_CALL)
-      self._jobs = [
-        generate_spot_positions_cli_str(nuclear_mask_paths_shard, self.destination, self.source, config=self.config)
-        for nuclear_mask_paths_shard in nuclear_mask_paths_shards
-      ]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    return self.shard_jobs(self.nuclear_mask_paths)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL))
+    return (
+      generate_spot_positions_cli_str(
+        shard,
+        self.destination,
+        self.source,
+        config=self.config,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def job_name(self):
     if not hasattr(self, "_job_name"):
@@ -67,12 +96,16 @@ class GenerateAllSpotPositionsJob:
 @cli.log.LoggingApp
 def generate_all_spot_positions_cli(app):
   try:
-    GenerateAllSpotPositionsJob(
+    job = GenerateAllSpotPositionsJob(
       app.params.source,
       app.params.destination,
       app.params.source_dir,
       config=app.params.config
-    ).run()
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
@@ -80,6 +113,8 @@ generate_all_spot_positions_cli.add_param("source")
 generate_all_spot_positions_cli.add_param("destination")
 generate_all_spot_positions_cli.add_param("source_dir")
 generate_all_spot_positions_cli.add_param("--config")
+generate_all_spot_positions_cli.add_param("--retry", action="store_true")
+generate_all_spot_positions_cli.add_param("--memory", type=float)
 
 if __name__ == "__main__":
    generate_all_spot_positions_cli.run()
@@ -5,13 +5,18 @@ import logging
 
 from generate_spot_result_line import generate_spot_result_line_cli_str
 
+from models.failure_manifest import failures_path, retrying_failures
+from models.instrumentation import instrumented_shard, timed
 from models.paths import *
+from models.result_shard_writer import result_shard_filename
+from models.shard_manifest import write_shard_manifests
 from models.image_filename import ImageFilename
 from models.image_filename_glob import ImageFilenameGlob
-from models.swarm_job import SwarmJob, shard_job_params
+from models.swarm_job import SwarmJob, stream_job_params
 
 FILES_PER_CALL_COUNT = 20000
 MEMORY = 2
+THREADS = 1
 
 class GenerateAllSpotResultLinesJob:
   def __init__(
@@ -21,7 +26,8 @@ class GenerateAllSpotResultLinesJob:
     distance_transforms_source_directory,
     nuclear_masks_source_directory_path,
     destination,
-    log
+    log,
+    shard_outputs=False
   ):
     self.spots_source_directory = spots_source_directory
     self.z_centers_source_directory = z_centers_source_directory
@@ -29,36 +35,58 @@ class GenerateAllSpotResultLinesJob:
     self.nuclear_masks_source_directory_path = nuclear_masks_source_directory_path
     self.destination = destination
     self.logdir = log
+    self.shard_outputs = shard_outputs
     self.logger = logging.getLogger()
   
   def run(self):
-    SwarmJob(
-      self.spots_source_directory,
-      self.destination_path,
-      self.job_name,
-      self.jobs,
-      self.logdir,
-      MEMORY,
-      FILES_PER_CALL_COUNT
-    ).run()
+    self.run_jobs(self.job_stream, MEMORY)
+
+  def retry(self, memory=MEMORY):
+    with retrying_failures(self.destination_path, "generate_all_spot_result_lines") as items:
+      self.logger.warning("retrying %i failed items", len(items))
+      if len(items) > 0:
+        self.run_jobs(self.shard_jobs(items), memory)
+
+  def run_jobs(self, jobs, memory):
+    with instrumented_shard("generate_all_spot_result_lines"):
+      with timed("run"):
+        SwarmJob(
+          self.spots_source_directory,
+          self.destination_path,
+          self.job_name,
+          jobs,
+          self.logdir,
+          memory,
+          FILES_PER_CALL_COUNT,
+          threads=THREADS
+        ).run()
 
   @property
   def jobs(self):
     if not hasattr(self, "_jobs"):
-      spot_source_paths_shards = shard_job_params(self.spot_source_paths, FILES_PER_CALL_COUNT)
-      self._jobs = [
-        generate_spot_result_line_cli_str(
-          spot_source_paths_shard,
-          self.spots_source_directory,
-          self.z_centers_source_directory,
-          self.distance_transforms_source_directory,
-          self.nuclear_masks_source_directory_path,
-          self.destination
-        )
-        for spot_source_paths_shard in spot_source_paths_shards
-      ]
+      self._jobs = list(self.job_stream)
     return self._jobs
 
+  @property
+  def job_stream(self):
+    return self.shard_jobs(self.spot_source_paths)
+
+  def shard_jobs(self, items):
+    shards = write_shard_manifests(self.destination_path, self.job_name, stream_job_params(items, FILES_PER_CALL_COUNT))
+    return (
+      generate_spot_result_line_cli_str(
+        shard,
+        self.z_centers_source_directory,
+        self.distance_transforms_source_directory,
+        self.nuclear_masks_source_directory_path,
+        self.spots_source_directory,
+        self.destination,
+        shard_output=result_shard_filename(self.job_name, shard_index) if self.shard_outputs else None,
+        failures=failures_path(self.destination_path, self.job_name, shard_index)
+      )
+      for shard_index, shard in enumerate(shards)
+    )
+
   @property
   def job_name(self):
     if not hasattr(self, "_job_name"):
@@ -86,13 +114,18 @@ class GenerateAllSpotResultLinesJob:
 @cli.log.LoggingApp
 def generate_all_spot_result_lines_cli(app):
   try:
-    GenerateAllSpotResultLinesJob(
+    job = GenerateAllSpotResultLinesJob(
       app.params.spots_source_directory,
       app.params.z_centers_source_directory,
       app.params.distance_transforms_source_directory,
       app.params.nuclear_masks_source_directory_path,
       app.params.destination,
-    ).run()
+      shard_outputs=app.params.shard_outputs
+    )
+    if app.params.retry:
+      job.retry(app.params.memory or MEMORY)
+    else:
+      job.run()
   except Exception as exception:
     traceback.print_exc()
 
@@ -101,6 +134,9 @@ generate_all_spot_result_lines_cli.add_param("z_centers_source_directory", defau
 generate_all_spot_result_lines_cli.add_param("distance_transforms_source_directory", default="todo", nargs="?")
 generate_all_spot_result_lines_cli.add_param("nuclear_masks_source_directory_path", default="todo", nargs="?")
 generate_all_spot_result_lines_cli.add_param("destination", default="C:\\\\Users\\finne\\Documents\\python\\spot_result_lines\\", nargs="?")
+generate_all_spot_result_lines_cli.add_param("--shard_outputs", action="store_true")
+generate_all_spot_result_lines_cli.add_param("--retry", action="store_true")
+generate_all_spot_result_lines_cli.add_param("--memory", type=float)
 
 if __name__ == "__main__":
    generate_all_spot_result_lines_cli.run()
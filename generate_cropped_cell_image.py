@@ -1,27 +1,32 @@
-import re
+import os
 import shlex
-import traceback
 from copy import copy
 from functools import lru_cache
 
 import cli.log
-import matplotlib.pyplot as plt
 import numpy
-import skimage.io
-import skimage.measure
-import skimage.util
 
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
 from models.image_filename import ImageFilename
+from models.instrumentation import instrumented_shard, numpy_save_path, record_read, record_write, timed
+from models.memory_governor import governed_item, releasable_cache
 from models.nuclear_mask import NuclearMask
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.scratch_staging import default_scratch, scratch_staging
+from models.shard_manifest import ShardManifest, manifest_sources, source_arguments
 
 
+@releasable_cache
 @lru_cache(maxsize=1)
 def load_source_image(source_image_path):
   if source_image_path.suffix == ".tif":
-    return skimage.io.imread(source_image_path)
+    import skimage.io
+    source_image = skimage.io.imread(source_image_path)
   else:
-    return numpy.load(source_image_path, allow_pickle=True)
+    source_image = numpy.load(source_image_path, allow_pickle=True)
+  record_read(source_image_path)
+  return source_image
 
 class GenerateCroppedCellImageJob:
   def __init__(self, source_image, source_mask, destination, source_image_dir, source_mask_dir):
@@ -32,7 +37,14 @@ class GenerateCroppedCellImageJob:
     self.source_mask_dir = Path(source_mask_dir)
 
   def run(self):
-    numpy.save(self.destination_filename, self.masked_cropped_image)
+    with timed("load"):
+      self.image
+      self.mask
+    with timed("compute"):
+      self.masked_cropped_image
+    with timed("save"):
+      numpy.save(self.destination_filename, self.masked_cropped_image)
+    record_write(numpy_save_path(self.destination_filename))
 
   @property
   def destination_filename(self):
@@ -41,14 +53,8 @@ class GenerateCroppedCellImageJob:
   @property
   def destination_path(self):
     if not hasattr(self, "_destination_path"):
-      global_destination_path = Path(self.destination)
-      local_destination_path = Path(str(self.source_image_path.relative_to(self.source_image_dir))).parents[0]
-      path_to_make = global_destination_path / local_destination_path
-      self._destination_path = global_destination_path 
-      if not path_to_make.exists():
-        Path.mkdir(path_to_make, parents=True)
-      elif not path_to_make.is_dir():
-        raise Exception("destination already exists, but is not a directory")
+      self._destination_path = Path(self.destination)
+      ensure_directory(self._destination_path / os.path.dirname(self.source_image_relative_path))
     return self._destination_path
 
   @property
@@ -74,9 +80,15 @@ class GenerateCroppedCellImageJob:
   @property
   def source_image_filename(self):
     if not hasattr(self, "_source_image_filename"):
-      self._source_image_filename = ImageFilename.parse(str(self.source_image_path.relative_to(self.source_image_dir)))
+      self._source_image_filename = ImageFilename.parse(self.source_image_relative_path)
     return self._source_image_filename
 
+  @property
+  def source_image_relative_path(self):
+    if not hasattr(self, "_source_image_relative_path"):
+      self._source_image_relative_path = relative_path(self.source_image_path, self.source_image_dir)
+    return self._source_image_relative_path
+
   @property
   def source_image_suffix(self):
     return self.source_image_filename.suffix
@@ -84,7 +96,7 @@ class GenerateCroppedCellImageJob:
   @property
   def source_mask_suffix(self):
     if not hasattr(self, "_source_mask_suffix"):
-      self._source_mask_suffix = ImageFilename.parse(str(self.source_mask_path.relative_to(self.source_mask_dir))).suffix
+      self._source_mask_suffix = ImageFilename.parse(relative_path(self.source_mask_path, self.source_mask_dir)).suffix
     return self._source_mask_suffix
 
   @property
@@ -97,6 +109,7 @@ class GenerateCroppedCellImageJob:
   def mask(self):
     if not hasattr(self, "_mask"):
       self._mask = numpy.load(self.source_mask_path, allow_pickle=True).item()
+      record_read(self.source_mask_path)
     return self._mask
 
   @property
@@ -137,44 +150,66 @@ class GenerateCroppedCellImageJob:
   def masked_cropped_image(self):
     if not hasattr(self, "_masked_cropped_image"):
       if self.source_image_filename.extension == "tif":
+        import skimage.exposure
         normed_image = skimage.exposure.rescale_intensity(self.rect_cropped_image, in_range=(self.min_in_nucleus, self.max_in_nucleus), out_range=(0,1))
         self._masked_cropped_image = normed_image * self.nuclear_mask
       else:
         self._masked_cropped_image = self.rect_cropped_image * self.nuclear_mask
     return self._masked_cropped_image
 
-def generate_cropped_cell_image_cli_str(masks, destination, source_images_dir, source_masks_dir):
-  serialized_masks_params = (str(param) for image_or_mask_param in masks for param in image_or_mask_param)
+def generate_cropped_cell_image_cli_str(masks, destination, source_images_dir, source_masks_dir, failures=None):
+  if isinstance(masks, ShardManifest):
+    serialized_masks_params = source_arguments(masks)
+  else:
+    serialized_masks_params = (str(param) for image_or_mask_param in masks for param in image_or_mask_param)
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_cropped_cell_image"),
     "--destination=%s" % destination,
     "--source_images_dir=%s" % source_images_dir,
     "--source_masks_dir=%s" % source_masks_dir,
+    *failures_arguments(failures),
     *serialized_masks_params
   ])
 
 @cli.log.LoggingApp
 def generate_cropped_cell_image_cli(app):
-  for mask_pair_start_index in (index * 2 for index in range(int(len(app.params.masks) / 2))):
-    source_image, source_mask = app.params.masks[mask_pair_start_index:mask_pair_start_index + 2]
-    try:
-      GenerateCroppedCellImageJob(
-        source_image,
-        source_mask,
-        app.params.destination,
-        app.params.source_images_dir,
-        app.params.source_masks_dir,
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_cropped_cell_image"), recording_failures(app.params.failures), scratch_staging(app.params.scratch) as staging:
+    source_image_and_masks = manifest_sources(list(zip(app.params.masks[::2], app.params.masks[1::2])), app.params.manifest)
+    source_images_dir, source_masks_dir, destination = app.params.source_images_dir, app.params.source_masks_dir, app.params.destination
+    if staging != None:
+      source_image_and_masks = list(source_image_and_masks)
+      # an image is paired with each of its masks, so it is copied once
+      source_images = sorted(set(str(source_image) for source_image, _source_mask in source_image_and_masks))
+      staged_images = dict(zip(source_images, staging.stage(source_images, source_images_dir)))
+      source_image_and_masks = list(zip(
+        (staged_images[str(source_image)] for source_image, _source_mask in source_image_and_masks),
+        staging.stage((source_mask for _source_image, source_mask in source_image_and_masks), source_masks_dir)
+      ))
+      source_images_dir = staging.input_directory(source_images_dir)
+      source_masks_dir = staging.input_directory(source_masks_dir)
+      destination = staging.output_directory(destination)
+    ensure_destination_directories(
+      (source_image for source_image, _source_mask in source_image_and_masks),
+      source_images_dir,
+      destination
+    )
+    for source_image, source_mask in source_image_and_masks:
+      with timed("item"), recorded_failure((source_image, source_mask)), governed_item((source_image, source_mask)):
+        GenerateCroppedCellImageJob(
+          source_image,
+          source_mask,
+          destination,
+          source_images_dir,
+          source_masks_dir,
+        ).run()
 
 generate_cropped_cell_image_cli.add_param("masks", nargs="*")
 generate_cropped_cell_image_cli.add_param("--destination", required=True)
 generate_cropped_cell_image_cli.add_param("--source_images_dir", required=True)
 generate_cropped_cell_image_cli.add_param("--source_masks_dir", required=True)
+generate_cropped_cell_image_cli.add_param("--manifest")
+generate_cropped_cell_image_cli.add_param("--failures")
+generate_cropped_cell_image_cli.add_param("--scratch", default=default_scratch())
 
 if __name__ == "__main__":
    generate_cropped_cell_image_cli.run()
@@ -1,13 +1,17 @@
-import copy
-import logging
+import os
 import shlex
-import traceback
 
 import cli.log
 import numpy
-from scipy import ndimage
 
+from models.async_io import IO_THREADS, AsyncWriter, prefetch
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
+from models.instrumentation import instrumented_shard, numpy_save_path, record_read, record_write, timed
+from models.memory_governor import governed_item
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.scratch_staging import default_scratch, scratch_staging, staged_sources
+from models.shard_manifest import manifest_sources, source_arguments
 
 
 class GenerateDistanceTransformJob:
@@ -16,17 +20,32 @@ class GenerateDistanceTransformJob:
     self.destination = destination
     self.source_dir = Path(source_dir)
 
-  def run(self):
-    numpy.save(self.destination_filename, self.distance_transform)
+  def run(self, async_writer=None):
+    with timed("load"):
+      self.nuclear_mask
+    with timed("compute"):
+      self.distance_transform
+    if async_writer != None:
+      async_writer.save(self.destination_filename, self.distance_transform, self.source)
+      return
+    with timed("save"):
+      numpy.save(self.destination_filename, self.distance_transform)
+    record_write(numpy_save_path(self.destination_filename))
 
   @property
   def destination_filename(self):
-    source_relative_path = str(self.source_path.relative_to(self.source_dir))
-    return self.destination_path / source_relative_path.replace("_nuclear_mask_", "_distance_transform_")
+    return self.destination_path / self.source_relative_path.replace("_nuclear_mask_", "_distance_transform_")
+
+  @property
+  def source_relative_path(self):
+    if not hasattr(self, "_source_relative_path"):
+      self._source_relative_path = relative_path(self.source_path, self.source_dir)
+    return self._source_relative_path
 
   @property
   def distance_transform(self):
     if not hasattr(self, "_distance_transform"):
+       from scipy import ndimage
        raw_transform = ndimage.distance_transform_edt(self.nuclear_mask)
        normed_transform = raw_transform/numpy.amax(raw_transform)
        self._distance_transform = 1 - normed_transform
@@ -36,19 +55,14 @@ class GenerateDistanceTransformJob:
   def nuclear_mask(self):
     if not hasattr(self, "_nuclear_mask"):
       self._nuclear_mask = numpy.load(self.source_path, allow_pickle=True).item().mask
+      record_read(self.source_path)
     return self._nuclear_mask
 
   @property
   def destination_path(self):
     if not hasattr(self, "_destination_path"):
-      global_destination_path = Path(self.destination)
-      local_destination_path = Path(str(self.source_path.relative_to(self.source_dir))).parents[0]
-      path_to_make = global_destination_path / local_destination_path
-      self._destination_path = global_destination_path 
-      if not path_to_make.exists():
-        Path.mkdir(path_to_make, parents=True)
-      elif not path_to_make.is_dir():
-        raise Exception("destination already exists, but is not a directory")
+      self._destination_path = Path(self.destination)
+      ensure_directory(self._destination_path / os.path.dirname(self.source_relative_path))
     return self._destination_path
 
   @property
@@ -57,32 +71,53 @@ class GenerateDistanceTransformJob:
       self._source_path = source_path(self.source)
     return self._source_path
 
-def generate_distance_transform_cli_str(sources, destination, source_dir):
+def generate_distance_transform_cli_str(sources, destination, source_dir, failures=None):
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_distance_transform"),
     "--destination=%s" % destination,
     "--source_dir=%s" % source_dir,
-    *[str(source) for source in sources]
+    *failures_arguments(failures),
+    *source_arguments(sources)
   ])
 
+def generate_distance_transforms(params, async_writer=None):
+  jobs = (
+    GenerateDistanceTransformJob(
+      source,
+      params.destination,
+      params.source_dir,
+    )
+    for source in params.sources
+  )
+  if async_writer != None:
+    jobs = prefetch(jobs, lambda job: job.nuclear_mask, threads=params.io_threads)
+  for job in jobs:
+    with timed("item"), recorded_failure(job.source), governed_item(job.source):
+      job.run(async_writer)
+
 @cli.log.LoggingApp
 def generate_distance_transform_cli(app):
-  for source in app.params.sources:
-    try:
-      GenerateDistanceTransformJob(
-        source,
-        app.params.destination,
-        app.params.source_dir,
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_distance_transform"), recording_failures(app.params.failures), scratch_staging(app.params.scratch) as staging:
+    app.params.sources, app.params.source_dir, app.params.destination = staged_sources(
+      staging,
+      manifest_sources(app.params.sources, app.params.manifest),
+      app.params.source_dir,
+      app.params.destination
+    )
+    ensure_destination_directories(app.params.sources, app.params.source_dir, app.params.destination)
+    if app.params.io_threads > 0:
+      with AsyncWriter(threads=app.params.io_threads) as async_writer:
+        generate_distance_transforms(app.params, async_writer)
+    else:
+      generate_distance_transforms(app.params)
 
 generate_distance_transform_cli.add_param("sources", nargs="*")
 generate_distance_transform_cli.add_param("--destination", required=True)
 generate_distance_transform_cli.add_param("--source_dir", required=True)
+generate_distance_transform_cli.add_param("--io_threads", type=int, default=IO_THREADS)
+generate_distance_transform_cli.add_param("--manifest")
+generate_distance_transform_cli.add_param("--failures")
+generate_distance_transform_cli.add_param("--scratch", default=default_scratch())
 
 if __name__ == "__main__":
    generate_distance_transform_cli.run()
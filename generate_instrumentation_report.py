@@ -0,0 +1,177 @@
+import json
+import traceback
+
+import cli.log
+
+from models.paths import *
+
+MAX_REPORTED_ITEMS_COUNT = 10
+
+
+class StageReport:
+  def __init__(self, stage):
+    self.stage = stage
+    self.records = []
+
+  def add_record(self, record):
+    self.records.append(record)
+
+  @property
+  def shards_count(self):
+    return len(self.records)
+
+  @property
+  def wall_seconds(self):
+    return sum(record["wall_seconds"] for record in self.records)
+
+  @property
+  def max_wall_seconds(self):
+    return max(record["wall_seconds"] for record in self.records)
+
+  @property
+  def items_count(self):
+    return self.sections.get("item", {}).get("count", 0)
+
+  @property
+  def bytes_read(self):
+    return sum(record["bytes_read"] for record in self.records)
+
+  @property
+  def bytes_written(self):
+    return sum(record["bytes_written"] for record in self.records)
+
+  @property
+  def max_peak_rss_bytes(self):
+    return max((record["peak_rss_bytes"] or 0) for record in self.records)
+
+  @property
+  def max_traced_peak_bytes(self):
+    return max((record["traced_peak_bytes"] or 0) for record in self.records)
+
+  @property
+  def heaviest_items(self):
+    # older records have no per item memory
+    return sorted(
+      (heaviest_item for record in self.records for heaviest_item in record.get("heaviest_items", [])),
+      key=lambda heaviest_item: -heaviest_item["rss_bytes"]
+    )[:MAX_REPORTED_ITEMS_COUNT]
+
+  @property
+  def memory_events(self):
+    memory_events = {}
+    for record in self.records:
+      for event, count in record.get("memory_events", {}).items():
+        memory_events[event] = memory_events.get(event, 0) + count
+    return memory_events
+
+  @property
+  def sections(self):
+    if not hasattr(self, "_sections"):
+      self._sections = {}
+      for record in self.records:
+        for section, section_timing in record["sections"].items():
+          if not section in self._sections:
+            self._sections[section] = { "count": 0, "seconds": 0.0, "max_seconds": 0.0 }
+          self._sections[section]["count"] += section_timing["count"]
+          self._sections[section]["seconds"] += section_timing["seconds"]
+          self._sections[section]["max_seconds"] = max(self._sections[section]["max_seconds"], section_timing["max_seconds"])
+    return self._sections
+
+  def to_json_params(self):
+    return {
+      "stage": self.stage,
+      "shards_count": self.shards_count,
+      "items_count": self.items_count,
+      "wall_seconds": self.wall_seconds,
+      "max_wall_seconds": self.max_wall_seconds,
+      "sections": self.sections,
+      "bytes_read": self.bytes_read,
+      "bytes_written": self.bytes_written,
+      "max_peak_rss_bytes": self.max_peak_rss_bytes,
+      "max_traced_peak_bytes": self.max_traced_peak_bytes,
+      "heaviest_items": self.heaviest_items,
+      "memory_events": self.memory_events
+    }
+
+  def lines(self):
+    yield "%s: %i shards, %i items, %.1fs total, %.1fs slowest shard" % (
+      self.stage,
+      self.shards_count,
+      self.items_count,
+      self.wall_seconds,
+      self.max_wall_seconds
+    )
+    yield "  read %.1f MB, wrote %.1f MB, peak rss %.1f MB" % (
+      self.bytes_read / 1e6,
+      self.bytes_written / 1e6,
+      self.max_peak_rss_bytes / 1e6
+    )
+    for event, count in sorted(self.memory_events.items()):
+      yield "  %s: %i" % (event.replace("_", " "), count)
+    for heaviest_item in self.heaviest_items[:3]:
+      yield "  peak rss %.1f MB during %s" % (heaviest_item["rss_bytes"] / 1e6, heaviest_item["item"])
+    for section, section_timing in sorted(self.sections.items(), key=lambda item: -item[1]["seconds"]):
+      if section == "item":
+        continue
+      yield "  %-10s %10.2fs %5.1f%% %8i calls %8.4fs mean %8.4fs max" % (
+        section,
+        section_timing["seconds"],
+        100 * section_timing["seconds"] / self.wall_seconds if self.wall_seconds > 0 else 0,
+        section_timing["count"],
+        section_timing["seconds"] / section_timing["count"],
+        section_timing["max_seconds"]
+      )
+
+class GenerateInstrumentationReportJob:
+  def __init__(self, source, destination=None):
+    self.source = source
+    self.destination = destination
+
+  def run(self):
+    for stage_report in self.stage_reports:
+      for line in stage_report.lines():
+        print(line)
+    if self.destination != None:
+      with open(self.destination, "w") as destination_file:
+        json.dump([stage_report.to_json_params() for stage_report in self.stage_reports], destination_file, indent=2)
+
+  @property
+  def source_path(self):
+    if not hasattr(self, "_source_path"):
+      self._source_path = source_path(self.source)
+      if not self._source_path.is_dir():
+        raise Exception("instrumentation directory does not exist")
+    return self._source_path
+
+  @property
+  def records(self):
+    for record_path in sorted(self.source_path.glob("*.json")):
+      with open(record_path) as record_file:
+        yield json.load(record_file)
+
+  @property
+  def stage_reports(self):
+    if not hasattr(self, "_stage_reports"):
+      stage_reports_by_stage = {}
+      for record in self.records:
+        if not record["stage"] in stage_reports_by_stage:
+          stage_reports_by_stage[record["stage"]] = StageReport(record["stage"])
+        stage_reports_by_stage[record["stage"]].add_record(record)
+      self._stage_reports = sorted(stage_reports_by_stage.values(), key=lambda stage_report: -stage_report.wall_seconds)
+    return self._stage_reports
+
+@cli.log.LoggingApp
+def generate_instrumentation_report_cli(app):
+  try:
+    GenerateInstrumentationReportJob(
+      app.params.source,
+      destination=app.params.destination
+    ).run()
+  except Exception as exception:
+    traceback.print_exc()
+
+generate_instrumentation_report_cli.add_param("source")
+generate_instrumentation_report_cli.add_param("--destination")
+
+if __name__ == "__main__":
+  generate_instrumentation_report_cli.run()
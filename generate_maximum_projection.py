@@ -1,28 +1,42 @@
 import shlex
 import logging
-import re
-import traceback
 from pathlib import Path
 
 import cli.log
 import numpy
-import skimage.exposure
-import skimage.io
 
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
+from models.instrumentation import instrumented_shard, numpy_save_path, record_write, timed
+from models.memory_governor import governed_item
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.scratch_staging import default_scratch, scratch_staging, staged_sources
+from models.shard_manifest import manifest_sources, source_arguments
+from models.z_projection import ZProjectionAccumulator
 from models.z_sliced_image import ZSlicedImage
 
+LOGGER = logging.getLogger()
+
 
 class GenerateMaximumProjectionJob:
-  def __init__(self, source_directory, filename_pattern, destination):
+  def __init__(self, source_directory, filename_pattern, destination, tile_size=None):
     self.source_directory = source_directory
     self.filename_pattern = filename_pattern
     self.destination = destination
+    self.tile_size = tile_size
     self.logger = logging.getLogger()
 
   def run(self):
-    skimage.io.imsave(str(self.destination_path / self.maximum_projection_destination_filename), self.maximum_projection)
-    numpy.save(str(self.destination_path / self.z_center_destination_filename), self.z_center)
+    import skimage.io
+    if self.tile_size != None and self.source_z_sliced_images_memmapped:
+      self.write_tiled_projection()
+      return
+    self.maximum_projection
+    with timed("save"):
+      skimage.io.imsave(str(self.destination_path / self.maximum_projection_destination_filename), self.maximum_projection)
+      numpy.save(str(self.destination_path / self.z_center_destination_filename), self.z_center)
+    record_write(self.destination_path / self.maximum_projection_destination_filename)
+    record_write(numpy_save_path(self.destination_path / self.z_center_destination_filename))
 
   @property
   def destination_path(self):
@@ -59,25 +73,67 @@ class GenerateMaximumProjectionJob:
     if hasattr(self, "_z_center") or hasattr(self, "_maximum_projection"):
       raise Exception("already computed")
 
-    shaped = False
-    maximum_projection = None
-    summed_z_values = None
-    weighted_summed_z_values = None
-    for source_z_sliced_image in self.source_z_sliced_images:
-      if not shaped:
-        shaped = True
-        maximum_projection = numpy.zeros_like(source_z_sliced_image.image)
-        summed_z_values = numpy.int32(numpy.zeros_like(source_z_sliced_image.image))
-        weighted_summed_z_values = numpy.int32(numpy.zeros_like(source_z_sliced_image.image))
-
-      maximum_projection = numpy.fmax(maximum_projection, source_z_sliced_image.image)
-      summed_z_values = summed_z_values + source_z_sliced_image.image
-      weighted_summed_z_values = weighted_summed_z_values + (source_z_sliced_image.image * source_z_sliced_image.z)
-    self._maximum_projection = maximum_projection
-
-    zero_adjusted_summed_z_values = summed_z_values + ((summed_z_values == 0) * numpy.ones_like(summed_z_values))
-    zero_adjusted_weighted_summed_z_values = weighted_summed_z_values + ((weighted_summed_z_values == 0) * numpy.ones_like(weighted_summed_z_values))
-    self._z_center = (zero_adjusted_weighted_summed_z_values / zero_adjusted_summed_z_values).astype(numpy.float16)
+    source_z_sliced_images = list(self.source_z_sliced_images)
+    # z comes from the filename, so the stack depth is known before any slice is loaded
+    z_projection_accumulator = ZProjectionAccumulator([source_z_sliced_image.z for source_z_sliced_image in source_z_sliced_images])
+    for source_z_sliced_image in source_z_sliced_images:
+      with timed("load"):
+        source_z_sliced_image.image
+      with timed("compute"):
+        z_projection_accumulator.add(source_z_sliced_image.image, source_z_sliced_image.z)
+    self._maximum_projection = z_projection_accumulator.maximum_projection
+
+    with timed("compute"):
+      self._z_center = z_projection_accumulator.z_center
+
+  def write_tiled_projection(self):
+    import tifffile
+    source_z_sliced_images = self.source_z_sliced_images_memmapped
+    shape, dtype = source_z_sliced_images[0].mapped_shape_and_dtype
+    z_values = [source_z_sliced_image.z for source_z_sliced_image in source_z_sliced_images]
+    maximum_projection_path = self.destination_path / self.maximum_projection_destination_filename
+    z_center_path = numpy_save_path(self.destination_path / self.z_center_destination_filename)
+    with timed("save"):
+      tifffile.memmap(str(maximum_projection_path), shape=shape, dtype=dtype).flush()
+      numpy.lib.format.open_memmap(z_center_path, mode="w+", dtype=numpy.float16, shape=shape).flush()
+    # peak memory is set by the tile: one region of each slice and the accumulators for it
+    for row_start in range(0, shape[0], self.tile_size):
+      for column_start in range(0, shape[1], self.tile_size):
+        tile = (slice(row_start, row_start + self.tile_size), slice(column_start, column_start + self.tile_size))
+        z_projection_accumulator = ZProjectionAccumulator(z_values)
+        for source_z_sliced_image in source_z_sliced_images:
+          with timed("load"):
+            tile_image = source_z_sliced_image.read_region(tile)
+          with timed("compute"):
+            z_projection_accumulator.add(tile_image, source_z_sliced_image.z)
+        with timed("compute"):
+          tile_z_center = z_projection_accumulator.z_center
+        with timed("save"):
+          maximum_projection = tifffile.memmap(str(maximum_projection_path), mode="r+")
+          maximum_projection[tile] = z_projection_accumulator.maximum_projection
+          maximum_projection.flush()
+          del maximum_projection
+          z_center = numpy.load(z_center_path, mmap_mode="r+")
+          z_center[tile] = tile_z_center
+          z_center.flush()
+          del z_center
+    record_write(maximum_projection_path)
+    record_write(z_center_path)
+
+  @property
+  def source_z_sliced_images_memmapped(self):
+    if not hasattr(self, "_source_z_sliced_images_memmapped"):
+      source_z_sliced_images = list(self.source_z_sliced_images)
+      try:
+        with timed("load"):
+          shapes_and_dtypes = set(source_z_sliced_image.mapped_shape_and_dtype for source_z_sliced_image in source_z_sliced_images)
+        if len(shapes_and_dtypes) != 1:
+          raise Exception("slices differ in shape or type")
+        self._source_z_sliced_images_memmapped = source_z_sliced_images
+      except Exception as exception:
+        LOGGER.warning("cannot project %s tile by tile, projecting whole slices: %s", self.filename_pattern, exception)
+        self._source_z_sliced_images_memmapped = None
+    return self._source_z_sliced_images_memmapped
 
   @property
   def source_z_sliced_images(self):
@@ -108,32 +164,47 @@ class GenerateMaximumProjectionJob:
   def z_center_destination_filename(self):
     return "%s%s" % (self.destination_filename_prefix, "_z_center")
 
-def generate_maximum_projection_cli_str(source_directory, filename_patterns, destination):
+def generate_maximum_projection_cli_str(source_directory, filename_patterns, destination, tile_size=None, failures=None):
+  tile_size_arguments = ["--tile_size=%i" % tile_size] if tile_size != None else []
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_maximum_projection"),
     "--destination=%s" % destination,
     "--source_directory=%s" % source_directory,
-    *(str(filename_pattern) for filename_pattern in filename_patterns)
+    *tile_size_arguments,
+    *failures_arguments(failures),
+    *source_arguments(filename_patterns)
   ])
 
 @cli.log.LoggingApp
 def generate_maximum_projection_cli(app):
-  for filename_pattern in app.params.filename_patterns:
-    try:
-      GenerateMaximumProjectionJob(
-        app.params.source_directory,
-        filename_pattern,
-        app.params.destination
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_maximum_projection"), recording_failures(app.params.failures), scratch_staging(app.params.scratch) as staging:
+    filename_patterns = list(manifest_sources(app.params.filename_patterns, app.params.manifest))
+    _sources, source_directory, destination = staged_sources(
+      staging,
+      (
+        source_file_path
+        for filename_pattern in filename_patterns
+        for source_file_path in Path(app.params.source_directory).rglob(filename_pattern)
+      ),
+      app.params.source_directory,
+      app.params.destination
+    )
+    for filename_pattern in filename_patterns:
+      with timed("item"), recorded_failure(filename_pattern), governed_item(filename_pattern):
+        GenerateMaximumProjectionJob(
+          source_directory,
+          filename_pattern,
+          destination,
+          tile_size=app.params.tile_size
+        ).run()
 
 generate_maximum_projection_cli.add_param("--source_directory", required=True)
 generate_maximum_projection_cli.add_param("--destination", required=True)
+generate_maximum_projection_cli.add_param("--tile_size", type=int)
 generate_maximum_projection_cli.add_param("filename_patterns", nargs="*")
+generate_maximum_projection_cli.add_param("--manifest")
+generate_maximum_projection_cli.add_param("--failures")
+generate_maximum_projection_cli.add_param("--scratch", default=default_scratch())
 
 if __name__ == "__main__":
    generate_maximum_projection_cli.run()
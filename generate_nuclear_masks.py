@@ -1,39 +1,61 @@
+import os
 import shlex
-import traceback
 
 import cli.log
 import numpy
-import skimage.measure
 
+from models.async_io import IO_THREADS, AsyncWriter, prefetch
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
+from models.instrumentation import instrumented_shard, numpy_save_path, record_read, record_write, timed
+from models.label_encoding import RunLengthLabels
+from models.labels import label_statistics
+from models.memory_governor import governed_item, memory_governor
 from models.nuclear_mask import NuclearMask
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.scratch_staging import default_scratch, scratch_staging, staged_sources
+from models.shard_manifest import manifest_sources, source_arguments
 
 
 class GenerateNuclearMasksJob:
-  def __init__(self, source, destination, source_dir):
+  def __init__(self, source, destination, source_dir, min_area=None, max_area=None):
     self.source = source
     self.destination = destination
     self.source_dir = Path(source_dir)
+    self.min_area = min_area
+    self.max_area = max_area
 
-  def run(self):
-    for index, nuclear_mask in enumerate(self.nuclear_masks):
-      numpy.save(self.indexed_destination_filename(index + 1), nuclear_mask)
+  def run(self, async_writer=None):
+    with timed("load"):
+      self.segmentation
+    with timed("compute"):
+      self.nuclear_masks
+    if async_writer != None:
+      for index, nuclear_mask in enumerate(self.nuclear_masks):
+        async_writer.save(self.indexed_destination_filename(index + 1), nuclear_mask, self.source)
+      return
+    with timed("save"):
+      for index, nuclear_mask in enumerate(self.nuclear_masks):
+        numpy.save(self.indexed_destination_filename(index + 1), nuclear_mask)
+        record_write(numpy_save_path(self.indexed_destination_filename(index + 1)))
 
   def indexed_destination_filename(self, index):
-    source_relative_path = str(self.source_path.relative_to(self.source_dir))
-    return self.destination_path / source_relative_path.replace("_nuclear_segmentation", ("_nuclear_mask_%03i" % index))
+    destination_relative_path = self.source_relative_path.replace("_nuclear_segmentation", ("_nuclear_mask_%03i" % index))
+    if self.source_path.suffix == ".npz":
+      destination_relative_path = destination_relative_path[:-len(".npz")] + ".npy"
+    return self.destination_path / destination_relative_path
+
+  @property
+  def source_relative_path(self):
+    if not hasattr(self, "_source_relative_path"):
+      self._source_relative_path = relative_path(self.source_path, self.source_dir)
+    return self._source_relative_path
 
   @property
   def destination_path(self):
     if not hasattr(self, "_destination_path"):
-      global_destination_path = Path(self.destination)
-      local_destination_path = Path(str(self.source_path.relative_to(self.source_dir))).parents[0]
-      path_to_make = global_destination_path / local_destination_path
-      self._destination_path = global_destination_path 
-      if not path_to_make.exists():
-        Path.mkdir(path_to_make, parents=True)
-      elif not path_to_make.is_dir():
-        raise Exception("destination already exists, but is not a directory")
+      self._destination_path = Path(self.destination)
+      ensure_directory(self._destination_path / os.path.dirname(self.source_relative_path))
     return self._destination_path
 
   @property
@@ -45,49 +67,99 @@ class GenerateNuclearMasksJob:
   @property
   def segmentation(self):
     if not hasattr(self, "_segmentation"):
-      self._segmentation = numpy.load(self.source_path, allow_pickle=True)
+      if self.source_path.suffix == ".npz":
+        self._segmentation = RunLengthLabels.load(self.source_path)
+      else:
+        # memory mapped when memory runs short, so the kernel can drop the pages already read instead of the shard
+        # running out
+        mmap_mode = "r" if memory_governor().under_pressure() else None
+        self._segmentation = numpy.load(self.source_path, allow_pickle=True, mmap_mode=mmap_mode)
+        record_read(self.source_path)
     return self._segmentation
 
   @property
-  def regionprops(self):
-    if not hasattr(self, "_regionprops"):
-      self._regionprops = skimage.measure.regionprops(self.segmentation)
-    return self._regionprops
+  def label_statistics(self):
+    if not hasattr(self, "_label_statistics"):
+      if isinstance(self.segmentation, RunLengthLabels):
+        all_label_statistics = self.segmentation.label_statistics
+      else:
+        all_label_statistics = label_statistics(self.segmentation)
+      # debris and merged clumps are dropped here, before any crop is made for them
+      self._label_statistics = all_label_statistics.filtered(self.min_area, self.max_area)
+    return self._label_statistics
 
   @property
   def nuclear_masks(self):
     if not hasattr(self, "_nuclear_masks"):
-      self._nuclear_masks = [
-        NuclearMask.build(self.segmentation, rp) for rp in self.regionprops
-      ]
+      if isinstance(self.segmentation, RunLengthLabels):
+        # run length encoded segmentations are decoded one nucleus crop at a time
+        self._nuclear_masks = [
+          NuclearMask(self.segmentation.decode_region(bounding_box) == label, bounding_box[:2])
+          for label, bounding_box in zip(self.label_statistics.labels.tolist(), self.label_statistics.bounding_boxes)
+        ]
+      else:
+        self._nuclear_masks = [
+          NuclearMask.from_bounding_box(self.segmentation, label, bounding_box)
+          for label, bounding_box in zip(self.label_statistics.labels.tolist(), self.label_statistics.bounding_boxes)
+        ]
     return self._nuclear_masks
 
-def generate_nuclear_masks_cli_str(sources, destination, source_dir):
+def generate_nuclear_masks_cli_str(sources, destination, source_dir, min_area=None, max_area=None, failures=None):
+  area_arguments = [
+    *(["--min_area=%i" % min_area] if min_area != None else []),
+    *(["--max_area=%i" % max_area] if max_area != None else [])
+  ]
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_nuclear_masks"),
     "--destination=%s" % destination,
     "--source_dir=%s" % source_dir,
-    *[str(source) for source in sources]
+    *area_arguments,
+    *failures_arguments(failures),
+    *source_arguments(sources)
   ])
 
+def generate_nuclear_masks(params, async_writer=None):
+  jobs = (
+    GenerateNuclearMasksJob(
+      source,
+      params.destination,
+      params.source_dir,
+      min_area=params.min_area,
+      max_area=params.max_area
+    )
+    for source in params.sources
+  )
+  if async_writer != None:
+    jobs = prefetch(jobs, lambda job: job.segmentation, threads=params.io_threads)
+  for job in jobs:
+    with timed("item"), recorded_failure(job.source), governed_item(job.source):
+      job.run(async_writer)
+
 @cli.log.LoggingApp
 def generate_nuclear_masks_cli(app):
-  for source in app.params.sources:
-    try:
-      GenerateNuclearMasksJob(
-        source,
-        app.params.destination,
-        app.params.source_dir,
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_nuclear_masks"), recording_failures(app.params.failures), scratch_staging(app.params.scratch) as staging:
+    app.params.sources, app.params.source_dir, app.params.destination = staged_sources(
+      staging,
+      manifest_sources(app.params.sources, app.params.manifest),
+      app.params.source_dir,
+      app.params.destination
+    )
+    ensure_destination_directories(app.params.sources, app.params.source_dir, app.params.destination)
+    if app.params.io_threads > 0:
+      with AsyncWriter(threads=app.params.io_threads) as async_writer:
+        generate_nuclear_masks(app.params, async_writer)
+    else:
+      generate_nuclear_masks(app.params)
 
 generate_nuclear_masks_cli.add_param("sources", nargs="*")
 generate_nuclear_masks_cli.add_param("--destination", required=True)
 generate_nuclear_masks_cli.add_param("--source_dir", required=True)
+generate_nuclear_masks_cli.add_param("--io_threads", type=int, default=IO_THREADS)
+generate_nuclear_masks_cli.add_param("--min_area", type=int)
+generate_nuclear_masks_cli.add_param("--max_area", type=int)
+generate_nuclear_masks_cli.add_param("--manifest")
+generate_nuclear_masks_cli.add_param("--failures")
+generate_nuclear_masks_cli.add_param("--scratch", default=default_scratch())
 
 if __name__ == "__main__":
    generate_nuclear_masks_cli.run()
@@ -1,32 +1,54 @@
 import shlex
 import logging
-import re
-import traceback
 from copy import copy
+from functools import lru_cache
 from pathlib import Path
 
 import cli.log
-import matplotlib.pyplot as plt
 import numpy
-import scipy
-import skimage.io
-import skimage.segmentation
-from cellpose import models, plot, transforms
 
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
 from models.image_filename import ImageFilename
+from models.instrumentation import instrumented_shard, numpy_save_path, record_read, record_write, timed
+from models.label_encoding import LABEL_ENCODINGS, save_labels
+from models.memory_governor import governed_item, memory_governor, releasable_cache
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.scratch_staging import default_scratch, scratch_staging, staged_sources
+from models.shard_manifest import manifest_sources, source_arguments
 
+# tiles cellpose runs through the network at once, its own default; the governor halves it when memory runs short
+CELLPOSE_BATCH_SIZE = 8
+
+@releasable_cache
+@lru_cache(maxsize=1)
+def load_cellpose_model(model_type="nuclei"):
+  from cellpose import models
+  return models.Cellpose(model_type=model_type)
 
 class GenerateNuclearSegmentationJob:
-  def __init__(self, source, destination, source_dir, diameter):
+  def __init__(self, source, destination, source_dir, diameter, encoding="npy", batch_size=CELLPOSE_BATCH_SIZE, image=None):
     self.source_dir = Path(source_dir)
     self.source = source
     self.destination = destination
     self.diameter = diameter
+    self.encoding = encoding
+    self.batch_size = batch_size
+    # an image the caller already loaded from source, which is then not read again
+    if image is not None:
+      self._image = image
     self.logger = logging.getLogger()
 
   def run(self):
-    numpy.save(self.destination_filename, self.cellpose_filtered)
+    with timed("load"):
+      self.image
+    with timed("segment"):
+      self.cellpose_result
+    with timed("compute"):
+      self.cellpose_filtered
+    with timed("save"):
+      save_labels(self.destination_filename, self.cellpose_filtered, self.encoding)
+    record_write(self.destination_filename if self.encoding == "rle" else numpy_save_path(self.destination_filename))
 
   @property
   def destination_path(self):
@@ -56,7 +78,7 @@ class GenerateNuclearSegmentationJob:
       self._destination_image_filename.z = None
       self._destination_image_filename.c = None
       self._destination_image_filename.suffix = "_nuclear_segmentation"
-      self._destination_image_filename.extension = "npy"
+      self._destination_image_filename.extension = "npz" if self.encoding == "rle" else "npy"
     return self._destination_image_filename
 
   @property
@@ -76,54 +98,72 @@ class GenerateNuclearSegmentationJob:
   @property
   def image(self):
     if not hasattr(self, "_image"):
+      import skimage.io
       self._image = skimage.io.imread(self.source_path, as_gray=True)
+      record_read(self.source_path)
     return self._image
 
   @property
   def cellpose_result(self):
     if not hasattr(self, "_cellpose_result"):
-      model = models.Cellpose(model_type = "nuclei")
-      self._cellpose_result = model.eval(self.image, diameter=self.diameter, channels=[[0,0]], resample=True)
+      model = load_cellpose_model()
+      self._cellpose_result = model.eval(
+        self.image,
+        diameter=self.diameter,
+        channels=[[0,0]],
+        resample=True,
+        batch_size=memory_governor().batch_size_for(self.batch_size, "cellpose")
+      )
     return self._cellpose_result
 
   @property
   def cellpose_filtered(self):
     if not hasattr(self, "_cellpose_filtered"):
+      import skimage.segmentation
       dilated = skimage.segmentation.expand_labels(self.cellpose_result[0], distance=3)
       self._cellpose_filtered = skimage.segmentation.clear_border(dilated)
     return self._cellpose_filtered
 
 
-def generate_nuclear_segmentation_cli_str(sources, destination, source_dir, diameter):
+def generate_nuclear_segmentation_cli_str(sources, destination, source_dir, diameter, encoding="npy", failures=None):
   diameter_arguments = ["--diameter=%i" % diameter] if diameter != None else []
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_nuclear_segmentation"),
     "--destination=%s" % destination,
     "--source_dir=%s" % source_dir,
     *diameter_arguments,
-    *[str(source) for source in sources]
+    "--encoding=%s" % encoding,
+    *failures_arguments(failures),
+    *source_arguments(sources)
   ])
 
 @cli.log.LoggingApp
 def generate_nuclear_segmentation_cli(app):
-  for source in app.params.sources:
-    try:
-      GenerateNuclearSegmentationJob(
-        source,
-        app.params.destination,
-        app.params.source_dir,
-        app.params.diameter
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_nuclear_segmentation"), recording_failures(app.params.failures), scratch_staging(app.params.scratch) as staging:
+    sources, source_dir, destination = staged_sources(
+      staging,
+      manifest_sources(app.params.sources, app.params.manifest),
+      app.params.source_dir,
+      app.params.destination
+    )
+    for source in sources:
+      with timed("item"), recorded_failure(source), governed_item(source):
+        GenerateNuclearSegmentationJob(
+          source,
+          destination,
+          source_dir,
+          app.params.diameter,
+          encoding=app.params.encoding
+        ).run()
 
 generate_nuclear_segmentation_cli.add_param("sources", nargs="*")
 generate_nuclear_segmentation_cli.add_param("--destination", required=True)
 generate_nuclear_segmentation_cli.add_param("--source_dir", required=True)
 generate_nuclear_segmentation_cli.add_param("--diameter", type=int, default=100)
+generate_nuclear_segmentation_cli.add_param("--encoding", choices=LABEL_ENCODINGS, default="npy")
+generate_nuclear_segmentation_cli.add_param("--manifest")
+generate_nuclear_segmentation_cli.add_param("--failures")
+generate_nuclear_segmentation_cli.add_param("--scratch", default=default_scratch())
 
 if __name__ == "__main__":
    generate_nuclear_segmentation_cli.run()
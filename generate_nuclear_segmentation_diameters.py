@@ -0,0 +1,131 @@
+import json
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from time import perf_counter
+
+import cli.log
+import numpy
+
+from generate_nuclear_segmentation import GenerateNuclearSegmentationJob, load_cellpose_model
+from models.instrumentation import instrumented_shard, timed
+
+LOGGER = logging.getLogger()
+
+@lru_cache(maxsize=1)
+def load_sweep_image(source, source_dir):
+  return GenerateNuclearSegmentationJob(source, None, source_dir, None).image
+
+def preload_sweep(source, source_dir):
+  # each worker reads the image and loads the model once, then segments it at every diameter it is handed
+  load_sweep_image(source, source_dir)
+  load_cellpose_model()
+
+def segment_with_diameter(source, source_dir, diameter):
+  job = GenerateNuclearSegmentationJob(source, None, source_dir, diameter, image=load_sweep_image(source, source_dir))
+  start_time = perf_counter()
+  labels = job.cellpose_filtered
+  seconds = perf_counter() - start_time
+  areas = numpy.bincount(numpy.ravel(labels))[1:]
+  areas = areas[areas > 0]
+  equivalent_diameters = 2 * numpy.sqrt(areas / numpy.pi)
+  return {
+    "diameter": diameter,
+    "nuclei_count": len(areas),
+    "area_percentiles": {
+      str(percentile): float(numpy.percentile(areas, percentile)) if len(areas) > 0 else None
+      for percentile in [10, 50, 90]
+    },
+    "median_equivalent_diameter": float(numpy.median(equivalent_diameters)) if len(areas) > 0 else None,
+    "seconds": seconds
+  }
+
+class GenerateNuclearSegmentationDiametersJob:
+  def __init__(self, source, diameters, source_dir=None, destination=None, processes=1):
+    self.source = source
+    self.diameters = diameters
+    self.source_dir = source_dir if source_dir != None else str(Path(source).parent)
+    self.destination = destination
+    self.processes = processes
+
+  def run(self):
+    with instrumented_shard("generate_nuclear_segmentation_diameters"):
+      with timed("sweep"):
+        self.results
+      print("%8s %7s %10s %10s %10s %10s %9s" % ("diameter", "nuclei", "area p10", "area p50", "area p90", "median d", "seconds"))
+      for result in self.results:
+        print("%8s %7i %10s %10s %10s %10s %9.2f" % (
+          result["diameter"],
+          result["nuclei_count"],
+          *("%.0f" % value if value != None else "-" for value in result["area_percentiles"].values()),
+          "%.1f" % result["median_equivalent_diameter"] if result["median_equivalent_diameter"] != None else "-",
+          result["seconds"]
+        ))
+      if self.suggested_diameter != None:
+        print("suggested --diameter=%s" % self.suggested_diameter)
+      if self.destination != None:
+        with open(self.destination, "w") as destination_file:
+          json.dump({ "results": self.results, "suggested_diameter": self.suggested_diameter }, destination_file, indent=2)
+
+  @property
+  def results(self):
+    if not hasattr(self, "_results"):
+      self._results = []
+      if self.processes > 1:
+        with ProcessPoolExecutor(
+          max_workers=min(self.processes, len(self.diameters)),
+          initializer=preload_sweep,
+          initargs=(self.source, self.source_dir)
+        ) as executor:
+          futures = [
+            executor.submit(segment_with_diameter, self.source, self.source_dir, diameter)
+            for diameter in self.diameters
+          ]
+          for future in futures:
+            try:
+              self._results.append(future.result())
+            except Exception as exception:
+              traceback.print_exc()
+      else:
+        preload_sweep(self.source, self.source_dir)
+        for diameter in self.diameters:
+          try:
+            self._results.append(segment_with_diameter(self.source, self.source_dir, diameter))
+          except Exception as exception:
+            traceback.print_exc()
+    return self._results
+
+  @property
+  def suggested_diameter(self):
+    # cellpose segments best when the diameter it is given matches the nuclei it finds
+    matched_results = [result for result in self.results if result["median_equivalent_diameter"] != None]
+    if len(matched_results) == 0:
+      return None
+    return min(
+      matched_results,
+      key=lambda result: abs(result["median_equivalent_diameter"] - result["diameter"]) / result["diameter"]
+    )["diameter"]
+
+@cli.log.LoggingApp
+def generate_nuclear_segmentation_diameters_cli(app):
+  try:
+    GenerateNuclearSegmentationDiametersJob(
+      app.params.source,
+      [int(diameter) for diameter in app.params.diameters.split(",")],
+      source_dir=app.params.source_dir,
+      destination=app.params.destination,
+      processes=app.params.processes
+    ).run()
+  except Exception as exception:
+    traceback.print_exc()
+
+generate_nuclear_segmentation_diameters_cli.add_param("source")
+generate_nuclear_segmentation_diameters_cli.add_param("--diameters", default="60,80,100,120,140")
+generate_nuclear_segmentation_diameters_cli.add_param("--source_dir")
+generate_nuclear_segmentation_diameters_cli.add_param("--destination")
+generate_nuclear_segmentation_diameters_cli.add_param("--processes", type=int, default=1)
+
+if __name__ == "__main__":
+  generate_nuclear_segmentation_diameters_cli.run()
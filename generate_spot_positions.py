@@ -1,23 +1,27 @@
 import json
 import logging
+import os
 import shlex
-import traceback
 from copy import copy
+from itertools import groupby, islice
 from pathlib import Path
 from functools import lru_cache
 
 import cli.log
 import numpy
-import scipy.ndimage
-import skimage.feature
-import skimage.measure
-import skimage.filters
-import skimage.io
-import skimage.segmentation
 
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
 from models.generate_spot_positions_config import GenerateSpotPositionsConfig
 from models.image_filename import ImageFilename
+from models.instrumentation import instrumented_shard, numpy_save_path, record_read, record_write, timed
+from models.memory_governor import governed_item, memory_governor
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.scratch_staging import default_scratch, scratch_staging, staged_sources
+from models.shard_manifest import manifest_sources, source_arguments
+from models.spot_detection import crop_backgrounds, detect_spots_batch, filter_image, laplacian_of_gaussian, local_maxima, sorted_spots
+
+BATCH_SIZE = 1
 
 
 @lru_cache(maxsize=1)
@@ -56,21 +60,23 @@ class GenerateSpotPositionsJob:
     self.logger = logging.getLogger()
 
   def run(self):
-      for spot_index, spot in enumerate(self.spots):
-        numpy.save(self.destination_filename_for_spot_index(spot_index), spot)
+      with timed("load"):
+        self.image
+      with timed("detect"):
+        self.global_filtered_spots
+      with timed("measure"):
+        self.spots
+      with timed("save"):
+        for spot_index, spot in enumerate(self.spots):
+          numpy.save(self.destination_filename_for_spot_index(spot_index), spot)
+          record_write(numpy_save_path(self.destination_filename_for_spot_index(spot_index)))
 
   @property
   def destination_path(self):
-   if not hasattr(self, "_destination_path"):
-      global_destination_path = Path(self.destination)
-      local_destination_path = Path(str(self.source_path.relative_to(self.source_dir))).parents[0]
-      path_to_make = global_destination_path / local_destination_path
-      self._destination_path = global_destination_path 
-      if not path_to_make.exists():
-        Path.mkdir(path_to_make, parents=True)
-      elif not path_to_make.is_dir():
-        raise Exception("destination already exists, but is not a directory")
-   return self._destination_path
+    if not hasattr(self, "_destination_path"):
+      self._destination_path = Path(self.destination)
+      ensure_directory(self._destination_path / os.path.dirname(self.source_relative_path))
+    return self._destination_path
 
   def destination_filename_for_spot_index(self, spot_index):
     destination_image_filename = copy(self.source_image_filename)
@@ -87,9 +93,15 @@ class GenerateSpotPositionsJob:
   @property
   def source_image_filename(self):
     if not hasattr(self, "_source_image_filename"):
-      self._source_image_filename = ImageFilename.parse(str(self.source_path.relative_to(self.source_dir)))
+      self._source_image_filename = ImageFilename.parse(self.source_relative_path)
     return self._source_image_filename
 
+  @property
+  def source_relative_path(self):
+    if not hasattr(self, "_source_relative_path"):
+      self._source_relative_path = relative_path(self.source_path, self.source_dir)
+    return self._source_relative_path
+
   @property
   def threshold(self):
     if not hasattr(self, "_threshold"):
@@ -100,31 +112,41 @@ class GenerateSpotPositionsJob:
   def image(self):
     if not hasattr(self, "_image"):
       self._image = numpy.load(self.source_path, allow_pickle=True)
+      record_read(self.source_path)
     return self._image
 
   @property
   def filtered_image(self):
     if not hasattr(self, "_filtered_image"):
-        self._filtered_image = skimage.filters.gaussian(self.image, sigma=self.peak_radius)
+        self._filtered_image = filter_image(self.image, self.peak_radius)
     return self._filtered_image
 
+  @property
+  def spot_response(self):
+    if not hasattr(self, "_spot_response"):
+      self._spot_response = laplacian_of_gaussian(self.filtered_image)
+    return self._spot_response
+
   @property
   def raw_spots(self):
     if not hasattr(self, "_raw_spots"):
-      self._raw_spots = skimage.feature.blob_log(self.filtered_image, min_sigma=0.3, max_sigma=0.3, threshold=self.threshold)
+      self._raw_spots = local_maxima(self.spot_response) & (self.spot_response > self.threshold)
     return self._raw_spots
 
   @property
   def global_filtered_spots(self):
     if not hasattr(self, "_global_filtered_spots"):
-      self._global_filtered_spots = [
-        (int(x), int(y))
-        for x, y, _sigma
-        in self.raw_spots 
-        if self.image[int(x), int(y)] > self.global_contrast_threshold
-      ]
+      self._global_filtered_spots = sorted_spots(
+        self.spot_response,
+        self.raw_spots & (self.image > self.global_contrast_threshold)
+      )
     return self._global_filtered_spots
 
+  def use_detection(self, image_background, global_filtered_spots):
+    # what a batched detection over several crops found for this one, in place of detecting its spots on its own
+    self._image_background = image_background
+    self._global_filtered_spots = global_filtered_spots
+
   @property
   def spots(self):
     if not hasattr(self, "_spots"):
@@ -136,6 +158,10 @@ class GenerateSpotPositionsJob:
     return self._spots
 
   def find_spot_props(self, integer_spot):
+    import scipy.ndimage
+    import skimage.measure
+    import skimage.segmentation
+
     local_box_x_min = max(0, integer_spot[0]-10)
     local_box_y_min = max(0, integer_spot[1]-10)
     local_box_x_max = min(integer_spot[0]+10, numpy.shape(self.image)[0])
@@ -197,36 +223,89 @@ class GenerateSpotPositionsJob:
       if self.source_image_filename.c in configs:
         return configs[self.source_image_filename.c]
 
-def generate_spot_positions_cli_str(sources, destination, source_dir, config=None):
+def detect_spots_in_batch(jobs):
+  detectable_jobs = []
+  for job in jobs:
+    try:
+      with timed("load"):
+        job.image
+      job.peak_radius, job.local_contrast_threshold, job.global_contrast_threshold
+      detectable_jobs.append(job)
+    except Exception as exception:
+      # left for the job to raise and report when it runs on its own
+      continue
+  if len(detectable_jobs) == 0:
+    return
+  with timed("detect"):
+    image_backgrounds = dict(zip(detectable_jobs, crop_backgrounds([job.image for job in detectable_jobs])))
+    # crops of similar height share a canvas with the least padding
+    detectable_jobs.sort(key=lambda job: (job.peak_radius, job.image.shape[0]))
+    for peak_radius, peak_radius_jobs in groupby(detectable_jobs, key=lambda job: job.peak_radius):
+      peak_radius_jobs = list(peak_radius_jobs)
+      try:
+        spots_lists = detect_spots_batch(
+          [job.image for job in peak_radius_jobs],
+          peak_radius,
+          [image_backgrounds[job] * job.local_contrast_threshold for job in peak_radius_jobs],
+          [job.global_contrast_threshold for job in peak_radius_jobs]
+        )
+      except Exception as exception:
+        logging.getLogger().warning("batched spot detection failed, detecting spots crop by crop: %s", exception)
+        continue
+      for job, spots in zip(peak_radius_jobs, spots_lists):
+        job.use_detection(image_backgrounds[job], spots)
+
+def generate_spot_positions_cli_str(sources, destination, source_dir, config=None, failures=None):
   config_arguments = ["--config=%s" % config] if config != None else []
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_spot_positions"),
     "--destination=%s" % destination,
     "--source_dir=%s" % source_dir,
     *config_arguments,
-    *[str(source) for source in sources]
+    *failures_arguments(failures),
+    *source_arguments(sources)
   ])
 
 @cli.log.LoggingApp
 def generate_spot_positions_cli(app):
-  for source in app.params.sources:
-    try:
-      GenerateSpotPositionsJob(
-        source,
-        app.params.destination,
-        app.params.source_dir,
-        config=app.params.config
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_spot_positions"), recording_failures(app.params.failures), scratch_staging(app.params.scratch) as staging:
+    sources, source_dir, destination = staged_sources(
+      staging,
+      manifest_sources(app.params.sources, app.params.manifest),
+      app.params.source_dir,
+      app.params.destination
+    )
+    ensure_destination_directories(sources, source_dir, destination)
+    batch_size = max(app.params.batch_size, 1)
+    sources_iterator = iter(sources)
+    while True:
+      # batches shrink while the shard is near its memory limit and grow back once it is not
+      batch_sources = list(islice(sources_iterator, memory_governor().batch_size_for(batch_size, "spot_positions")))
+      if len(batch_sources) == 0:
+        break
+      jobs = [
+        GenerateSpotPositionsJob(
+          source,
+          destination,
+          source_dir,
+          config=app.params.config
+        )
+        for source in batch_sources
+      ]
+      if batch_size > 1:
+        detect_spots_in_batch(jobs)
+      for job in jobs:
+        with timed("item"), recorded_failure(job.source), governed_item(job.source):
+          job.run()
 
 generate_spot_positions_cli.add_param("sources", nargs="*")
 generate_spot_positions_cli.add_param("--destination", required=True)
 generate_spot_positions_cli.add_param("--source_dir", required=True)
 generate_spot_positions_cli.add_param("--config")
+generate_spot_positions_cli.add_param("--batch_size", type=int, default=BATCH_SIZE)
+generate_spot_positions_cli.add_param("--manifest")
+generate_spot_positions_cli.add_param("--failures")
+generate_spot_positions_cli.add_param("--scratch", default=default_scratch())
 
 if __name__ == "__main__":
    generate_spot_positions_cli.run()
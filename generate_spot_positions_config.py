@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import random
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+import cli.log
+import numpy
+
+from generate_spot_positions import GenerateSpotPositionsJob
+from models.generate_spot_positions_config import GenerateSpotPositionsConfig
+from models.image_filename import ImageFilename
+from models.image_filename_glob import ImageFilenameGlob
+from models.instrumentation import instrumented_shard, timed
+from models.paths import *
+from models.spot_detection import local_maxima, sorted_spots
+
+LOGGER = logging.getLogger()
+SAMPLES_PER_CHANNEL = 10
+
+def parse_values(values, value_type=float):
+  return [value_type(value) for value in values.split(",")]
+
+def sweep_crop(source, source_dir, peak_radius, local_contrast_thresholds, global_contrast_thresholds):
+  # the filtered image, the LoG response and its maxima depend only on the radius, so every threshold pair reuses them
+  job = GenerateSpotPositionsJob(source, None, source_dir, user_determined_radius=peak_radius)
+  maxima = local_maxima(job.spot_response)
+  spot_props = {}
+  results = []
+  for local_contrast_threshold, global_contrast_threshold in product(local_contrast_thresholds, global_contrast_thresholds):
+    spots = sorted_spots(
+      job.spot_response,
+      maxima & (job.spot_response > job.image_background * local_contrast_threshold) & (job.image > global_contrast_threshold)
+    )
+    for spot in spots:
+      if not spot in spot_props:
+        spot_props[spot] = job.find_spot_props(spot)
+    results.append({
+      "local_contrast_threshold": local_contrast_threshold,
+      "global_contrast_threshold": global_contrast_threshold,
+      "spots_count": len(spots),
+      "areas": [float(spot_props[spot][1]) for spot in spots],
+      "eccentricities": [float(spot_props[spot][2]) for spot in spots],
+      "solidities": [float(spot_props[spot][3]) for spot in spots]
+    })
+  return results
+
+class SpotPositionsSetting:
+  def __init__(self, channel, peak_radius, local_contrast_threshold, global_contrast_threshold):
+    self.channel = channel
+    self.peak_radius = peak_radius
+    self.local_contrast_threshold = local_contrast_threshold
+    self.global_contrast_threshold = global_contrast_threshold
+    self.spots_counts = []
+    self.areas = []
+    self.eccentricities = []
+    self.solidities = []
+
+  def add_crop_result(self, crop_result):
+    self.spots_counts.append(crop_result["spots_count"])
+    self.areas += crop_result["areas"]
+    self.eccentricities += crop_result["eccentricities"]
+    self.solidities += crop_result["solidities"]
+
+  @property
+  def spots_per_crop(self):
+    return numpy.mean(self.spots_counts) if len(self.spots_counts) > 0 else 0
+
+  def statistic(self, values, function):
+    return function(values) if len(values) > 0 else float("nan")
+
+  @property
+  def config(self):
+    return GenerateSpotPositionsConfig(
+      channel=self.channel,
+      local_contrast_threshold=self.local_contrast_threshold,
+      peak_radius=self.peak_radius,
+      global_contrast_threshold=self.global_contrast_threshold
+    )
+
+  def to_json_params(self):
+    return {
+      **self.config.to_json_params(),
+      "crops_count": len(self.spots_counts),
+      "spots_count": int(sum(self.spots_counts)),
+      "spots_per_crop": float(self.spots_per_crop),
+      "median_area": float(self.statistic(self.areas, numpy.median)),
+      "mean_eccentricity": float(self.statistic(self.eccentricities, numpy.mean)),
+      "mean_solidity": float(self.statistic(self.solidities, numpy.mean))
+    }
+
+  def line(self):
+    return "%7s %6s %6s %6s %6i %7i %9.2f %8.1f %8.2f %8.2f" % (
+      self.channel,
+      self.peak_radius,
+      self.local_contrast_threshold,
+      self.global_contrast_threshold,
+      len(self.spots_counts),
+      sum(self.spots_counts),
+      self.spots_per_crop,
+      self.statistic(self.areas, numpy.median),
+      self.statistic(self.eccentricities, numpy.mean),
+      self.statistic(self.solidities, numpy.mean)
+    )
+
+class GenerateSpotPositionsConfigJob:
+  def __init__(
+    self,
+    source,
+    destination=None,
+    channels=None,
+    samples_count=SAMPLES_PER_CHANNEL,
+    peak_radii=[1, 2, 3],
+    local_contrast_thresholds=[1.5, 2, 2.75, 3.5, 4],
+    global_contrast_thresholds=[0, 0.2, 0.4, 0.6],
+    target_spots_per_nucleus=None,
+    processes=None,
+    seed=0
+  ):
+    self.source = source
+    self.destination = destination
+    self.channels = channels
+    self.samples_count = samples_count
+    self.peak_radii = peak_radii
+    self.local_contrast_thresholds = local_contrast_thresholds
+    self.global_contrast_thresholds = global_contrast_thresholds
+    self.target_spots_per_nucleus = target_spots_per_nucleus
+    self.processes = processes
+    self.seed = seed
+
+  def run(self):
+    with instrumented_shard("generate_spot_positions_config"):
+      with timed("sweep"):
+        self.settings
+      print("%7s %6s %6s %6s %6s %7s %9s %8s %8s %8s" % (
+        "channel", "radius", "local", "global", "crops", "spots", "per crop", "area", "eccent", "solidity"
+      ))
+      for setting in self.settings:
+        print(setting.line())
+      if self.target_spots_per_nucleus == None:
+        LOGGER.warning("no --target_spots_per_nucleus given, so no setting was chosen")
+        return
+      for chosen_setting in self.chosen_settings:
+        print("channel %s: %s" % (chosen_setting.channel, json.dumps(chosen_setting.to_json_params())))
+      if self.destination != None:
+        self.write_configs()
+
+  @property
+  def source_path(self):
+    if not hasattr(self, "_source_path"):
+      self._source_path = source_path(self.source)
+    return self._source_path
+
+  @property
+  def crop_paths_by_channel(self):
+    if not hasattr(self, "_crop_paths_by_channel"):
+      self._crop_paths_by_channel = {}
+      crop_paths = self.source_path.rglob(str(ImageFilenameGlob(suffix="_maximum_projection_nuclear_mask_???", extension="npy")))
+      for crop_path in sorted(crop_paths):
+        channel = ImageFilename.parse(str(crop_path.relative_to(self.source_path))).c
+        if self.channels == None or channel in self.channels:
+          self._crop_paths_by_channel.setdefault(channel, []).append(crop_path)
+    return self._crop_paths_by_channel
+
+  @property
+  def sampled_crop_paths_by_channel(self):
+    if not hasattr(self, "_sampled_crop_paths_by_channel"):
+      sampler = random.Random(self.seed)
+      self._sampled_crop_paths_by_channel = {
+        channel: sampler.sample(crop_paths, min(self.samples_count, len(crop_paths)))
+        for channel, crop_paths in sorted(self.crop_paths_by_channel.items())
+      }
+    return self._sampled_crop_paths_by_channel
+
+  @property
+  def settings(self):
+    if not hasattr(self, "_settings"):
+      settings_by_key = {}
+      for channel in self.sampled_crop_paths_by_channel:
+        for peak_radius, local_contrast_threshold, global_contrast_threshold in product(
+          self.peak_radii,
+          self.local_contrast_thresholds,
+          self.global_contrast_thresholds
+        ):
+          key = (channel, peak_radius, local_contrast_threshold, global_contrast_threshold)
+          settings_by_key[key] = SpotPositionsSetting(*key)
+      with ProcessPoolExecutor(max_workers=self.processes or os.cpu_count()) as executor:
+        futures = [
+          (channel, peak_radius, executor.submit(
+            sweep_crop,
+            str(crop_path),
+            str(self.source_path),
+            peak_radius,
+            self.local_contrast_thresholds,
+            self.global_contrast_thresholds
+          ))
+          for channel, crop_paths in self.sampled_crop_paths_by_channel.items()
+          for crop_path in crop_paths
+          for peak_radius in self.peak_radii
+        ]
+        for channel, peak_radius, future in futures:
+          try:
+            for crop_result in future.result():
+              key = (channel, peak_radius, crop_result["local_contrast_threshold"], crop_result["global_contrast_threshold"])
+              settings_by_key[key].add_crop_result(crop_result)
+          except Exception as exception:
+            traceback.print_exc()
+      self._settings = list(settings_by_key.values())
+    return self._settings
+
+  @property
+  def chosen_settings(self):
+    if not hasattr(self, "_chosen_settings"):
+      self._chosen_settings = [
+        min(
+          (setting for setting in self.settings if setting.channel == channel),
+          key=lambda setting: abs(setting.spots_per_crop - self.target_spots_per_nucleus)
+        )
+        for channel in self.sampled_crop_paths_by_channel
+      ]
+    return self._chosen_settings
+
+  def write_configs(self):
+    destination_path = Path(self.destination)
+    existing_configs = []
+    if destination_path.exists():
+      with open(destination_path) as json_file:
+        existing_configs = [GenerateSpotPositionsConfig.from_json_params(json_params) for json_params in json.load(json_file)]
+    chosen_configs = [chosen_setting.config for chosen_setting in self.chosen_settings]
+    chosen_channels = set(config.channel for config in chosen_configs)
+    configs = [
+      *chosen_configs,
+      *(config for config in existing_configs if not config.channel in chosen_channels)
+    ]
+    with open(destination_path, "w") as json_file:
+      json.dump([config.to_json_params() for config in configs], json_file)
+
+@cli.log.LoggingApp
+def generate_spot_positions_config_cli(app):
+  try:
+    GenerateSpotPositionsConfigJob(
+      app.params.source,
+      destination=app.params.destination,
+      channels=parse_values(app.params.channels, int) if app.params.channels != None else None,
+      samples_count=app.params.samples_count,
+      peak_radii=parse_values(app.params.peak_radii),
+      local_contrast_thresholds=parse_values(app.params.local_contrast_thresholds),
+      global_contrast_thresholds=parse_values(app.params.global_contrast_thresholds),
+      target_spots_per_nucleus=app.params.target_spots_per_nucleus,
+      processes=app.params.processes,
+      seed=app.params.seed
+    ).run()
+  except Exception as exception:
+    traceback.print_exc()
+
+generate_spot_positions_config_cli.add_param("source")
+generate_spot_positions_config_cli.add_param("--destination")
+generate_spot_positions_config_cli.add_param("--channels")
+generate_spot_positions_config_cli.add_param("--samples_count", type=int, default=SAMPLES_PER_CHANNEL)
+generate_spot_positions_config_cli.add_param("--peak_radii", default="1,2,3")
+generate_spot_positions_config_cli.add_param("--local_contrast_thresholds", default="1.5,2,2.75,3.5,4")
+generate_spot_positions_config_cli.add_param("--global_contrast_thresholds", default="0,0.2,0.4,0.6")
+generate_spot_positions_config_cli.add_param("--target_spots_per_nucleus", type=float)
+generate_spot_positions_config_cli.add_param("--processes", type=int)
+generate_spot_positions_config_cli.add_param("--seed", type=int, default=0)
+
+if __name__ == "__main__":
+  generate_spot_positions_config_cli.run()
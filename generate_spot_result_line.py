@@ -1,16 +1,23 @@
 import shlex
 import csv
 import logging
+import os
 import re
-import traceback
 from copy import copy
 from pathlib import Path
 
 import cli.log
 import numpy
 
+from models.async_io import IO_THREADS, prefetch
+from models.failure_manifest import failures_arguments, recorded_failure, recording_failures
 from models.image_filename import ImageFilename
+from models.instrumentation import instrumented_shard, record_read, record_write, timed
+from models.memory_governor import governed_item
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.result_shard_writer import ResultShardWriter
+from models.shard_manifest import manifest_sources, source_arguments
 
 SPOT_RESULT_FILE_SUFFIX_RE = re.compile("_nucleus_(?P<nucleus_index>\d{3})_spot_(?P<spot_index>\d+)")
 
@@ -31,11 +38,23 @@ class GenerateSpotResultLineJob:
     self.nuclear_masks_source_directory = nuclear_masks_source_directory
     self.destination = destination
   
-  def run(self):
-    with open(self.destination_filename, 'w') as csv_file:
-      csv_writer = csv.DictWriter(csv_file, self.csv_values.keys())
-      csv_writer.writeheader()
-      csv_writer.writerow(self.csv_values)
+  def run(self, result_shard_writer=None):
+    with timed("load"):
+      self.load()
+    with timed("compute"):
+      csv_values = self.csv_values
+    with timed("save"):
+      if result_shard_writer != None:
+        result_shard_writer.writerow(csv_values)
+        return
+      with open(self.destination_filename, 'w') as csv_file:
+        csv_writer = csv.DictWriter(csv_file, csv_values.keys())
+        csv_writer.writeheader()
+        csv_writer.writerow(csv_values)
+    record_write(self.destination_filename)
+
+  def load(self):
+    return [self.spot, self.z_center_image, self.distance_transform_image, self.nuclear_mask]
 
   @property
   def csv_values(self):
@@ -61,19 +80,19 @@ class GenerateSpotResultLineJob:
   @property
   def destination_path(self):
     if not hasattr(self, "_destination_path"):
-      global_destination_path = Path(self.destination)
-      local_destination_path = Path(str(self.source_path.relative_to(self.spot_source_directory))).parents[0]
-      path_to_make = global_destination_path / local_destination_path
-      self._destination_path = global_destination_path 
-      if not path_to_make.exists():
-        Path.mkdir(path_to_make, parents=True)
-      elif not path_to_make.is_dir():
-        raise Exception("destination already exists, but is not a directory")
+      self._destination_path = Path(self.destination)
+      ensure_directory(self._destination_path / os.path.dirname(self.source_relative_path))
     return self._destination_path
 
   @property
   def destination_filename(self):
-    return self.destination_path / ("%s.csv" % self.source_path.relative_to(self.spot_source_directory))
+    return self.destination_path / ("%s.csv" % self.source_relative_path)
+
+  @property
+  def source_relative_path(self):
+    if not hasattr(self, "_source_relative_path"):
+      self._source_relative_path = relative_path(self.source_path, self.spot_source_directory)
+    return self._source_relative_path
 
   @property
   def source_path(self):
@@ -84,7 +103,7 @@ class GenerateSpotResultLineJob:
   @property
   def source_image_filename(self):
     if not hasattr(self, "_source_image_filename"):
-      self._source_image_filename = ImageFilename.parse(str(self.source_path.relative_to(self.spot_source_directory)))
+      self._source_image_filename = ImageFilename.parse(self.source_relative_path)
     return self._source_image_filename
   
   @property
@@ -105,6 +124,7 @@ class GenerateSpotResultLineJob:
   def spot(self):
     if not hasattr(self, "_spot"):
       self._spot = numpy.load(self.source_path, allow_pickle=True)
+      record_read(self.source_path)
     return self._spot
 
   @property
@@ -160,6 +180,7 @@ class GenerateSpotResultLineJob:
   def z_center_image(self):
     if not hasattr(self, "_z_center_image"):
       self._z_center_image = numpy.load(self.z_center_image_path)
+      record_read(self.z_center_image_path)
     return self._z_center_image
   
   @property
@@ -190,6 +211,7 @@ class GenerateSpotResultLineJob:
   def distance_transform_image(self):
     if not hasattr(self, "_distance_transform_image"):
       self._distance_transform_image = numpy.load(self.distance_transform_image_path)
+      record_read(self.distance_transform_image_path)
     return self._distance_transform_image
   
   @property
@@ -208,6 +230,7 @@ class GenerateSpotResultLineJob:
   def nuclear_mask(self):
     if not hasattr(self, "_nuclear_mask"):
       self._nuclear_mask = numpy.load(self.nuclear_mask_path, allow_pickle=True).item()
+      record_read(self.nuclear_mask_path)
     return self._nuclear_mask
   
   @property
@@ -240,35 +263,51 @@ def generate_spot_result_line_cli_str(
   distance_transforms_source_directory,
   nuclear_masks_source_directory,
   spot_source_directory,
-  destination
+  destination,
+  shard_output=None,
+  failures=None
 ):
+  shard_output_arguments = ["--shard_output=%s" % shard_output] if shard_output != None else []
   return shlex.join([
-    "pipenv",
-    "run",
-    "python",
-    __file__,
+    *pipeline_command("generate_spot_result_line"),
     "--z_centers_source_directory=%s" % z_centers_source_directory,
     "--distance_transforms_source_directory=%s" % distance_transforms_source_directory,
     "--nuclear_masks_source_directory=%s" % nuclear_masks_source_directory,
     "--spot_source_directory=%s" % spot_source_directory,
     "--destination=%s" % destination,
-    *[str(spot_source) for spot_source in spot_sources]
+    *shard_output_arguments,
+    *failures_arguments(failures),
+    *source_arguments(spot_sources)
   ])
 
+def generate_spot_result_lines(params, result_shard_writer=None):
+  jobs = (
+    GenerateSpotResultLineJob(
+      spot_source,
+      params.spot_source_directory,
+      params.z_centers_source_directory,
+      params.distance_transforms_source_directory,
+      params.nuclear_masks_source_directory,
+      params.destination,
+    )
+    for spot_source in params.spot_sources
+  )
+  if params.io_threads > 0:
+    jobs = prefetch(jobs, GenerateSpotResultLineJob.load, threads=params.io_threads)
+  for job in jobs:
+    with timed("item"), recorded_failure(job.spot_source), governed_item(job.spot_source):
+      job.run(result_shard_writer)
+
 @cli.log.LoggingApp
 def generate_spot_result_line_cli(app):
-  for spot_source in app.params.spot_sources:
-    try:
-      GenerateSpotResultLineJob(
-        spot_source,
-        app.params.z_centers_source_directory,
-        app.params.distance_transforms_source_directory,
-        app.params.nuclear_masks_source_directory,
-        app.params.spot_source_directory,
-        app.params.destination,
-      ).run()
-    except Exception as exception:
-      traceback.print_exc()
+  with instrumented_shard("generate_spot_result_line"), recording_failures(app.params.failures):
+    app.params.spot_sources = manifest_sources(app.params.spot_sources, app.params.manifest)
+    if app.params.shard_output != None:
+      with ResultShardWriter(Path(app.params.destination) / app.params.shard_output) as result_shard_writer:
+        generate_spot_result_lines(app.params, result_shard_writer)
+    else:
+      ensure_destination_directories(app.params.spot_sources, app.params.spot_source_directory, app.params.destination)
+      generate_spot_result_lines(app.params)
 
 generate_spot_result_line_cli.add_param("spot_sources", nargs="*")
 generate_spot_result_line_cli.add_param("--z_centers_source_directory", required=True)
@@ -276,6 +315,10 @@ generate_spot_result_line_cli.add_param("--distance_transforms_source_directory"
 generate_spot_result_line_cli.add_param("--nuclear_masks_source_directory", required=True)
 generate_spot_result_line_cli.add_param("--spot_source_directory", required=True)
 generate_spot_result_line_cli.add_param("--destination", required=True)
+generate_spot_result_line_cli.add_param("--shard_output")
+generate_spot_result_line_cli.add_param("--io_threads", type=int, default=IO_THREADS)
+generate_spot_result_line_cli.add_param("--manifest")
+generate_spot_result_line_cli.add_param("--failures")
 
 if __name__ == "__main__":
    generate_spot_result_line_cli.run()
@@ -1,26 +1,151 @@
+import csv
+import io
+import shlex
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import cli.log
 
 from models.image_filename import ImageFilename
 from models.image_filename_glob import ImageFilenameGlob
+from models.instrumentation import instrumented_shard, record_read, record_write, timed
 from models.paths import *
+from models.pipeline_command import pipeline_command
+from models.result_shard_writer import RESULT_SHARD_GLOB
 
 
+READERS_COUNT = 8
+READ_CHUNK_SIZE = 64
+READ_WINDOW_SIZE = 4096
+WRITE_BUFFER_BYTES = 8 * 1024 * 1024
+COLUMNAR_FORMATS = ["parquet", "feather", "npy"]
+# what generate_spot_result_line writes in each column; any other column is kept as text
+RESULT_COLUMN_DTYPES = {
+  "filename": str,
+  "experiment": str,
+  "well": str,
+  "field": int,
+  "channel": int,
+  "nucleus_index": int,
+  "spot_index": int,
+  "center_x": float,
+  "center_y": float,
+  "center_z": float,
+  "center_r": float,
+  "area": float,
+  "eccentricity": float,
+  "solidity": float,
+  "nuclear_mask_offset_x": int,
+  "nuclear_mask_offset_y": int
+}
+
+def read_result_lines(result_line_paths):
+  result_lines = []
+  for result_line_path in result_line_paths:
+    with open(result_line_path) as result_line_file:
+      # a shard whose spots all failed is left empty, without even a header
+      if next(result_line_file, None) == None:
+        continue
+      result_lines += [line for line in result_line_file if not line.isspace()]
+  return "".join(result_lines)
+
+class ColumnarResults:
+  # the columns are converted a chunk of result lines at a time, as the chunks are written to the csv, rather than
+  # parsing the merged csv again once it is written
+  def __init__(self, headers):
+    self.names = next(csv.reader([headers]))
+    self.chunks = []
+
+  def add(self, result_lines):
+    rows = list(csv.reader(io.StringIO(result_lines)))
+    if len(rows) == 0:
+      return
+    self.chunks.append([
+      numpy_column(values, RESULT_COLUMN_DTYPES.get(name, str))
+      for name, values in zip(self.names, zip(*rows))
+    ])
+
+  def save(self, path):
+    import numpy
+    if len(self.chunks) > 0:
+      columns = [numpy.concatenate(chunk_columns) for chunk_columns in zip(*self.chunks)]
+    else:
+      columns = [numpy_column([], RESULT_COLUMN_DTYPES.get(name, str)) for name in self.names]
+    results = numpy.empty(len(columns[0]), dtype=[(name, column.dtype) for name, column in zip(self.names, columns)])
+    for name, column in zip(self.names, columns):
+      results[name] = column
+    numpy.save(path, results)
+
+def numpy_column(values, dtype):
+  import numpy
+  return numpy.array(values, dtype=str).astype(dtype)
+
+def load_pyarrow_csv(csv_path):
+  try:
+    import pyarrow.csv
+  except ImportError:
+    raise Exception("pyarrow is required for parquet and feather output")
+  return pyarrow.csv.read_csv(csv_path)
+
 class GenerateSpotResultsFileJob:
-  def __init__(self, source, destination):
+  def __init__(self, source, destination, readers_count=READERS_COUNT, ordered=True, columnar_format=None, sharded=False):
     self.source = source
     self.destination = destination
+    self.sharded = sharded
+    self.readers_count = readers_count
+    self.ordered = ordered
+    self.columnar_format = columnar_format
 
   def run(self):
-    with open(self.destination_filename, 'w') as destination_file:
-      destination_file.write(self.headers)
-      for result_line_path in self.result_line_paths:
-        with open(result_line_path) as result_line_file:
-          next(result_line_file)
-          for line in result_line_file:
-            if not line.isspace():
-              destination_file.write(line)
+    with instrumented_shard("generate_spot_results_file"):
+      with timed("list"):
+        self.result_line_paths
+      columnar_results = ColumnarResults(self.headers) if self.columnar_format == "npy" else None
+      with timed("compile"):
+        with open(self.destination_filename, 'w', buffering=WRITE_BUFFER_BYTES) as destination_file:
+          destination_file.write(self.headers)
+          for result_line_paths, result_lines in self.read_result_lines():
+            destination_file.write(result_lines)
+            if columnar_results != None:
+              columnar_results.add(result_lines)
+            for result_line_path in result_line_paths:
+              record_read(result_line_path)
+      record_write(self.destination_filename)
+      if self.columnar_format != None:
+        with timed("columnar"):
+          self.write_columnar(columnar_results)
+        record_write(self.columnar_destination_filename)
+
+  def read_result_lines(self):
+    # files are read in chunks to amortize the thread pool overhead, with a bounded window in flight to keep memory flat
+    chunks = [
+      self.result_line_paths[chunk_start:chunk_start + READ_CHUNK_SIZE]
+      for chunk_start in range(0, len(self.result_line_paths), READ_CHUNK_SIZE)
+    ]
+    window_chunks_count = READ_WINDOW_SIZE // READ_CHUNK_SIZE
+    with ThreadPoolExecutor(max_workers=self.readers_count) as executor:
+      for window_start in range(0, len(chunks), window_chunks_count):
+        window_chunks = chunks[window_start:window_start + window_chunks_count]
+        if self.ordered:
+          yield from zip(window_chunks, executor.map(read_result_lines, window_chunks))
+        else:
+          futures = { executor.submit(read_result_lines, chunk): chunk for chunk in window_chunks }
+          for future in as_completed(futures):
+            yield futures[future], future.result()
+
+  def write_columnar(self, columnar_results=None):
+    if self.columnar_format == "npy":
+      columnar_results.save(self.columnar_destination_filename)
+    elif self.columnar_format == "parquet":
+      results = load_pyarrow_csv(self.destination_filename)
+      import pyarrow.parquet
+      pyarrow.parquet.write_table(results, self.columnar_destination_filename)
+    elif self.columnar_format == "feather":
+      results = load_pyarrow_csv(self.destination_filename)
+      import pyarrow.feather
+      pyarrow.feather.write_feather(results, self.columnar_destination_filename)
+    else:
+      raise Exception("unknown columnar format %s" % self.columnar_format)
 
   @property
   def source_path(self):
@@ -32,19 +157,36 @@ class GenerateSpotResultsFileJob:
 
   @property
   def result_line_paths(self):
-    return self.source_path.rglob(str(ImageFilenameGlob(suffix="_nucleus_???_spot_*", extension="csv")))
+    if not hasattr(self, "_result_line_paths"):
+      if self.sharded:
+        self._result_line_paths = sorted(self.source_path.glob(RESULT_SHARD_GLOB))
+      else:
+        self._result_line_paths = list(self.source_path.rglob(str(ImageFilenameGlob(suffix="_nucleus_???_spot_*", extension="csv"))))
+      if len(self._result_line_paths) == 0:
+        raise Exception("no result lines found")
+    return self._result_line_paths
   
   @property
   def arbitrary_result_line_path(self):
     if not hasattr(self, "_arbitrary_result_line_path"):
-      self._arbitrary_result_line_path = next(self.result_line_paths)
+      self._arbitrary_result_line_path = next(
+        (result_line_path for result_line_path in self.result_line_paths if result_line_path.stat().st_size > 0),
+        None
+      )
+      if self._arbitrary_result_line_path == None:
+        raise Exception("all result lines are empty")
     return self._arbitrary_result_line_path
   
   @property
-  def arbitrary_result_line_image_filename(self):
-    if not hasattr(self, "_arbitrary_result_line_image_filename"):
-      self._arbitrary_result_line_image_filename = ImageFilename.parse(str(self.arbitrary_result_line_path.relative_to(self.source_path)))
-    return self._arbitrary_result_line_image_filename
+  def experiment(self):
+    if not hasattr(self, "_experiment"):
+      if self.sharded:
+        # shard files are named after the job, so the experiment comes from the rows themselves
+        with open(self.arbitrary_result_line_path) as result_line_file:
+          self._experiment = next(csv.DictReader(result_line_file))["experiment"]
+      else:
+        self._experiment = ImageFilename.parse(str(self.arbitrary_result_line_path.relative_to(self.source_path))).experiment
+    return self._experiment
 
   @property
   def destination_path(self):
@@ -55,8 +197,12 @@ class GenerateSpotResultsFileJob:
   @property
   def destination_filename(self):
     if not hasattr(self, "_destination_filename"):
-      self._destination_filename = self.destination_path / ("%s_spot_positions.csv" % self.arbitrary_result_line_image_filename.experiment)
+      self._destination_filename = self.destination_path / ("%s_spot_positions.csv" % self.experiment)
     return self._destination_filename
+
+  @property
+  def columnar_destination_filename(self):
+    return self.destination_filename.with_suffix(".%s" % self.columnar_format)
   
   @property
   def headers(self):
@@ -65,6 +211,14 @@ class GenerateSpotResultsFileJob:
         self._headers = next(artibrary_result_line_file)
     return self._headers
 
+def generate_spot_results_file_cli_str(source, destination, sharded=False):
+  sharded_arguments = ["--sharded"] if sharded else []
+  return shlex.join([
+    *pipeline_command("generate_spot_results_file"),
+    *sharded_arguments,
+    str(source),
+    str(destination)
+  ])
 
 @cli.log.LoggingApp
 def generate_spot_results_file_cli(app):
@@ -72,12 +226,20 @@ def generate_spot_results_file_cli(app):
     GenerateSpotResultsFileJob(
       app.params.source,
       app.params.destination,
+      readers_count=app.params.readers_count,
+      ordered=not app.params.unordered,
+      columnar_format=app.params.columnar_format,
+      sharded=app.params.sharded
     ).run()
   except Exception as exception:
     traceback.print_exc()
 
 generate_spot_results_file_cli.add_param("source")
 generate_spot_results_file_cli.add_param("destination")
+generate_spot_results_file_cli.add_param("--readers_count", type=int, default=READERS_COUNT)
+generate_spot_results_file_cli.add_param("--unordered", action="store_true")
+generate_spot_results_file_cli.add_param("--columnar_format", choices=COLUMNAR_FORMATS)
+generate_spot_results_file_cli.add_param("--sharded", action="store_true")
 
 if __name__ == "__main__":
    generate_spot_results_file_cli.run()
@@ -0,0 +1,105 @@
+import logging
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import perf_counter
+
+import numpy
+
+from models.failure_manifest import record_failure
+from models.instrumentation import numpy_save_path, record_write, timed
+from models.memory_governor import memory_governor
+
+LOGGER = logging.getLogger()
+
+IO_THREADS = 4
+MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+MAX_PREFETCHED_ITEMS = 16
+
+def value_nbytes(value):
+  if isinstance(value, (list, tuple)):
+    return sum(value_nbytes(element) for element in value)
+  if hasattr(value, "mask"):
+    return value_nbytes(value.mask)
+  return getattr(value, "nbytes", 0)
+
+def timed_load(load, item):
+  with timed("prefetch"):
+    return load(item)
+
+def prefetch(items, load, max_in_flight_bytes=MAX_IN_FLIGHT_BYTES, max_prefetched_items=MAX_PREFETCHED_ITEMS, threads=IO_THREADS):
+  # load runs on a reader thread while the caller computes earlier items; each item is yielded once its load
+  # has finished, and a failed load is left for the caller to repeat so the error surfaces in its own loop
+  items = iter(items)
+  pending = deque()
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    def prefetched_bytes():
+      return sum(
+        value_nbytes(future.result())
+        for _item, future in pending
+        if future.done() and future.exception() == None
+      )
+
+    def fill():
+      while len(pending) == 0 or (
+        len(pending) < max_prefetched_items and
+        prefetched_bytes() < memory_governor().in_flight_bytes(max_in_flight_bytes)
+      ):
+        item = next(items, StopIteration)
+        if item is StopIteration:
+          return
+        pending.append((item, executor.submit(timed_load, load, item)))
+
+    fill()
+    while len(pending) > 0:
+      item, future = pending.popleft()
+      wait([future])
+      fill()
+      yield item
+
+class AsyncWriter:
+  def __init__(self, max_in_flight_bytes=MAX_IN_FLIGHT_BYTES, threads=IO_THREADS):
+    self.max_in_flight_bytes = max_in_flight_bytes
+    self.threads = threads
+    self.in_flight_bytes = 0
+    self.condition = threading.Condition()
+    self.failed_items = set()
+
+  def __enter__(self):
+    self.executor = ThreadPoolExecutor(max_workers=self.threads)
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.executor.shutdown(wait=True)
+
+  def save(self, path, value, item=None):
+    # blocks while the queued arrays already hold max_in_flight_bytes, so a fast producer cannot outrun the disk
+    bytes_count = value_nbytes(value)
+    max_in_flight_bytes = memory_governor().in_flight_bytes(self.max_in_flight_bytes)
+    with self.condition:
+      while self.in_flight_bytes > 0 and self.in_flight_bytes + bytes_count > max_in_flight_bytes:
+        self.condition.wait()
+      self.in_flight_bytes += bytes_count
+    self.executor.submit(self.write, path, value, bytes_count, item)
+
+  def write(self, path, value, bytes_count, item):
+    start_time = perf_counter()
+    try:
+      with timed("save"):
+        numpy.save(path, value)
+      record_write(numpy_save_path(path))
+    except Exception as exception:
+      LOGGER.error("could not write %s", path)
+      traceback.print_exc()
+      # the item's own loop has moved on by now, so its failure is recorded from here, once however many of its
+      # writes fail
+      with self.condition:
+        first_failure = item != None and not item in self.failed_items
+        self.failed_items.add(item)
+      if first_failure:
+        record_failure(item, exception, perf_counter() - start_time)
+    finally:
+      with self.condition:
+        self.in_flight_bytes -= bytes_count
+        self.condition.notify_all()
@@ -0,0 +1,104 @@
+import importlib
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from models.dataflow import STAGE_DEPENDENCIES, STAGES, FieldCommands
+from models.paths import ensure_directory
+from models.swarm_job import SwarmJob, shard_job_params
+
+LOGGER = logging.getLogger()
+
+FIELDS_PER_COMMAND_COUNT = 8
+RESULTS_FILE_MEMORY = 2
+RESULTS_FILE_THREADS = 1
+
+class ChainedSubmission:
+  # every stage's swarm is queued up front, each held by the scheduler until the stages it reads from succeed,
+  # so the driver exits as soon as everything is submitted instead of polling each stage to completion
+  def __init__(self, pipeline_run, stages=STAGES, results_file=True, fields_per_command=FIELDS_PER_COMMAND_COUNT):
+    self.pipeline_run = pipeline_run
+    self.stages = stages
+    self.results_file = results_file
+    self.fields_per_command = fields_per_command
+
+  def submit(self):
+    ensure_directory(self.logdir)
+    with self.pipeline_run_path.open("w") as pipeline_run_file:
+      json.dump(self.pipeline_run.to_json_params(), pipeline_run_file, indent=2)
+    job_ids = {}
+    for stage in self.stages:
+      dependency_job_ids = [job_ids[dependency] for dependency in STAGE_DEPENDENCIES[stage] if dependency in job_ids]
+      job_ids[stage] = self.swarm_job(
+        stage,
+        self.stage_commands(stage),
+        self.stage_memory(stage),
+        self.stage_threads(stage)
+      ).submit(dependency_job_ids)
+      LOGGER.warning("submitted %s as job %s", stage, job_ids[stage])
+    if self.results_file and "spot_result_lines" in job_ids:
+      job_ids["results_file"] = self.swarm_job(
+        "results_file",
+        [self.field_commands.results_file_command()],
+        RESULTS_FILE_MEMORY,
+        RESULTS_FILE_THREADS
+      ).submit([job_ids["spot_result_lines"]])
+      LOGGER.warning("submitted results_file as job %s", job_ids["results_file"])
+    with (self.logdir / ("%s_jobs.json" % self.name)).open("w") as job_ids_file:
+      json.dump(job_ids, job_ids_file, indent=2)
+    return job_ids
+
+  def stage_commands(self, stage):
+    from run_pipeline_fields import run_pipeline_fields_cli_str
+    return [
+      run_pipeline_fields_cli_str(self.pipeline_run_path, stage, fields_shard)
+      for fields_shard in shard_job_params(self.field_names, self.fields_per_command)
+    ]
+
+  def stage_memory(self, stage):
+    return importlib.import_module("generate_all_%s" % stage).MEMORY
+
+  def stage_threads(self, stage):
+    return importlib.import_module("generate_all_%s" % stage).THREADS
+
+  def swarm_job(self, stage, commands, memory, threads):
+    return SwarmJob(
+      self.pipeline_run.images,
+      self.logdir,
+      "%s_%s" % (self.name, stage),
+      commands,
+      self.logdir,
+      memory,
+      len(commands),
+      threads=threads
+    )
+
+  @property
+  def field_commands(self):
+    if not hasattr(self, "_field_commands"):
+      self._field_commands = FieldCommands(self.pipeline_run)
+    return self._field_commands
+
+  @property
+  def field_names(self):
+    # fields come from the images alone, which is all that exists before the first stage runs
+    if not hasattr(self, "_field_names"):
+      self._field_names = sorted(str(field) for field in self.field_commands.fields)
+      if len(self._field_names) == 0:
+        raise Exception("no fields found in %s" % self.pipeline_run.images)
+    return self._field_names
+
+  @property
+  def name(self):
+    if not hasattr(self, "_name"):
+      self._name = "run_pipeline_%s" % datetime.now().strftime("%Y%m%d%H%M%S")
+    return self._name
+
+  @property
+  def logdir(self):
+    return Path(self.pipeline_run.directory("logs"))
+
+  @property
+  def pipeline_run_path(self):
+    return self.logdir / ("%s.json" % self.name)
@@ -0,0 +1,363 @@
+import logging
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatchcase, translate
+from itertools import product
+from pathlib import Path
+
+from models.image_filename import ImageFilename
+from models.image_filename_glob import ImageFilenameGlob
+from models.instrumentation import WRITTEN_PATHS_VARIABLE, read_written_paths
+from models.paths import relative_path
+from models.swarm_job import shard_job_params
+from models.thread_budget import thread_environment, threads_per_worker
+
+LOGGER = logging.getLogger()
+
+CONCURRENCY = 4
+ITEMS_PER_COMMAND_COUNT = 2000
+# a field is every file of one site of one well: channels, slices and stage suffixes vary within it
+FIELD_EXCLUDED_KEYS = ["a", "z", "c", "suffix", "extension"]
+
+STAGE_DEPENDENCIES = {
+  "maximum_projections": [],
+  "nuclear_segmentations": ["maximum_projections"],
+  "nuclear_masks": ["nuclear_segmentations"],
+  "distance_transforms": ["nuclear_masks"],
+  "cropped_cell_images": ["maximum_projections", "nuclear_masks"],
+  "spot_positions": ["cropped_cell_images"],
+  "spot_result_lines": ["spot_positions", "distance_transforms"]
+}
+STAGES = list(STAGE_DEPENDENCIES)
+
+STAGE_DIRECTORIES = {
+  "maximum_projections": "mips",
+  "nuclear_segmentations": "segmentations",
+  "nuclear_masks": "masks",
+  "distance_transforms": "distance_transforms",
+  "cropped_cell_images": "crops",
+  "spot_positions": "spots",
+  "spot_result_lines": "result_lines"
+}
+
+def field_key(image_filename):
+  return ImageFilenameGlob.from_image_filename(image_filename, excluding_keys=FIELD_EXCLUDED_KEYS)
+
+class DirectoryIndex:
+  # one walk of a stage directory serves every field; after that, the paths a finished task reports are added, and
+  # the directory is walked again only when a task could not report them
+  def __init__(self, directory, fields=None):
+    self.directory = Path(directory)
+    # a job that only handles some fields skips parsing every other field's files
+    self.name_re = re.compile("|".join(translate(str(field)) for field in fields)) if fields != None else None
+    self.files_by_field = {}
+    self.seen_paths = set()
+    self.stale = True
+
+  def refresh(self):
+    if not self.stale:
+      return
+    self.stale = False
+    for root, _directories, names in os.walk(self.directory):
+      for name in names:
+        self.add_path(os.path.join(root, name))
+
+  def add_paths(self, paths):
+    directory_prefix = os.path.join(str(self.directory), "")
+    for path in paths:
+      if path.startswith(directory_prefix):
+        self.add_path(path)
+
+  def add_path(self, path):
+    if path in self.seen_paths:
+      return
+    self.seen_paths.add(path)
+    # the whole relative path, since LSM filenames keep the well, field, channel and slice in directories
+    path_relative_path = relative_path(path, self.directory)
+    if self.name_re != None and not self.name_re.match(path_relative_path):
+      return
+    try:
+      image_filename = ImageFilename.parse(path_relative_path)
+    except Exception:
+      return
+    if image_filename == None:
+      return
+    self.files_by_field.setdefault(field_key(image_filename), []).append((image_filename, Path(path)))
+
+  @property
+  def fields(self):
+    self.refresh()
+    return list(self.files_by_field)
+
+  def files(self, field, suffix="*", extension="*"):
+    self.refresh()
+    return sorted(
+      (
+        (image_filename, path)
+        for image_filename, path in self.files_by_field.get(field, [])
+        if fnmatchcase(image_filename.suffix, suffix) and fnmatchcase(image_filename.extension, extension)
+      ),
+      key=lambda file: str(file[1])
+    )
+
+  def paths(self, field, suffix="*", extension="*"):
+    return [path for _image_filename, path in self.files(field, suffix, extension)]
+
+class FieldCommands:
+  def __init__(self, pipeline_run, fields=None):
+    self.pipeline_run = pipeline_run
+    self.indices = {
+      name: DirectoryIndex(pipeline_run.directory(name), fields)
+      for name in ["mips", "segmentations", "masks", "crops", "spots"]
+    }
+    self.indices["images"] = DirectoryIndex(pipeline_run.images, fields)
+
+  @property
+  def fields(self):
+    return [field for field in self.indices["images"].fields if len(self.image_filenames(field)) > 0]
+
+  def image_filenames(self, field):
+    return [image_filename for image_filename, _path in self.indices["images"].files(field, suffix="", extension="tif")]
+
+  def stage_completed(self, stage, written_paths=None):
+    directory_name = STAGE_DIRECTORIES[stage]
+    if not directory_name in self.indices:
+      return
+    if written_paths == None:
+      self.indices[directory_name].stale = True
+    else:
+      self.indices[directory_name].add_paths(written_paths)
+
+  def commands(self, stage, fields):
+    # items are listed when the stage is dispatched, once the fields' upstream outputs exist
+    items = [item for field in fields for item in getattr(self, "%s_items" % stage)(field)]
+    return [
+      getattr(self, "%s_command" % stage)(items_shard)
+      for items_shard in shard_job_params(items, ITEMS_PER_COMMAND_COUNT)
+    ]
+
+  def maximum_projections_items(self, field):
+    return sorted(set(
+      str(ImageFilenameGlob.from_image_filename(image_filename, excluding_keys=["z"]))
+      for image_filename in self.image_filenames(field)
+    ))
+
+  def maximum_projections_command(self, filename_patterns):
+    from generate_maximum_projection import generate_maximum_projection_cli_str
+    return generate_maximum_projection_cli_str(
+      self.pipeline_run.images,
+      filename_patterns,
+      self.pipeline_run.directory("mips"),
+      tile_size=self.pipeline_run.tile_size
+    )
+
+  def nuclear_segmentations_items(self, field):
+    return [
+      path
+      for image_filename, path in self.indices["mips"].files(field, suffix="_maximum_projection", extension="tif")
+      if image_filename.c == self.pipeline_run.DAPI_channel
+    ]
+
+  def nuclear_segmentations_command(self, sources):
+    from generate_nuclear_segmentation import generate_nuclear_segmentation_cli_str
+    return generate_nuclear_segmentation_cli_str(
+      sources,
+      self.pipeline_run.directory("segmentations"),
+      self.pipeline_run.directory("mips"),
+      self.pipeline_run.diameter
+    )
+
+  def nuclear_masks_items(self, field):
+    return self.indices["segmentations"].paths(field, suffix="_nuclear_segmentation", extension="np[yz]")
+
+  def nuclear_masks_command(self, sources):
+    from generate_nuclear_masks import generate_nuclear_masks_cli_str
+    return generate_nuclear_masks_cli_str(
+      sources,
+      self.pipeline_run.directory("masks"),
+      self.pipeline_run.directory("segmentations"),
+      self.pipeline_run.min_area,
+      self.pipeline_run.max_area
+    )
+
+  def nuclear_mask_paths(self, field):
+    return self.indices["masks"].paths(field, suffix="_nuclear_mask_???", extension="npy")
+
+  def distance_transforms_items(self, field):
+    return self.nuclear_mask_paths(field)
+
+  def distance_transforms_command(self, sources):
+    from generate_distance_transform import generate_distance_transform_cli_str
+    return generate_distance_transform_cli_str(
+      sources,
+      self.pipeline_run.directory("distance_transforms"),
+      self.pipeline_run.directory("masks")
+    )
+
+  def cropped_cell_images_items(self, field):
+    source_image_paths = [
+      path
+      for image_filename, path in [
+        *self.indices["mips"].files(field, suffix="_maximum_projection", extension="tif"),
+        *self.indices["mips"].files(field, suffix="_z_center", extension="npy")
+      ]
+      if image_filename.c != self.pipeline_run.DAPI_channel
+    ]
+    return list(product(source_image_paths, self.nuclear_mask_paths(field)))
+
+  def cropped_cell_images_command(self, masks):
+    from generate_cropped_cell_image import generate_cropped_cell_image_cli_str
+    return generate_cropped_cell_image_cli_str(
+      masks,
+      self.pipeline_run.directory("crops"),
+      self.pipeline_run.directory("mips"),
+      self.pipeline_run.directory("masks")
+    )
+
+  def spot_positions_items(self, field):
+    return self.indices["crops"].paths(field, suffix="_maximum_projection_nuclear_mask_???", extension="npy")
+
+  def spot_positions_command(self, sources):
+    from generate_spot_positions import generate_spot_positions_cli_str
+    return generate_spot_positions_cli_str(
+      sources,
+      self.pipeline_run.directory("spots"),
+      self.pipeline_run.directory("crops"),
+      config=self.pipeline_run.spot_positions_config
+    )
+
+  def spot_result_lines_items(self, field):
+    return self.indices["spots"].paths(field, suffix="_nucleus_???_spot_*", extension="npy")
+
+  def spot_result_lines_command(self, spot_sources):
+    from generate_spot_result_line import generate_spot_result_line_cli_str
+    return generate_spot_result_line_cli_str(
+      spot_sources,
+      self.pipeline_run.directory("crops"),
+      self.pipeline_run.directory("distance_transforms"),
+      self.pipeline_run.directory("masks"),
+      self.pipeline_run.directory("spots"),
+      self.pipeline_run.directory("result_lines")
+    )
+
+  def results_file_command(self):
+    from generate_spot_results_file import generate_spot_results_file_cli_str
+    return generate_spot_results_file_cli_str(self.pipeline_run.directory("result_lines"), self.pipeline_run.results)
+
+def run_commands(name, commands, environment=None):
+  # returns the paths the commands wrote, as they reported them
+  with tempfile.TemporaryDirectory() as written_paths_directory:
+    written_paths_path = os.path.join(written_paths_directory, "written_paths")
+    environment = { **(environment if environment != None else os.environ), WRITTEN_PATHS_VARIABLE: written_paths_path }
+    for command in commands:
+      LOGGER.warning("%s: %s", name, command)
+      completed_process = subprocess.run(shlex.split(command), env=environment)
+      if completed_process.returncode != 0:
+        raise Exception("%s exited with %i" % (name, completed_process.returncode))
+    return read_written_paths(written_paths_path)
+
+class LocalExecutor:
+  def __init__(self, concurrency=CONCURRENCY):
+    self.concurrency = concurrency
+    self.executor = ThreadPoolExecutor(max_workers=concurrency)
+    # the cores are split evenly between the commands that can run at once
+    self.environment = { **os.environ, **thread_environment(threads_per_worker(concurrency)) }
+
+  def submit(self, name, commands):
+    return self.executor.submit(run_commands, name, commands, self.environment)
+
+  def shutdown(self):
+    self.executor.shutdown(wait=True)
+
+class DataflowScheduler:
+  def __init__(self, pipeline_run, executor=None, concurrency=CONCURRENCY, stages=STAGES, results_file=True):
+    self.pipeline_run = pipeline_run
+    self.executor = executor if executor != None else LocalExecutor(concurrency)
+    self.concurrency = concurrency
+    self.stages = stages
+    self.results_file = results_file
+    self.field_commands = FieldCommands(pipeline_run)
+    self.completed_tasks = set()
+    self.failed_tasks = set()
+    self.skipped_tasks = set()
+    self.running_tasks = {}
+
+  def run(self):
+    fields = self.field_commands.fields
+    LOGGER.warning("scheduling %i stages for %i fields", len(self.stages), len(fields))
+    pending_tasks = [(stage, field) for field in fields for stage in self.stages]
+    try:
+      while len(pending_tasks) > 0 or len(self.running_tasks) > 0:
+        pending_tasks = self.dispatch_ready_tasks(pending_tasks)
+        if len(self.running_tasks) == 0:
+          break
+        finished_futures, _running_futures = wait(self.running_tasks, return_when=FIRST_COMPLETED)
+        for future in finished_futures:
+          self.finish_task(future)
+      for stage, field in pending_tasks:
+        self.skip_task(stage, field)
+      if self.results_file and any(stage == "spot_result_lines" for stage, _field in self.completed_tasks):
+        run_commands("results_file", [self.field_commands.results_file_command()])
+    finally:
+      self.executor.shutdown()
+    return {
+      "fields_count": len(fields),
+      "completed_tasks_count": len(self.completed_tasks),
+      "failed_tasks_count": len(self.failed_tasks),
+      "skipped_tasks_count": len(self.skipped_tasks)
+    }
+
+  def is_ready(self, stage, field):
+    return all(
+      (dependency, field) in self.completed_tasks
+      for dependency in STAGE_DEPENDENCIES[stage]
+      if dependency in self.stages
+    )
+
+  def is_blocked(self, stage, field):
+    return any(
+      (dependency, field) in self.failed_tasks or (dependency, field) in self.skipped_tasks
+      for dependency in STAGE_DEPENDENCIES[stage]
+      if dependency in self.stages
+    )
+
+  def dispatch_ready_tasks(self, pending_tasks):
+    # the furthest along stages go first, so fields drain through the pipeline rather than piling up at one stage
+    still_pending_tasks = []
+    for stage, field in sorted(pending_tasks, key=lambda task: -self.stages.index(task[0])):
+      if self.is_blocked(stage, field):
+        self.skip_task(stage, field)
+      elif len(self.running_tasks) < self.concurrency and self.is_ready(stage, field):
+        self.start_task(stage, field)
+      else:
+        still_pending_tasks.append((stage, field))
+    return still_pending_tasks
+
+  def skip_task(self, stage, field):
+    LOGGER.error("skipped %s for %s: an upstream stage failed", stage, field)
+    self.skipped_tasks.add((stage, field))
+
+  def start_task(self, stage, field):
+    try:
+      commands = self.field_commands.commands(stage, [field])
+    except Exception:
+      LOGGER.exception("could not plan %s for %s", stage, field)
+      self.failed_tasks.add((stage, field))
+      return
+    future = self.executor.submit("%s %s" % (stage, field), commands)
+    self.running_tasks[future] = (stage, field)
+
+  def finish_task(self, future):
+    stage, field = self.running_tasks.pop(future)
+    if future.exception() != None:
+      # what the failed task wrote before it stopped is only found by walking the directory again
+      self.field_commands.stage_completed(stage)
+      LOGGER.error("%s failed for %s: %s", stage, field, future.exception())
+      self.failed_tasks.add((stage, field))
+    else:
+      self.field_commands.stage_completed(stage, future.result())
+      self.completed_tasks.add((stage, field))
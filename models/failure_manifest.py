@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+
+from models.paths import ensure_directory
+from models.scratch_staging import shared_item
+
+LOGGER = logging.getLogger()
+
+FAILURES_DIRECTORY_NAME = "failures"
+RETRIED_DIRECTORY_NAME = "retried"
+
+CURRENT_FAILURE_MANIFEST = None
+
+def failures_path(directory, job_name, shard_index):
+  return Path(directory) / FAILURES_DIRECTORY_NAME / ("%s_%i.jsonl" % (job_name, shard_index))
+
+class FailureManifest:
+  # one json line per item whose exception the shard swallowed, with the item exactly as the shard was given it,
+  # so a retry can shard just those items again
+  def __init__(self, path):
+    self.path = Path(path)
+    self.file = None
+    self.failures_count = 0
+    # background writers record their failures from their own threads
+    self.lock = threading.Lock()
+
+  def record(self, item, exception, seconds):
+    # a staged shard's items are local copies; the retry needs the shared paths they were staged from
+    item = shared_item(item)
+    with self.lock:
+      if self.file == None:
+        ensure_directory(self.path.parent)
+        # a rerun of the shard replaces its failures rather than appending to them
+        self.file = open(self.path, "w")
+      self.file.write(json.dumps({
+        "item": list(item) if isinstance(item, (tuple, list)) else str(item),
+        "exception_type": type(exception).__name__,
+        "message": str(exception),
+        "seconds": seconds,
+        "host": socket.gethostname(),
+        "pid": os.getpid()
+      }, default=str) + "\n")
+      self.file.flush()
+      self.failures_count += 1
+
+  def close(self):
+    if self.file != None:
+      self.file.close()
+      LOGGER.warning("%i failed items recorded in %s", self.failures_count, self.path)
+
+@contextmanager
+def recording_failures(path):
+  global CURRENT_FAILURE_MANIFEST
+  if path == None or CURRENT_FAILURE_MANIFEST != None:
+    yield CURRENT_FAILURE_MANIFEST
+    return
+
+  CURRENT_FAILURE_MANIFEST = FailureManifest(path)
+  try:
+    yield CURRENT_FAILURE_MANIFEST
+  finally:
+    CURRENT_FAILURE_MANIFEST.close()
+    CURRENT_FAILURE_MANIFEST = None
+
+def record_failure(item, exception, seconds):
+  if CURRENT_FAILURE_MANIFEST != None:
+    CURRENT_FAILURE_MANIFEST.record(item, exception, seconds)
+
+@contextmanager
+def recorded_failure(item):
+  start_time = perf_counter()
+  try:
+    yield
+  except Exception as exception:
+    traceback.print_exc()
+    record_failure(item, exception, perf_counter() - start_time)
+
+def failed_items(paths):
+  items = {}
+  for path in paths:
+    with path.open() as failures_file:
+      for line in failures_file:
+        if line.strip() == "":
+          continue
+        item = json.loads(line)["item"]
+        items[tuple(item) if isinstance(item, list) else item] = True
+  return list(items)
+
+@contextmanager
+def retrying_failures(directory, job_name_prefix):
+  # failures of every earlier run of a stage; they are moved aside once the retry has run, so each failure is
+  # retried once, and kept when the retry could not run at all
+  failures_directory = Path(directory) / FAILURES_DIRECTORY_NAME
+  paths = sorted(failures_directory.glob("%s_*.jsonl" % job_name_prefix))
+  yield failed_items(paths)
+  if len(paths) > 0:
+    ensure_directory(failures_directory / RETRIED_DIRECTORY_NAME)
+  for path in paths:
+    os.replace(path, failures_directory / RETRIED_DIRECTORY_NAME / path.name)
+
+def failures_arguments(failures):
+  return ["--failures=%s" % failures] if failures != None else []
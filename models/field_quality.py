@@ -0,0 +1,145 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import numpy
+
+from models.paths import ensure_directory
+
+LOGGER = logging.getLogger()
+
+SKIPPED_FIELDS_DIRECTORY_NAME = "skipped_fields"
+PREFILTER_MODES = ["skip", "deprioritize"]
+THUMBNAIL_SIZE = 512
+BACKGROUND_PERCENTILE = 5
+FOREGROUND_SIGMAS = 6
+MIN_FOREGROUND_FRACTION = 0.001
+# what one field costs cellpose, for estimating the time a skip saves
+ESTIMATED_SEGMENTATION_SECONDS = 120
+QUALITY_THREADS = 4
+
+def thumbnail(image, size=THUMBNAIL_SIZE):
+  # block means rather than every nth pixel, so noise averages out instead of passing for detail
+  image = numpy.asarray(image, dtype=numpy.float32)
+  factor = max(1, int(numpy.ceil(max(image.shape) / size)))
+  rows_count, columns_count = image.shape[0] // factor, image.shape[1] // factor
+  blocks = image[:rows_count * factor, :columns_count * factor].reshape(rows_count, factor, columns_count, factor)
+  return blocks.mean(axis=(1, 3))
+
+def laplacian_variance(image):
+  laplacian = image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2] + image[1:-1, 2:] - 4 * image[1:-1, 1:-1]
+  return float(laplacian.var())
+
+class FieldQuality:
+  def __init__(self, path, image):
+    self.path = path
+    self.image = thumbnail(image)
+
+  @classmethod
+  def load(cls, path):
+    import skimage.io
+    return cls(path, skimage.io.imread(path, as_gray=True))
+
+  @property
+  def background(self):
+    # the low end of the histogram is background however much of the field the nuclei cover; the median is not
+    # once they cover more than half of it
+    return float(numpy.percentile(self.image, BACKGROUND_PERCENTILE))
+
+  @property
+  def noise(self):
+    # from the differences between neighbouring pixels, which sit inside the same nucleus or the same stretch of
+    # background almost everywhere, so the estimate does not depend on how much of the field is covered
+    differences = numpy.diff(self.image, axis=1)
+    return float(1.4826 * numpy.median(numpy.abs(differences - numpy.median(differences))) / numpy.sqrt(2))
+
+  @property
+  def foreground_fraction(self):
+    return float(numpy.mean(self.image > self.background + FOREGROUND_SIGMAS * self.noise))
+
+  @property
+  def focus(self):
+    # variance of the laplacian over the squared mean intensity, so dim and bright plates compare alike
+    mean_intensity = float(self.image.mean())
+    if mean_intensity == 0:
+      return 0.0
+    return laplacian_variance(self.image) / mean_intensity ** 2
+
+  def to_json_params(self):
+    return {
+      "item": str(self.path),
+      "background": self.background,
+      "noise": self.noise,
+      "foreground_fraction": self.foreground_fraction,
+      "focus": self.focus
+    }
+
+class FieldQualityFilter:
+  # a look at each DAPI projection before cellpose: fields with almost no foreground, or too blurred when a focus
+  # threshold is given, are skipped or left until every other field has been segmented
+  def __init__(
+    self,
+    mode="skip",
+    min_foreground_fraction=MIN_FOREGROUND_FRACTION,
+    min_focus=None,
+    estimated_segmentation_seconds=ESTIMATED_SEGMENTATION_SECONDS
+  ):
+    if not mode in PREFILTER_MODES:
+      raise Exception("unknown prefilter mode %s" % mode)
+    self.mode = mode
+    self.min_foreground_fraction = min_foreground_fraction
+    self.min_focus = min_focus
+    self.estimated_segmentation_seconds = estimated_segmentation_seconds
+
+  def reasons(self, field_quality_params):
+    reasons = []
+    if field_quality_params["foreground_fraction"] < self.min_foreground_fraction:
+      reasons.append("foreground fraction %.5f below %.5f" % (field_quality_params["foreground_fraction"], self.min_foreground_fraction))
+    if self.min_focus != None and field_quality_params["focus"] < self.min_focus:
+      reasons.append("focus %.5f below %.5f" % (field_quality_params["focus"], self.min_focus))
+    return reasons
+
+  def filter(self, paths, directory, name):
+    start_time = perf_counter()
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=QUALITY_THREADS) as executor:
+      field_quality_params_list = list(executor.map(lambda path: FieldQuality.load(path).to_json_params(), paths))
+    passed_paths = []
+    failed_paths = []
+    ensure_directory(Path(directory) / SKIPPED_FIELDS_DIRECTORY_NAME)
+    with (Path(directory) / SKIPPED_FIELDS_DIRECTORY_NAME / ("%s.jsonl" % name)).open("w") as skipped_fields_file:
+      for path, field_quality_params in zip(paths, field_quality_params_list):
+        reasons = self.reasons(field_quality_params)
+        if len(reasons) == 0:
+          passed_paths.append(path)
+          continue
+        failed_paths.append(path)
+        skipped_fields_file.write(json.dumps({ **field_quality_params, "mode": self.mode, "reasons": reasons }) + "\n")
+    self.write_summary(directory, name, len(paths), len(failed_paths), perf_counter() - start_time)
+    if self.mode == "deprioritize":
+      return passed_paths + failed_paths
+    return passed_paths
+
+  def write_summary(self, directory, name, fields_count, failed_fields_count, prefilter_seconds):
+    skipped_fields_count = failed_fields_count if self.mode == "skip" else 0
+    estimated_seconds_saved = skipped_fields_count * self.estimated_segmentation_seconds - prefilter_seconds
+    summary = {
+      "mode": self.mode,
+      "fields_count": fields_count,
+      "failed_fields_count": failed_fields_count,
+      "skipped_fields_count": skipped_fields_count,
+      "prefilter_seconds": prefilter_seconds,
+      "estimated_seconds_saved": estimated_seconds_saved
+    }
+    with (Path(directory) / SKIPPED_FIELDS_DIRECTORY_NAME / ("%s_summary.json" % name)).open("w") as summary_file:
+      json.dump(summary, summary_file, indent=2)
+    LOGGER.warning(
+      "prefilter: %i of %i fields below the thresholds (%s), %.1fs spent, about %.0f minutes of segmentation saved",
+      failed_fields_count,
+      fields_count,
+      "skipped" if self.mode == "skip" else "segmented last",
+      prefilter_seconds,
+      max(0, estimated_seconds_saved) / 60
+    )
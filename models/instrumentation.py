@@ -0,0 +1,256 @@
+import cProfile
+import heapq
+import json
+import logging
+import os
+import socket
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+LOGGER = logging.getLogger()
+
+INSTRUMENTATION_DIRECTORY_VARIABLE = "PIPELINE_INSTRUMENTATION_DIRECTORY"
+PROFILE_VARIABLE = "PIPELINE_PROFILE"
+TRACE_MEMORY_VARIABLE = "PIPELINE_TRACE_MEMORY"
+# a file every output's path is appended to, for whoever ran the stage to index
+WRITTEN_PATHS_VARIABLE = "PIPELINE_WRITTEN_PATHS"
+INSTRUMENTATION_ENVIRONMENT_VARIABLES = [
+  INSTRUMENTATION_DIRECTORY_VARIABLE,
+  PROFILE_VARIABLE,
+  TRACE_MEMORY_VARIABLE
+]
+
+MAX_RECORDED_ITEMS_COUNT = 10
+PEAK_RSS_RESET_PATH = Path("/proc/self/clear_refs")
+STATUS_PATH = Path("/proc/self/status")
+
+CURRENT_SHARD_INSTRUMENTATION = None
+# the peak before the last reset, which took ru_maxrss down with it
+EARLIER_PEAK_RSS_BYTES = 0
+
+def peak_rss_bytes():
+  if resource == None:
+    return None
+  # ru_maxrss is reported in kilobytes on linux
+  return max(EARLIER_PEAK_RSS_BYTES, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+def reset_peak_rss():
+  # writing 5 resets the kernel's high water mark of the resident set, so high_water_rss_bytes reads the peak
+  # since now; returns whether it could
+  global EARLIER_PEAK_RSS_BYTES
+  EARLIER_PEAK_RSS_BYTES = peak_rss_bytes() or 0
+  try:
+    PEAK_RSS_RESET_PATH.write_text("5")
+    return True
+  except OSError:
+    return False
+
+def high_water_rss_bytes():
+  try:
+    with STATUS_PATH.open() as status_file:
+      for line in status_file:
+        if line.startswith("VmHWM:"):
+          # reported in kilobytes
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+def numpy_save_path(path):
+  # numpy.save appends .npy to any filename that does not already end with it
+  path = Path(path)
+  if path.suffix == ".npy":
+    return path
+  return path.with_name(path.name + ".npy")
+
+class ShardInstrumentation:
+  def __init__(self, stage, directory, profile=False, trace_memory=False):
+    self.stage = stage
+    self.directory = Path(directory)
+    self.profile = profile
+    self.trace_memory = trace_memory
+    self.sections = {}
+    self.bytes_read = 0
+    self.bytes_written = 0
+    self.heaviest_items = []
+    self.memory_events = {}
+    self.lock = threading.Lock()
+
+  @classmethod
+  def from_environment(cls, stage):
+    directory = os.environ.get(INSTRUMENTATION_DIRECTORY_VARIABLE)
+    if directory == None:
+      return None
+    return cls(
+      stage,
+      directory,
+      profile=os.environ.get(PROFILE_VARIABLE) == "1",
+      trace_memory=os.environ.get(TRACE_MEMORY_VARIABLE) == "1"
+    )
+
+  def start(self):
+    self.started_at = datetime.now()
+    self.start_time = perf_counter()
+    if self.trace_memory:
+      tracemalloc.start()
+    if self.profile:
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+
+  def stop(self):
+    self.wall_seconds = perf_counter() - self.start_time
+    if self.profile:
+      self.profiler.disable()
+    if self.trace_memory:
+      _current, self.traced_peak_bytes = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+  def add_section_time(self, section, seconds):
+    with self.lock:
+      if not section in self.sections:
+        self.sections[section] = { "count": 0, "seconds": 0.0, "max_seconds": 0.0 }
+      self.sections[section]["count"] += 1
+      self.sections[section]["seconds"] += seconds
+      self.sections[section]["max_seconds"] = max(self.sections[section]["max_seconds"], seconds)
+
+  def add_bytes_read(self, bytes_count):
+    with self.lock:
+      self.bytes_read += bytes_count
+
+  def add_bytes_written(self, bytes_count):
+    with self.lock:
+      self.bytes_written += bytes_count
+
+  def add_item_memory(self, item, rss_bytes):
+    # only the items the shard peaked highest during are kept
+    with self.lock:
+      heaviest_item = (rss_bytes, str(item))
+      if len(self.heaviest_items) < MAX_RECORDED_ITEMS_COUNT:
+        heapq.heappush(self.heaviest_items, heaviest_item)
+      else:
+        heapq.heappushpop(self.heaviest_items, heaviest_item)
+
+  def add_memory_event(self, event):
+    with self.lock:
+      self.memory_events[event] = self.memory_events.get(event, 0) + 1
+
+  def write(self):
+    if not self.directory.exists():
+      Path.mkdir(self.directory, parents=True, exist_ok=True)
+    with open(self.record_path, "w") as record_file:
+      json.dump(self.record, record_file)
+    if self.profile:
+      self.profiler.dump_stats(str(self.profile_path))
+
+  @property
+  def record(self):
+    return {
+      "stage": self.stage,
+      "host": socket.gethostname(),
+      "pid": os.getpid(),
+      "started_at": self.started_at.isoformat(),
+      "wall_seconds": self.wall_seconds,
+      "sections": self.sections,
+      "bytes_read": self.bytes_read,
+      "bytes_written": self.bytes_written,
+      "peak_rss_bytes": peak_rss_bytes(),
+      "traced_peak_bytes": self.traced_peak_bytes if self.trace_memory else None,
+      "heaviest_items": [
+        { "item": item, "rss_bytes": rss_bytes }
+        for rss_bytes, item in sorted(self.heaviest_items, reverse=True)
+      ],
+      "memory_events": self.memory_events,
+      "profile": str(self.profile_path) if self.profile else None
+    }
+
+  @property
+  def record_name(self):
+    if not hasattr(self, "_record_name"):
+      self._record_name = "%s_%s_%i_%s" % (
+        self.stage,
+        socket.gethostname(),
+        os.getpid(),
+        self.started_at.strftime("%Y%m%d%H%M%S%f")
+      )
+    return self._record_name
+
+  @property
+  def record_path(self):
+    return self.directory / ("%s.json" % self.record_name)
+
+  @property
+  def profile_path(self):
+    return self.directory / ("%s.prof" % self.record_name)
+
+@contextmanager
+def instrumented_shard(stage):
+  global CURRENT_SHARD_INSTRUMENTATION
+  shard_instrumentation = ShardInstrumentation.from_environment(stage)
+  if shard_instrumentation == None or CURRENT_SHARD_INSTRUMENTATION != None:
+    yield CURRENT_SHARD_INSTRUMENTATION
+    return
+
+  CURRENT_SHARD_INSTRUMENTATION = shard_instrumentation
+  shard_instrumentation.start()
+  try:
+    yield shard_instrumentation
+  finally:
+    shard_instrumentation.stop()
+    CURRENT_SHARD_INSTRUMENTATION = None
+    try:
+      shard_instrumentation.write()
+    except Exception:
+      LOGGER.exception("could not write instrumentation record for %s", stage)
+
+@contextmanager
+def timed(section):
+  shard_instrumentation = CURRENT_SHARD_INSTRUMENTATION
+  if shard_instrumentation == None:
+    yield
+    return
+  start_time = perf_counter()
+  try:
+    yield
+  finally:
+    shard_instrumentation.add_section_time(section, perf_counter() - start_time)
+
+def record_read(path):
+  shard_instrumentation = CURRENT_SHARD_INSTRUMENTATION
+  if shard_instrumentation != None:
+    shard_instrumentation.add_bytes_read(os.path.getsize(path))
+
+def record_write(path):
+  shard_instrumentation = CURRENT_SHARD_INSTRUMENTATION
+  if shard_instrumentation != None:
+    shard_instrumentation.add_bytes_written(os.path.getsize(path))
+  written_paths_path = os.environ.get(WRITTEN_PATHS_VARIABLE)
+  if written_paths_path != None:
+    from models.scratch_staging import shared_output_path
+    # one line in one append, so the stage's writer threads do not interleave
+    with open(written_paths_path, "a") as written_paths_file:
+      written_paths_file.write("%s\n" % shared_output_path(path))
+
+def read_written_paths(written_paths_path):
+  if not Path(written_paths_path).exists():
+    return []
+  with open(written_paths_path) as written_paths_file:
+    return [line.rstrip("\n") for line in written_paths_file if line.strip() != ""]
+
+def record_item_memory(item, rss_bytes):
+  shard_instrumentation = CURRENT_SHARD_INSTRUMENTATION
+  if shard_instrumentation != None and rss_bytes != None:
+    shard_instrumentation.add_item_memory(item, rss_bytes)
+
+def record_memory_event(event):
+  shard_instrumentation = CURRENT_SHARD_INSTRUMENTATION
+  if shard_instrumentation != None:
+    shard_instrumentation.add_memory_event(event)
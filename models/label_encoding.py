@@ -0,0 +1,132 @@
+import numpy
+
+from models.instrumentation import record_read
+from models.labels import LabelStatistics
+
+LABEL_ENCODINGS = ["npy", "rle"]
+LABEL_DTYPES = [numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64]
+
+def label_dtype(max_label):
+  for dtype in LABEL_DTYPES:
+    if max_label <= numpy.iinfo(dtype).max:
+      return dtype
+  raise Exception("label %s does not fit in any unsigned type" % max_label)
+
+def compact_labels(label_matrix):
+  max_label = int(label_matrix.max()) if label_matrix.size > 0 else 0
+  if label_matrix.size > 0 and label_matrix.min() < 0:
+    raise Exception("labels must not be negative")
+  return label_matrix.astype(label_dtype(max_label), copy=False)
+
+class RunLengthLabels:
+  # nonzero runs of each row: a label matrix is mostly background, so a field shrinks to a few arrays of run ends
+  def __init__(self, shape, rows, columns, lengths, labels):
+    self.shape = tuple(int(size) for size in shape)
+    self.rows = rows
+    self.columns = columns
+    self.lengths = lengths
+    self.labels = labels
+
+  @classmethod
+  def encode(cls, label_matrix):
+    rows_count, columns_count = label_matrix.shape
+    # a zero column after every row ends each row's last run and keeps runs from joining across rows
+    padded = numpy.zeros((rows_count, columns_count + 1), dtype=label_matrix.dtype)
+    padded[:, :columns_count] = label_matrix
+    flat = padded.ravel()
+    is_run_start = numpy.ones(flat.shape, dtype=bool)
+    is_run_start[1:] = flat[1:] != flat[:-1]
+    run_starts = numpy.flatnonzero(is_run_start)
+    run_lengths = numpy.diff(numpy.append(run_starts, flat.size))
+    run_labels = flat[run_starts]
+    is_label_run = run_labels != 0
+    run_starts = run_starts[is_label_run]
+    position_dtype = label_dtype(columns_count + 1)
+    return cls(
+      label_matrix.shape,
+      (run_starts // (columns_count + 1)).astype(label_dtype(rows_count)),
+      (run_starts % (columns_count + 1)).astype(position_dtype),
+      run_lengths[is_label_run].astype(position_dtype),
+      compact_labels(run_labels[is_label_run])
+    )
+
+  @classmethod
+  def load(cls, path):
+    with numpy.load(path) as runs:
+      run_length_labels = cls(runs["shape"], runs["rows"], runs["columns"], runs["lengths"], runs["labels"])
+    record_read(path)
+    return run_length_labels
+
+  def save(self, path):
+    numpy.savez(path, shape=numpy.array(self.shape), rows=self.rows, columns=self.columns, lengths=self.lengths, labels=self.labels)
+
+  @property
+  def nbytes(self):
+    return self.rows.nbytes + self.columns.nbytes + self.lengths.nbytes + self.labels.nbytes
+
+  @property
+  def distinct_labels(self):
+    return numpy.unique(self.labels)
+
+  @property
+  def label_statistics(self):
+    labels = numpy.array(sorted(self.bounding_boxes), dtype=numpy.int64)
+    areas_by_label_index = numpy.bincount(
+      numpy.unique(self.labels, return_inverse=True)[1],
+      weights=self.lengths,
+      minlength=len(labels)
+    ).astype(numpy.int64)
+    return LabelStatistics(labels, areas_by_label_index, [self.bounding_boxes[label] for label in labels.tolist()])
+
+  @property
+  def bounding_boxes(self):
+    # (min_row, min_col, max_row, max_col) per label, exclusive at the end like regionprops.bbox
+    if not hasattr(self, "_bounding_boxes"):
+      labels, label_indices = numpy.unique(self.labels, return_inverse=True)
+      run_ends = self.columns.astype(numpy.int64) + self.lengths
+      min_rows = numpy.full(len(labels), self.shape[0], dtype=numpy.int64)
+      min_columns = numpy.full(len(labels), self.shape[1], dtype=numpy.int64)
+      max_rows = numpy.zeros(len(labels), dtype=numpy.int64)
+      max_columns = numpy.zeros(len(labels), dtype=numpy.int64)
+      numpy.minimum.at(min_rows, label_indices, self.rows)
+      numpy.minimum.at(min_columns, label_indices, self.columns)
+      numpy.maximum.at(max_rows, label_indices, self.rows.astype(numpy.int64) + 1)
+      numpy.maximum.at(max_columns, label_indices, run_ends)
+      self._bounding_boxes = {
+        label: (min_row, min_column, max_row, max_column)
+        for label, min_row, min_column, max_row, max_column
+        in zip(labels.tolist(), min_rows.tolist(), min_columns.tolist(), max_rows.tolist(), max_columns.tolist())
+      }
+    return self._bounding_boxes
+
+  def decode(self):
+    return self.decode_region((0, 0, *self.shape))
+
+  def decode_region(self, bounding_box):
+    # only the runs that cross the box are painted, so a crop costs its own runs rather than the whole field
+    min_row, min_column, max_row, max_column = bounding_box
+    region = numpy.zeros((max_row - min_row, max_column - min_column), dtype=self.labels.dtype)
+    run_starts = self.columns.astype(numpy.int64)
+    run_ends = run_starts + self.lengths
+    in_region = (self.rows >= min_row) & (self.rows < max_row) & (run_ends > min_column) & (run_starts < max_column)
+    run_starts = numpy.maximum(run_starts[in_region], min_column) - min_column
+    run_lengths = numpy.minimum(run_ends[in_region], max_column) - min_column - run_starts
+    flat_run_starts = (self.rows[in_region].astype(numpy.int64) - min_row) * region.shape[1] + run_starts
+    run_offsets = numpy.arange(run_lengths.sum()) - numpy.repeat(numpy.cumsum(run_lengths) - run_lengths, run_lengths)
+    region.ravel()[numpy.repeat(flat_run_starts, run_lengths) + run_offsets] = numpy.repeat(self.labels[in_region], run_lengths)
+    return region
+
+def save_labels(path, label_matrix, encoding="npy"):
+  if encoding == "rle":
+    RunLengthLabels.encode(label_matrix).save(path)
+  elif encoding == "npy":
+    numpy.save(path, compact_labels(label_matrix))
+  else:
+    raise Exception("unknown label encoding %s" % encoding)
+
+def load_labels(path):
+  if str(path).endswith(".npz"):
+    return RunLengthLabels.load(path).decode()
+  label_matrix = numpy.load(path, allow_pickle=True)
+  record_read(path)
+  return label_matrix
@@ -1,8 +1,44 @@
+import numpy
+
+
+class LabelStatistics:
+  def __init__(self, labels, areas, bounding_boxes):
+    self.labels = labels
+    self.areas = areas
+    self.bounding_boxes = bounding_boxes
+
+  def filtered(self, min_area=None, max_area=None):
+    keep = numpy.ones(len(self.labels), dtype=bool)
+    if min_area != None:
+      keep &= self.areas >= min_area
+    if max_area != None:
+      keep &= self.areas <= max_area
+    return LabelStatistics(
+      self.labels[keep],
+      self.areas[keep],
+      [bounding_box for bounding_box, kept in zip(self.bounding_boxes, keep) if kept]
+    )
+
+def label_areas(label_matrix):
+  # counts every value from 0 to the largest label; only uint64 labels need a cast to bincount's index type
+  flat_labels = numpy.ravel(label_matrix)
+  if not numpy.can_cast(flat_labels.dtype, numpy.intp):
+    flat_labels = flat_labels.astype(numpy.intp)
+  return numpy.bincount(flat_labels)
+
 def distinct_labels(label_matrix):
-  distinct_labels_set = set()
-  for labels_row in label_matrix:
-      for label in labels_row:
-          distinct_labels_set.add(label)
-  distinct_labels_set.remove(0)
-  return [label for label in distinct_labels_set]
+  labels = numpy.flatnonzero(label_areas(label_matrix))
+  return labels[labels != 0].tolist()
 
+def label_statistics(label_matrix):
+  from scipy import ndimage
+  areas = label_areas(label_matrix)
+  labels = numpy.flatnonzero(areas)
+  labels = labels[labels != 0]
+  # find_objects returns the slices of label n at index n - 1, in one pass over the image
+  objects = ndimage.find_objects(label_matrix)
+  bounding_boxes = [
+    (objects[label - 1][0].start, objects[label - 1][1].start, objects[label - 1][0].stop, objects[label - 1][1].stop)
+    for label in labels.tolist()
+  ]
+  return LabelStatistics(labels, areas[labels], bounding_boxes)
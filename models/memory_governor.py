@@ -0,0 +1,110 @@
+import gc
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from models.instrumentation import high_water_rss_bytes, peak_rss_bytes, record_item_memory, record_memory_event, reset_peak_rss
+from models.scratch_staging import shared_item
+
+LOGGER = logging.getLogger()
+
+MEMORY_LIMIT_VARIABLE = "PIPELINE_MEMORY_LIMIT_GB"
+CGROUP_MEMORY_LIMIT_PATH = Path("/sys/fs/cgroup/memory.max")
+HIGH_WATER_FRACTION = 0.8
+LOW_WATER_FRACTION = 0.5
+
+RELEASABLE_CACHES = []
+MEMORY_GOVERNOR = None
+
+def memory_limit_bytes():
+  # an explicit limit, then what slurm allocated the job, then the cgroup's; none of these means no limit
+  if MEMORY_LIMIT_VARIABLE in os.environ:
+    return int(float(os.environ[MEMORY_LIMIT_VARIABLE]) * 1024 ** 3)
+  if "SLURM_MEM_PER_NODE" in os.environ:
+    return int(os.environ["SLURM_MEM_PER_NODE"]) * 1024 ** 2
+  if "SLURM_MEM_PER_CPU" in os.environ:
+    return int(os.environ["SLURM_MEM_PER_CPU"]) * 1024 ** 2 * int(os.environ.get("SLURM_CPUS_PER_TASK", "1"))
+  try:
+    cgroup_memory_limit = CGROUP_MEMORY_LIMIT_PATH.read_text().strip()
+  except OSError:
+    return None
+  return int(cgroup_memory_limit) if cgroup_memory_limit.isdigit() else None
+
+def current_rss_bytes():
+  try:
+    with open("/proc/self/statm") as statm_file:
+      return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError):
+    # without /proc the peak is the closest thing there is
+    return peak_rss_bytes()
+
+def releasable_cache(cached_function):
+  # marks an lru_cache the governor may clear when memory runs short; the next call just loads again
+  RELEASABLE_CACHES.append(cached_function)
+  return cached_function
+
+class MemoryGovernor:
+  # keeps a shard under its allocation: batches shrink and caches are dropped above the high water mark, and
+  # batches grow back to what was asked for below the low water mark
+  def __init__(self, limit_bytes):
+    self.limit_bytes = limit_bytes
+    # each stage's knob shrinks and grows on its own
+    self.batch_sizes = {}
+
+  def usage(self):
+    if self.limit_bytes == None:
+      return 0.0
+    return (current_rss_bytes() or 0) / self.limit_bytes
+
+  def under_pressure(self):
+    return self.usage() > HIGH_WATER_FRACTION
+
+  def batch_size_for(self, requested_batch_size, knob="batch"):
+    batch_size = self.batch_sizes.get(knob, requested_batch_size)
+    usage = self.usage()
+    if usage > HIGH_WATER_FRACTION and batch_size > 1:
+      batch_size = max(1, batch_size // 2)
+      record_memory_event("batch_shrinks")
+      LOGGER.warning("memory at %.0f%% of the limit, %s batches shrunk to %i", usage * 100, knob, batch_size)
+    elif usage < LOW_WATER_FRACTION and batch_size < requested_batch_size:
+      batch_size = min(requested_batch_size, batch_size * 2)
+    self.batch_sizes[knob] = batch_size
+    return batch_size
+
+  def in_flight_bytes(self, requested_in_flight_bytes):
+    # queued reads and writes get half of the headroom left below the high water mark
+    if self.limit_bytes == None:
+      return requested_in_flight_bytes
+    headroom_bytes = self.limit_bytes * HIGH_WATER_FRACTION - (current_rss_bytes() or 0)
+    return int(max(0, min(requested_in_flight_bytes, headroom_bytes / 2)))
+
+  def relieve(self):
+    usage = self.usage()
+    if usage <= HIGH_WATER_FRACTION:
+      return
+    for cached_function in RELEASABLE_CACHES:
+      cached_function.cache_clear()
+    gc.collect()
+    record_memory_event("cache_flushes")
+    LOGGER.warning("memory at %.0f%% of the limit, caches flushed", usage * 100)
+
+  @contextmanager
+  def item(self, item):
+    # the item's own peak, not what it left behind, when the kernel's high water mark can be reset
+    peak_reset = reset_peak_rss()
+    try:
+      yield
+    finally:
+      item_rss_bytes = high_water_rss_bytes() if peak_reset else None
+      record_item_memory(shared_item(item), item_rss_bytes if item_rss_bytes != None else current_rss_bytes())
+      self.relieve()
+
+def memory_governor():
+  global MEMORY_GOVERNOR
+  if MEMORY_GOVERNOR == None:
+    MEMORY_GOVERNOR = MemoryGovernor(memory_limit_bytes())
+  return MEMORY_GOVERNOR
+
+def governed_item(item):
+  return memory_governor().item(item)
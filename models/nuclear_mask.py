@@ -1,13 +1,11 @@
-import skimage
-
 class NuclearMask:
   def __init__(self, mask, offset):
     self.mask = mask
     self.offset = offset
 
   @classmethod
-  def build(cls, masks, regionprops):
-    (min_row, min_col, max_row, max_col) = regionprops.bbox
+  def from_bounding_box(cls, masks, label, bounding_box):
+    (min_row, min_col, max_row, max_col) = bounding_box
     offset = (min_row, min_col)
-    mask = masks[min_row:max_row, min_col:max_col] == regionprops.label
+    mask = masks[min_row:max_row, min_col:max_col] == label
     return cls(mask, offset)
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 def source_path(source):
@@ -13,3 +14,38 @@ def destination_path(destination):
   elif not path.is_dir():
     raise Exception("destination already exists, but is not a directory")
   return path
+
+ENSURED_DIRECTORIES = set()
+
+def ensure_directory(directory):
+  # jobs in a shard mostly write into the same few directories, so each is checked at most once per process
+  directory = Path(directory)
+  if not directory in ENSURED_DIRECTORIES:
+    if not directory.exists():
+      Path.mkdir(directory, parents=True, exist_ok=True)
+    elif not directory.is_dir():
+      raise Exception("destination already exists, but is not a directory")
+    ENSURED_DIRECTORIES.add(directory)
+  return directory
+
+def ensure_directories(directories):
+  for directory in set(Path(directory) for directory in directories):
+    ensure_directory(directory)
+
+def relative_path(path, directory):
+  # a prefix check on the strings is much cheaper than Path.relative_to, which is only needed for odd inputs
+  path_str = str(path)
+  directory_prefix = os.path.join(str(directory), "")
+  if path_str.startswith(directory_prefix) and len(directory_prefix) > 1:
+    return path_str[len(directory_prefix):]
+  return str(Path(path).relative_to(directory))
+
+def ensure_destination_directories(sources, source_dir, destination):
+  # made once at shard start; a source outside source_dir is left for its own job to report
+  destination_directories = set()
+  for source in sources:
+    try:
+      destination_directories.add(Path(destination) / os.path.dirname(relative_path(Path(source), Path(source_dir))))
+    except ValueError:
+      continue
+  ensure_directories(destination_directories)
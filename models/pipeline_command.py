@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+PIPELINE_PATH = Path(__file__).resolve().parents[1] / "pipeline.py"
+
+def pipeline_command(stage):
+  return [sys.executable, str(PIPELINE_PATH), stage]
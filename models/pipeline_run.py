@@ -0,0 +1,69 @@
+from pathlib import Path
+
+RESULT_DIRECTORY_NAMES = {
+  "mips": "MIPs_and_z_centers",
+  "segmentations": "nuclear_segmentations",
+  "masks": "nuclear_masks",
+  "distance_transforms": "distance_transforms",
+  "crops": "cell_crops",
+  "spots": "spot_positions",
+  "result_lines": "spot_result_lines",
+  "logs": "logs"
+}
+
+class PipelineRun:
+  @classmethod
+  def from_json_params(cls, json_params):
+    return cls(
+      images=json_params["images"],
+      results=json_params["results"],
+      diameter=json_params["diameter"],
+      DAPI_channel=json_params["DAPI_channel"],
+      spot_positions_config=json_params.get("spot_positions_config"),
+      tile_size=json_params.get("tile_size"),
+      min_area=json_params.get("min_area"),
+      max_area=json_params.get("max_area"),
+      directories=json_params.get("directories", {})
+    )
+
+  def __init__(
+    self,
+    images,
+    results,
+    diameter,
+    DAPI_channel,
+    spot_positions_config=None,
+    tile_size=None,
+    min_area=None,
+    max_area=None,
+    directories={}
+  ):
+    self.images = str(images)
+    self.results = str(results)
+    self.diameter = diameter
+    self.DAPI_channel = DAPI_channel
+    self.spot_positions_config = spot_positions_config
+    self.tile_size = tile_size
+    self.min_area = min_area
+    self.max_area = max_area
+    # any stage directory not given explicitly goes under results, named like the notebooks name it
+    self.directories = {
+      name: str(directories.get(name, Path(self.results) / directory_name))
+      for name, directory_name in RESULT_DIRECTORY_NAMES.items()
+    }
+
+  def to_json_params(self):
+    return {
+      "images": self.images,
+      "results": self.results,
+      "diameter": self.diameter,
+      "DAPI_channel": self.DAPI_channel,
+      "spot_positions_config": self.spot_positions_config,
+      "tile_size": self.tile_size,
+      "min_area": self.min_area,
+      "max_area": self.max_area,
+      "directories": self.directories
+    }
+
+  def directory(self, name):
+    return self.directories[name]
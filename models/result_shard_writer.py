@@ -0,0 +1,32 @@
+import csv
+from pathlib import Path
+
+from models.instrumentation import record_write
+
+WRITE_BUFFER_BYTES = 1024 * 1024
+RESULT_SHARD_GLOB = "*_shard_*.csv"
+
+def result_shard_filename(job_name, shard_index):
+  return "%s_shard_%05i.csv" % (job_name, shard_index)
+
+class ResultShardWriter:
+  def __init__(self, path):
+    self.path = Path(path)
+    self.csv_writer = None
+
+  def __enter__(self):
+    if not self.path.parent.exists():
+      Path.mkdir(self.path.parent, parents=True)
+    # a rerun of the shard replaces its file rather than appending duplicate rows
+    self.file = open(self.path, "w", buffering=WRITE_BUFFER_BYTES)
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.file.close()
+    record_write(self.path)
+
+  def writerow(self, csv_values):
+    if self.csv_writer == None:
+      self.csv_writer = csv.DictWriter(self.file, csv_values.keys())
+      self.csv_writer.writeheader()
+    self.csv_writer.writerow(csv_values)
@@ -0,0 +1,145 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from models.instrumentation import timed
+from models.paths import ensure_directory, relative_path
+
+LOGGER = logging.getLogger()
+
+SCRATCH_VARIABLE = "PIPELINE_SCRATCH"
+AUTO_SCRATCH = "auto"
+
+CURRENT_SCRATCH_STAGING = None
+
+def scratch_root(scratch):
+  # auto is the job's node local /lscratch when slurm gave it one, and the node's temporary directory otherwise
+  if scratch != AUTO_SCRATCH:
+    return Path(scratch)
+  lscratch_path = Path("/lscratch") / os.environ.get("SLURM_JOB_ID", "")
+  if "SLURM_JOB_ID" in os.environ and lscratch_path.is_dir():
+    return lscratch_path
+  return Path(tempfile.gettempdir())
+
+def default_scratch():
+  return os.environ.get(SCRATCH_VARIABLE)
+
+class ScratchStaging:
+  # a shard's inputs are copied to node local disk in one pass before its jobs run, the jobs read and write only
+  # local paths, and the outputs go back to the shared destinations in one pass at the end, so the shared filesystem
+  # sees two bulk copies instead of every job's opens, stats and small writes
+  def __init__(self, scratch):
+    self.root = scratch_root(scratch)
+    self.input_directories = {}
+    self.output_directories = {}
+    self.shared_paths = {}
+
+  def __enter__(self):
+    self.directory = Path(tempfile.mkdtemp(prefix="shard_", dir=ensure_directory(self.root)))
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    try:
+      # outputs of the jobs that succeeded are kept even when the shard fails part way
+      self.write_back()
+    finally:
+      shutil.rmtree(self.directory, ignore_errors=True)
+
+  def stage(self, sources, source_directory):
+    # returns the local path of each source, which must be in source_directory
+    sources = [str(source) for source in sources]
+    local_directory = self.input_directory(source_directory)
+    relative_paths = [relative_path(source, source_directory) for source in sources]
+    with timed("stage"):
+      copy_files(source_directory, local_directory, relative_paths)
+    local_paths = [str(local_directory / source_relative_path) for source_relative_path in relative_paths]
+    self.shared_paths.update(zip(local_paths, sources))
+    return local_paths
+
+  def input_directory(self, source_directory):
+    return self.local_directory(self.input_directories, "inputs", source_directory)
+
+  def output_directory(self, destination):
+    return self.local_directory(self.output_directories, "outputs", destination)
+
+  def local_directory(self, directories, kind, shared_directory):
+    shared_directory = str(shared_directory)
+    if not shared_directory in directories:
+      directories[shared_directory] = ensure_directory(self.directory / kind / str(len(directories)))
+    return directories[shared_directory]
+
+  def shared_item(self, item):
+    if isinstance(item, (tuple, list)):
+      return type(item)(self.shared_item(item_path) for item_path in item)
+    return self.shared_paths.get(str(item), item)
+
+  def shared_output_path(self, path):
+    # where a file written into a local output directory ends up once it is written back
+    for shared_directory, local_directory in self.output_directories.items():
+      if str(path).startswith(os.path.join(str(local_directory), "")):
+        return Path(shared_directory) / relative_path(path, local_directory)
+    return path
+
+  def write_back(self):
+    with timed("write_back"):
+      for shared_directory, local_directory in self.output_directories.items():
+        relative_paths = [
+          relative_path(path, local_directory)
+          for path in local_directory.rglob("*")
+          if path.is_file()
+        ]
+        copy_files(local_directory, ensure_directory(shared_directory), relative_paths)
+        LOGGER.warning("wrote %i staged outputs back to %s", len(relative_paths), shared_directory)
+
+def copy_files(source_directory, destination_directory, relative_paths):
+  # one rsync call moves the whole list where rsync is installed; otherwise each file is copied in turn
+  if len(relative_paths) == 0:
+    return
+  if shutil.which("rsync") != None:
+    subprocess.run(
+      ["rsync", "-a", "--files-from=-", "%s/" % source_directory, "%s/" % destination_directory],
+      input="\n".join(relative_paths),
+      text=True
+    ).check_returncode()
+    return
+  for relative_file_path in relative_paths:
+    destination_file_path = Path(destination_directory) / relative_file_path
+    ensure_directory(destination_file_path.parent)
+    shutil.copyfile(Path(source_directory) / relative_file_path, destination_file_path)
+
+@contextmanager
+def scratch_staging(scratch):
+  global CURRENT_SCRATCH_STAGING
+  if scratch == None:
+    yield None
+    return
+
+  with ScratchStaging(scratch) as CURRENT_SCRATCH_STAGING:
+    try:
+      yield CURRENT_SCRATCH_STAGING
+    finally:
+      CURRENT_SCRATCH_STAGING = None
+
+def staged_sources(staging, sources, source_directory, destination):
+  # the sources, source directory and destination a shard's jobs should use, local copies when it is staged
+  if staging == None:
+    return sources, source_directory, destination
+  return (
+    staging.stage(sources, source_directory),
+    staging.input_directory(source_directory),
+    staging.output_directory(destination)
+  )
+
+def shared_item(item):
+  if CURRENT_SCRATCH_STAGING == None:
+    return item
+  return CURRENT_SCRATCH_STAGING.shared_item(item)
+
+def shared_output_path(path):
+  if CURRENT_SCRATCH_STAGING == None:
+    return path
+  return CURRENT_SCRATCH_STAGING.shared_output_path(path)
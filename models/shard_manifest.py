@@ -0,0 +1,73 @@
+import os
+from pathlib import Path
+
+from models.paths import ensure_directory, relative_path
+
+MANIFESTS_DIRECTORY_NAME = "manifests"
+ROOT_PREFIX = "#root\t"
+
+class ShardManifest:
+  # a shard's items, one per line, relative to the root they share: a swarm line then carries one short manifest path
+  # instead of thousands of absolute paths, and the shard reads its items from the file as it goes rather than from argv.
+  # items of several paths, like an image and mask pair, are tab separated on their line
+  def __init__(self, path):
+    self.path = Path(path)
+
+  @classmethod
+  def write(cls, path, items):
+    item_paths = [
+      tuple(str(item_path) for item_path in item) if isinstance(item, (tuple, list)) else (str(item),)
+      for item in items
+    ]
+    root = manifest_root(item_paths)
+    lines = [ROOT_PREFIX + root + "\n"] if root != "" else []
+    lines.extend(
+      "\t".join(relative_path(item_path, root) if root != "" else item_path for item_path in item) + "\n"
+      for item in item_paths
+    )
+    ensure_directory(Path(path).parent)
+    with open(path, "w") as manifest_file:
+      manifest_file.writelines(lines)
+    return cls(path)
+
+  def __iter__(self):
+    root = ""
+    with self.path.open() as manifest_file:
+      for line in manifest_file:
+        line = line.rstrip("\n")
+        if line.startswith(ROOT_PREFIX):
+          root = line[len(ROOT_PREFIX):]
+          continue
+        if line == "":
+          continue
+        item = tuple(os.path.join(root, item_path) if root != "" else item_path for item_path in line.split("\t"))
+        yield item if len(item) > 1 else item[0]
+
+def manifest_root(item_paths):
+  directories = set(os.path.dirname(item_path) for item in item_paths for item_path in item)
+  if len(directories) == 0 or "" in directories:
+    return ""
+  try:
+    return os.path.commonpath(directories)
+  except ValueError:
+    # relative and absolute paths have no common root; they are written as they are
+    return ""
+
+def manifest_path(directory, job_name, shard_index):
+  return Path(directory) / MANIFESTS_DIRECTORY_NAME / ("%s_%i.manifest" % (job_name, shard_index))
+
+def manifest_sources(sources, manifest):
+  if manifest == None:
+    return sources
+  if len(sources) > 0:
+    raise Exception("sources are given both as arguments and in manifest %s" % manifest)
+  return ShardManifest(manifest)
+
+def source_arguments(sources):
+  if isinstance(sources, ShardManifest):
+    return ["--manifest=%s" % sources.path]
+  return [str(source) for source in sources]
+
+def write_shard_manifests(directory, job_name, shards):
+  for shard_index, shard in enumerate(shards):
+    yield ShardManifest.write(manifest_path(directory, job_name, shard_index), shard)
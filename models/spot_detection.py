@@ -0,0 +1,140 @@
+import numpy
+
+LOG_SIGMA = 0.3
+GAUSSIAN_TRUNCATE = 4.0
+PEAK_FOOTPRINT_SIZE = 3
+
+def as_float_image(image):
+  import skimage.util
+  float_image = skimage.util.img_as_float(image)
+  if float_image.dtype == numpy.float16:
+    return float_image.astype(numpy.float32)
+  return float_image
+
+def filter_image(image, peak_radius):
+  import scipy.ndimage
+  return scipy.ndimage.gaussian_filter(as_float_image(image), peak_radius, mode="nearest", truncate=GAUSSIAN_TRUNCATE)
+
+def laplacian_of_gaussian(filtered_image):
+  import scipy.ndimage
+  # scale normalized like skimage.feature.blob_log so that thresholds carry over unchanged
+  return -scipy.ndimage.gaussian_laplace(filtered_image, LOG_SIGMA) * LOG_SIGMA ** 2
+
+def local_maxima(response):
+  import scipy.ndimage
+  maxima = response == scipy.ndimage.maximum_filter(response, size=PEAK_FOOTPRINT_SIZE, mode="nearest")
+  # a constant response has no peaks
+  if numpy.all(maxima):
+    maxima[:] = False
+  return maxima
+
+def sorted_spots(response, spots_mask):
+  rows, columns = numpy.nonzero(spots_mask)
+  # brightest response first, ties in raster order, as blob_log orders its peaks
+  order = numpy.argsort(-response[rows, columns], kind="stable")
+  return list(zip(rows[order].tolist(), columns[order].tolist()))
+
+def detect_spots(image, peak_radius, threshold, global_contrast_threshold):
+  response = laplacian_of_gaussian(filter_image(image, peak_radius))
+  spots_mask = local_maxima(response) & (response > threshold) & (image > global_contrast_threshold)
+  return sorted_spots(response, spots_mask)
+
+class CropCanvas:
+  # crops packed side by side into one 2-d buffer, each surrounded by its own edge pixels
+  def __init__(self, shapes, margin):
+    self.shapes = numpy.array(shapes).reshape(-1, 2)
+    self.margin = margin
+    self.slot_widths = self.shapes[:, 1] + 2 * margin
+    self.slot_starts = numpy.concatenate([[0], numpy.cumsum(self.slot_widths)[:-1]])
+    self.shape = (self.shapes[:, 0].max() + 2 * margin, self.slot_widths.sum())
+
+  def pack(self, images, dtype=None):
+    canvas = numpy.zeros(self.shape, dtype=dtype or numpy.result_type(*images))
+    for (rows_count, columns_count), column_start, image in zip(self.shapes, self.slot_starts + self.margin, images):
+      canvas[self.margin:self.margin + rows_count, column_start:column_start + columns_count] = image
+    return self.pad(canvas)
+
+  def pad(self, canvas):
+    # mode="nearest" on each crop alone sees exactly these margins
+    margin = self.margin
+    for (rows_count, columns_count), slot_start in zip(self.shapes, self.slot_starts):
+      interior_rows = slice(margin, margin + rows_count)
+      canvas[interior_rows, slot_start:slot_start + margin] = canvas[interior_rows, slot_start + margin:slot_start + margin + 1]
+      last_column = slot_start + margin + columns_count - 1
+      canvas[interior_rows, last_column + 1:last_column + 1 + margin] = canvas[interior_rows, last_column:last_column + 1]
+      slot_columns = slice(slot_start, slot_start + columns_count + 2 * margin)
+      canvas[margin + rows_count:, slot_columns] = canvas[margin + rows_count - 1:margin + rows_count, slot_columns]
+    canvas[:margin, :] = canvas[margin:margin + 1, :]
+    return canvas
+
+  def per_column(self, values):
+    return numpy.repeat(numpy.asarray(values), self.slot_widths)[numpy.newaxis, :]
+
+  @property
+  def interior(self):
+    if not hasattr(self, "_interior"):
+      rows = numpy.arange(self.shape[0])[:, numpy.newaxis]
+      columns = numpy.arange(self.shape[1]) - self.per_column(self.slot_starts)
+      self._interior = (
+        (rows >= self.margin) &
+        (rows < self.margin + self.per_column(self.shapes[:, 0])) &
+        (columns >= self.margin) &
+        (columns < self.margin + self.per_column(self.shapes[:, 1]))
+      )
+    return self._interior
+
+  def crop(self, canvas, index):
+    rows_count, columns_count = self.shapes[index]
+    column_start = self.slot_starts[index] + self.margin
+    return canvas[self.margin:self.margin + rows_count, column_start:column_start + columns_count]
+
+def crop_backgrounds(images, percentile=75):
+  counts = numpy.array([numpy.size(image) for image in images])
+  values = numpy.full((len(images), counts.max()), numpy.inf)
+  for index, image in enumerate(images):
+    values[index, :counts[index]] = numpy.ravel(image)
+  positions = (counts - 1) * (percentile / 100)
+  below = numpy.floor(positions).astype(numpy.intp)
+  above = numpy.minimum(below + 1, counts - 1)
+  # the padding is larger than any pixel, so it never lands on a crop's own ranks
+  values.partition(numpy.unique(numpy.concatenate([below, above])), axis=1)
+  below_values = values[numpy.arange(len(images)), below]
+  above_values = values[numpy.arange(len(images)), above]
+  differences = above_values - below_values
+  weights = positions - below
+  # linear interpolation the way numpy.percentile does it
+  return numpy.where(
+    weights >= 0.5,
+    above_values - differences * (1 - weights),
+    below_values + differences * weights
+  )
+
+def detect_spots_batch(images, peak_radius, thresholds, global_contrast_thresholds):
+  import scipy.ndimage
+  if len(images) == 0:
+    return []
+  margin = max(int(GAUSSIAN_TRUNCATE * peak_radius + 0.5), int(GAUSSIAN_TRUNCATE * LOG_SIGMA + 0.5), PEAK_FOOTPRINT_SIZE // 2)
+  canvas = CropCanvas([numpy.shape(image) for image in images], margin)
+  filtered = canvas.pad(filter_image(canvas.pack([as_float_image(image) for image in images]), peak_radius))
+  response = canvas.pad(laplacian_of_gaussian(filtered))
+  maxima = (response == scipy.ndimage.maximum_filter(response, size=PEAK_FOOTPRINT_SIZE, mode="nearest")) & canvas.interior
+  for index in range(len(images)):
+    # a constant crop has no peaks
+    crop_maxima = canvas.crop(maxima, index)
+    if numpy.all(crop_maxima):
+      crop_maxima[:] = False
+  spots_mask = (
+    maxima &
+    (response > canvas.per_column(thresholds)) &
+    (canvas.pack(images) > canvas.per_column(global_contrast_thresholds))
+  )
+  rows, columns = numpy.nonzero(spots_mask)
+  indices = numpy.searchsorted(canvas.slot_starts, columns, side="right") - 1
+  # per crop, brightest response first with ties in raster order, as sorted_spots orders them
+  order = numpy.lexsort((-response[rows, columns], indices))
+  spots = list(zip(
+    (rows[order] - margin).tolist(),
+    (columns[order] - canvas.slot_starts[indices[order]] - margin).tolist()
+  ))
+  boundaries = numpy.cumsum(numpy.bincount(indices, minlength=len(images))).tolist()
+  return [spots[start:end] for start, end in zip([0, *boundaries[:-1]], boundaries)]
@@ -6,6 +6,10 @@ import subprocess
 import enum
 from time import sleep
 
+from models.instrumentation import INSTRUMENTATION_ENVIRONMENT_VARIABLES
+from models.scratch_staging import SCRATCH_VARIABLE
+from models.thread_budget import DEFAULT_THREADS, thread_environment
+
 LOGGER = logging.getLogger()
 MAX_ARGS_PER_JOB = 10000
 
@@ -25,6 +29,18 @@ def shard_job_params(job_params, files_count):
     yield job_params_list[next_shard_start_index:shard_end_index]
     next_shard_start_index = shard_end_index
 
+def stream_job_params(job_params, files_count):
+  # shards are yielded as they fill, so a listing of millions of files never holds more than one shard
+  params_per_job = min(files_count, MAX_ARGS_PER_JOB)
+  shard = []
+  for job_param in job_params:
+    shard.append(job_param)
+    if len(shard) == params_per_job:
+      yield shard
+      shard = []
+  if len(shard) > 0:
+    yield shard
+
 class RunStrategy(enum.Enum):
   LOCAL = enum.auto()
   SWARM = enum.auto()
@@ -35,13 +51,14 @@ class SwarmJob:
   run_strategy = RunStrategy.SWARM if os.environ.get('ENVIRONMENT') == 'production' else RunStrategy.LOCAL
   file_type = "LSM" if os.environ.get('FILE_TYPE') == "LSM" else "CV"
     
-  def __init__(self, source, destination_path, name, jobs, logdir, mem, files_count):
+  def __init__(self, source, destination_path, name, jobs, logdir, mem, files_count, threads=DEFAULT_THREADS):
     self.source = source
     self.destination_path = destination_path
     self.name = name
     self.jobs = jobs
     self.mem = mem
     self.logdir = logdir
+    self.threads = threads
     self.bundling = math.ceil(files_count/MAX_ARGS_PER_JOB)
 
   def run(self):
@@ -57,19 +74,31 @@ class SwarmJob:
       LOGGER.warning("job not complete yet")
       sleep(20)
 
-  def start(self):
+  def submit(self, dependency_job_ids=[]):
+    # queues the swarm and returns at once; it starts only after every dependency has completed successfully
+    self.generate_file()
+    return self.start(dependency_job_ids)
+
+  def start(self, dependency_job_ids=[]):
+    dependency_arguments = ["--dependency", "afterok:%s" % ":".join(dependency_job_ids)] if len(dependency_job_ids) > 0 else []
     command = [
       "swarm",
       "--module", "python/3.8",
       "-f", self.swarm_file_path,
       "--job-name", self.name,
       "-g", str(self.mem),
+      "-t", str(self.threads),
       "--logdir", str(self.logdir),
       "-b", str(self.bundling),
+      *dependency_arguments,
       "--sbatch", self.export_string
     ]
     LOGGER.warning(command)
-    subprocess.run(command).check_returncode()
+    swarm_result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+    LOGGER.warning("swarm result: %s", swarm_result.stdout.strip())
+    swarm_result.check_returncode()
+    # swarm prints the id of the job array it submitted as its last line
+    return swarm_result.stdout.strip().splitlines()[-1]
 
   def is_complete(self):
     command = ["squeue", "-n", self.name, "-o", "%T", "-t", "all", "-h"]
@@ -97,5 +126,14 @@ class SwarmJob:
   @property
   def export_string(self):
     if not hasattr(self, "_export_string"):
-        self._export_string = '"\"--export=MKL_NUM_THREADS=2,FILE_TYPE=\"%s\"\""' % self.file_type
+        exports = [
+          *("%s=%s" % variable_value for variable_value in thread_environment(self.threads).items()),
+          "FILE_TYPE=\"%s\"" % self.file_type,
+          *(
+            "%s=%s" % (variable, os.environ[variable])
+            for variable in [*INSTRUMENTATION_ENVIRONMENT_VARIABLES, SCRATCH_VARIABLE]
+            if variable in os.environ
+          )
+        ]
+        self._export_string = '"\"--export=%s\""' % ",".join(exports)
     return self._export_string
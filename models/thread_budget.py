@@ -0,0 +1,51 @@
+import logging
+import os
+import sys
+
+LOGGER = logging.getLogger()
+
+THREADS_VARIABLE = "PIPELINE_THREADS"
+# read by the BLAS and OpenMP runtimes, and by torch, when they load
+LIBRARY_THREADS_VARIABLES = [
+  "OMP_NUM_THREADS",
+  "MKL_NUM_THREADS",
+  "OPENBLAS_NUM_THREADS",
+  "NUMEXPR_NUM_THREADS",
+  "VECLIB_MAXIMUM_THREADS"
+]
+DEFAULT_THREADS = 2
+
+def allocated_cores():
+  # the cores slurm gave this job, or the ones this process may run on outside of slurm
+  if "SLURM_CPUS_PER_TASK" in os.environ:
+    return int(os.environ["SLURM_CPUS_PER_TASK"])
+  if hasattr(os, "sched_getaffinity"):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+def threads_per_worker(workers_count, cores=None):
+  cores = cores if cores != None else allocated_cores()
+  return max(1, cores // max(1, workers_count))
+
+def thread_environment(threads):
+  return { variable: str(threads) for variable in [THREADS_VARIABLE, *LIBRARY_THREADS_VARIABLES] }
+
+def budgeted_threads():
+  threads = os.environ.get(THREADS_VARIABLE)
+  return int(threads) if threads != None else None
+
+def limit_threads(threads):
+  # the variables cover libraries loaded from here on and every child process; pools that are already running
+  # are resized in place
+  os.environ.update(thread_environment(threads))
+  try:
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=threads)
+  except ImportError:
+    # harmless before numpy is loaded, since the variables cover it then; after that, as in a worker host, its pools
+    # keep whatever size they started with
+    if "numpy" in sys.modules:
+      LOGGER.warning("threadpoolctl is not installed, so the thread pools numpy already started are not limited to %i threads", threads)
+  if "torch" in sys.modules:
+    sys.modules["torch"].set_num_threads(threads)
+  LOGGER.info("limited to %i threads", threads)
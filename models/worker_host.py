@@ -0,0 +1,247 @@
+import argparse
+import array
+import importlib
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+from time import perf_counter
+
+LOGGER = logging.getLogger()
+
+WORKER_HOST_VARIABLE = "PIPELINE_WORKER_HOST"
+POLL_SECONDS = 0.1
+LENGTH_FORMAT = "!I"
+PEER_CREDENTIALS_FORMAT = "3i"
+FORWARDED_FDS = [0, 1, 2]
+# read once, when the stages are imported, so a worker forked from the host keeps the host's values whatever the
+# client's environment says
+IMPORT_TIME_VARIABLES = ["FILE_TYPE", "ENVIRONMENT"]
+
+PRELOADED_STAGES = [
+  "generate_cropped_cell_image",
+  "generate_distance_transform",
+  "generate_maximum_projection",
+  "generate_nuclear_masks",
+  "generate_nuclear_segmentation",
+  "generate_spot_positions",
+  "generate_spot_result_line"
+]
+PRELOADED_MODULES = ["numpy", "scipy.ndimage", "skimage.io", "skimage.measure", "matplotlib"]
+
+def send_message(connection, message, fds=[]):
+  # a length prefix frames the json; the file descriptors ride along with the first bytes
+  payload = json.dumps(message).encode()
+  data = struct.pack(LENGTH_FORMAT, len(payload)) + payload
+  ancillary_data = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if len(fds) > 0 else []
+  sent_count = connection.sendmsg([data], ancillary_data)
+  connection.sendall(data[sent_count:])
+
+def receive_message(connection, max_fds_count=0):
+  fds = array.array("i")
+  data, ancillary_data, _flags, _address = connection.recvmsg(65536, socket.CMSG_SPACE(max_fds_count * fds.itemsize))
+  for level, kind, fds_data in ancillary_data:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(fds_data[:len(fds_data) - (len(fds_data) % fds.itemsize)])
+  if len(data) == 0:
+    raise Exception("worker host connection closed")
+  length = struct.calcsize(LENGTH_FORMAT)
+  while len(data) < length or len(data) < length + struct.unpack(LENGTH_FORMAT, data[:length])[0]:
+    chunk = connection.recv(65536)
+    if len(chunk) == 0:
+      raise Exception("worker host connection closed")
+    data += chunk
+  return json.loads(data[length:]), list(fds)
+
+def exit_code(status):
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+def return_code(value):
+  # the same mapping sys.exit applies to what a stage returns
+  if value == None:
+    return 0
+  if isinstance(value, int):
+    return value
+  return 1
+
+class WorkerHost:
+  # imports the stages and the scientific stack once, then forks a worker for every stage invocation it is sent,
+  # so a shard starts with everything already imported and loaded instead of paying for it again in a fresh python
+  def __init__(self, socket_path, run_stage, stages=PRELOADED_STAGES, config=None):
+    self.socket_path = socket_path
+    self.run_stage = run_stage
+    self.stages = stages
+    self.config = config
+    self.connections = {}
+
+  def serve(self):
+    self.preload()
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # a worker runs whatever it is sent as the host's owner, so nobody else may connect, whatever the umask
+    previous_umask = os.umask(0o077)
+    try:
+      self.listener.bind(self.socket_path)
+    finally:
+      os.umask(previous_umask)
+    os.chmod(self.socket_path, 0o600)
+    self.listener.listen(64)
+    signal.signal(signal.SIGTERM, lambda _signal_number, _frame: sys.exit(0))
+    LOGGER.warning("worker host listening on %s", self.socket_path)
+    try:
+      while True:
+        self.reap()
+        readable, _writable, _errored = select.select([self.listener], [], [], POLL_SECONDS)
+        if len(readable) > 0:
+          self.accept()
+    finally:
+      self.listener.close()
+      if os.path.exists(self.socket_path):
+        os.unlink(self.socket_path)
+
+  def preload(self):
+    start_time = perf_counter()
+    for module_name in [*PRELOADED_MODULES, *self.stages]:
+      try:
+        importlib.import_module(module_name)
+      except ImportError as exception:
+        LOGGER.warning("not preloading %s: %s", module_name, exception)
+    self.warm_caches()
+    LOGGER.warning("preloaded %i stages in %.2fs", len(self.stages), perf_counter() - start_time)
+
+  def warm_caches(self):
+    # caches are filled before the fork, so every worker inherits them; nothing here may start threads, which
+    # a forked worker would not have
+    if "generate_nuclear_segmentation" in self.stages:
+      try:
+        sys.modules["generate_nuclear_segmentation"].load_cellpose_model()
+      except Exception as exception:
+        LOGGER.warning("not preloading the cellpose model: %s", exception)
+    if "generate_spot_positions" in self.stages and self.config != None:
+      sys.modules["generate_spot_positions"].load_generate_spot_positions_configs(self.config)
+
+  def accept(self):
+    connection, _address = self.listener.accept()
+    peer_uid = self.peer_uid(connection)
+    if peer_uid != os.getuid():
+      LOGGER.warning("worker host refused a connection from uid %s", peer_uid)
+      connection.close()
+      return
+    try:
+      request, fds = receive_message(connection, len(FORWARDED_FDS))
+    except Exception:
+      traceback.print_exc()
+      connection.close()
+      return
+    rejection = self.rejection(request)
+    if rejection != None:
+      LOGGER.warning("worker host rejected %s: %s", request["stage"], rejection)
+      for fd in fds:
+        os.close(fd)
+      try:
+        send_message(connection, { "code": None, "rejection": rejection })
+      except OSError:
+        pass
+      connection.close()
+      return
+    pid = os.fork()
+    if pid == 0:
+      self.listener.close()
+      for other_connection in self.connections.values():
+        other_connection.close()
+      connection.close()
+      self.work(request, fds)
+    for fd in fds:
+      os.close(fd)
+    self.connections[pid] = connection
+
+  def peer_uid(self, connection):
+    _pid, uid, _gid = struct.unpack(
+      PEER_CREDENTIALS_FORMAT,
+      connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize(PEER_CREDENTIALS_FORMAT))
+    )
+    return uid
+
+  def rejection(self, request):
+    for variable in IMPORT_TIME_VARIABLES:
+      if request["environment"].get(variable) != os.environ.get(variable):
+        return "%s is %s for the client but %s for the host" % (
+          variable,
+          request["environment"].get(variable),
+          os.environ.get(variable)
+        )
+    return None
+
+  def work(self, request, fds):
+    code = 1
+    try:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      for fd, forwarded_fd in zip(fds, FORWARDED_FDS):
+        os.dup2(fd, forwarded_fd)
+        os.close(fd)
+      os.chdir(request["cwd"])
+      os.environ.clear()
+      os.environ.update(request["environment"])
+      code = return_code(self.run_stage(request["stage"], request["arguments"]))
+    except SystemExit as exception:
+      code = return_code(exception.code)
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(code)
+
+  def reap(self):
+    while len(self.connections) > 0:
+      pid, status = os.waitpid(-1, os.WNOHANG)
+      if pid == 0:
+        return
+      connection = self.connections.pop(pid, None)
+      if connection == None:
+        continue
+      try:
+        send_message(connection, { "code": exit_code(status) })
+      except OSError:
+        # the client went away; the worker's outcome is only in its own output
+        pass
+      connection.close()
+
+def run_on_worker_host(socket_path, stage, arguments):
+  # returns None when no host answers at socket_path, or the host was started with a different environment, so
+  # the caller can run the stage itself
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(socket_path)
+  except OSError:
+    connection.close()
+    return None
+  with connection:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    send_message(
+      connection,
+      { "stage": stage, "arguments": arguments, "cwd": os.getcwd(), "environment": dict(os.environ) },
+      FORWARDED_FDS
+    )
+    response, _fds = receive_message(connection)
+  if "rejection" in response:
+    LOGGER.warning("running %s without the worker host: %s", stage, response["rejection"])
+  return response["code"]
+
+def worker_host_main(arguments, run_stage):
+  parser = argparse.ArgumentParser(prog="pipeline.py host")
+  parser.add_argument("socket")
+  parser.add_argument("--stages", nargs="*", default=PRELOADED_STAGES)
+  parser.add_argument("--config")
+  params = parser.parse_args(arguments)
+  WorkerHost(params.socket, run_stage, stages=params.stages, config=params.config).serve()
+  return 0
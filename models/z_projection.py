@@ -0,0 +1,48 @@
+import numpy
+
+UNSIGNED_ACCUMULATOR_DTYPES = [numpy.uint16, numpy.uint32, numpy.uint64]
+
+def accumulator_dtype(image_dtype, z_values=None):
+  if not numpy.issubdtype(image_dtype, numpy.integer):
+    return numpy.float64
+  if numpy.issubdtype(image_dtype, numpy.signedinteger) or z_values == None:
+    return numpy.int64
+  # the weighted sum is the largest value either accumulator can reach
+  largest_weighted_sum = int(numpy.iinfo(image_dtype).max) * max(sum(z_values), len(z_values))
+  for dtype in UNSIGNED_ACCUMULATOR_DTYPES:
+    if numpy.dtype(dtype).itemsize >= numpy.dtype(image_dtype).itemsize and largest_weighted_sum <= numpy.iinfo(dtype).max:
+      return dtype
+  return numpy.float64
+
+class ZProjectionAccumulator:
+  def __init__(self, z_values=None):
+    self.z_values = z_values
+    self.maximum_projection = None
+    self.summed_z_values = None
+    self.weighted_summed_z_values = None
+
+  def add(self, image, z):
+    if self.maximum_projection is None:
+      dtype = accumulator_dtype(image.dtype, self.z_values)
+      self.maximum_projection = numpy.zeros_like(image)
+      self.summed_z_values = numpy.zeros(image.shape, dtype=dtype)
+      self.weighted_summed_z_values = numpy.zeros(image.shape, dtype=dtype)
+
+    numpy.fmax(self.maximum_projection, image, out=self.maximum_projection)
+    numpy.add(self.summed_z_values, image, out=self.summed_z_values, casting="unsafe")
+    numpy.add(
+      self.weighted_summed_z_values,
+      numpy.multiply(image, z, dtype=self.weighted_summed_z_values.dtype),
+      out=self.weighted_summed_z_values
+    )
+
+  @property
+  def z_center(self):
+    # pixels that are dark in every slice get a z center of 1
+    return numpy.divide(
+      self.weighted_summed_z_values,
+      self.summed_z_values,
+      out=numpy.ones(self.summed_z_values.shape, dtype=numpy.float16),
+      where=self.summed_z_values != 0,
+      casting="unsafe"
+    )
@@ -1,7 +1,7 @@
 import numpy
-import skimage.io
 
 from models.image_filename import ImageFilename
+from models.instrumentation import record_read
 
 
 class ZSlicedImage:
@@ -12,13 +12,36 @@ class ZSlicedImage:
   @property
   def image(self):
     if not hasattr(self, "_image"):
+      import skimage.io
       raw_image = skimage.io.imread(self.path)
+      record_read(self.path)
       if len(raw_image.shape) != 2:
         self._image = raw_image[:, :, 0]
       else:
         self._image = raw_image
     return self._image
 
+  @property
+  def mapped_shape_and_dtype(self):
+    # only uncompressed, untiled tiffs can be mapped
+    if not hasattr(self, "_mapped_shape_and_dtype"):
+      import tifffile
+      raw_memmap = tifffile.memmap(self.path, mode="r")
+      self._mapped_shape_and_dtype = (raw_memmap.shape[:2], raw_memmap.dtype)
+      del raw_memmap
+      record_read(self.path)
+    return self._mapped_shape_and_dtype
+
+  def read_region(self, region):
+    # the mapping is dropped once the region is copied, so mapped pages do not pile up across tiles
+    import tifffile
+    raw_memmap = tifffile.memmap(self.path, mode="r")
+    if len(raw_memmap.shape) != 2:
+      region = (*region, 0)
+    region_image = numpy.array(raw_memmap[region])
+    del raw_memmap
+    return region_image
+
   @property
   def z(self):
     if not hasattr(self, "_z"):
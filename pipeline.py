@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import importlib
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from models.thread_budget import budgeted_threads, limit_threads
+from models.worker_host import WORKER_HOST_VARIABLE, run_on_worker_host, worker_host_main
+
+REPOSITORY_PATH = Path(__file__).resolve().parent
+
+STAGE_CLIS = {
+  "generate_all_cropped_cell_images": "generate_all_cropped_cell_images_cli",
+  "generate_all_distance_transforms": "generate_all_distance_transforms_cli",
+  "generate_all_maximum_projections": "generate_all_maximum_projections_cli",
+  "generate_all_nuclear_masks": "generate_all_nuclear_masks",
+  "generate_all_nuclear_segmentations": "generate_all_nuclear_segmentations",
+  "generate_all_spot_positions": "generate_all_spot_positions_cli",
+  "generate_all_spot_result_lines": "generate_all_spot_result_lines_cli",
+  "generate_cropped_cell_image": "generate_cropped_cell_image_cli",
+  "generate_distance_transform": "generate_distance_transform_cli",
+  "generate_instrumentation_report": "generate_instrumentation_report_cli",
+  "generate_maximum_projection": "generate_maximum_projection_cli",
+  "generate_nuclear_masks": "generate_nuclear_masks_cli",
+  "generate_nuclear_segmentation": "generate_nuclear_segmentation_cli",
+  "generate_nuclear_segmentation_diameters": "generate_nuclear_segmentation_diameters_cli",
+  "generate_spot_positions": "generate_spot_positions_cli",
+  "generate_spot_positions_config": "generate_spot_positions_config_cli",
+  "generate_spot_result_line": "generate_spot_result_line_cli",
+  "generate_spot_results_file": "generate_spot_results_file_cli",
+  "run_pipeline": "run_pipeline_cli",
+  "run_pipeline_fields": "run_pipeline_fields_cli"
+}
+
+IMPORT_TIME_SCRIPT = (
+  "from time import perf_counter\n"
+  "start = perf_counter()\n"
+  "import %s\n"
+  "print(perf_counter() - start)\n"
+)
+
+def run_stage(stage, arguments):
+  # limited before the stage is imported, so numpy and torch start with the budgeted pools
+  threads = budgeted_threads()
+  if threads != None:
+    limit_threads(threads)
+  module = importlib.import_module(stage)
+  # pycli reads the sys.argv list it saw at import time, so replace its contents in place
+  sys.argv[:] = [module.__file__, *arguments]
+  return getattr(module, STAGE_CLIS[stage]).run()
+
+def measure_import_seconds(stage):
+  import_time_result = subprocess.run(
+    [sys.executable, "-c", IMPORT_TIME_SCRIPT % stage],
+    cwd=REPOSITORY_PATH,
+    capture_output=True,
+    text=True
+  )
+  import_time_result.check_returncode()
+  return float(import_time_result.stdout.strip().splitlines()[-1])
+
+def print_import_times(stages):
+  print("%-36s %10s" % ("stage", "import (s)"))
+  for stage in stages:
+    print("%-36s %10.3f" % (stage, measure_import_seconds(stage)))
+
+def forward_stage(stage, arguments):
+  # with a worker host running, the stage runs in a worker forked from it rather than in this fresh interpreter
+  socket_path = os.environ.get(WORKER_HOST_VARIABLE)
+  if socket_path == None:
+    return None
+  return run_on_worker_host(socket_path, stage, arguments)
+
+def print_usage():
+  print("usage: %s STAGE [ARGUMENTS...]" % Path(__file__).name)
+  print("       %s import_times [STAGE...]" % Path(__file__).name)
+  print("       %s host SOCKET [--stages STAGE...] [--config CONFIG]" % Path(__file__).name)
+  print("stages:")
+  for stage in sorted(STAGE_CLIS):
+    print("  %s" % stage)
+
+def main(arguments):
+  if len(arguments) == 0 or arguments[0] in ["-h", "--help"]:
+    print_usage()
+    return 0
+  command, command_arguments = arguments[0], arguments[1:]
+  if command == "import_times":
+    print_import_times(command_arguments or sorted(STAGE_CLIS))
+    return 0
+  if command == "host":
+    return worker_host_main(command_arguments, run_stage)
+  if not command in STAGE_CLIS:
+    print_usage()
+    return 2
+  forwarded_code = forward_stage(command, command_arguments)
+  if forwarded_code != None:
+    return forwarded_code
+  return run_stage(command, command_arguments)
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,74 @@
+import json
+import logging
+import traceback
+
+import cli.log
+
+from models.chained_submission import FIELDS_PER_COMMAND_COUNT, ChainedSubmission
+from models.dataflow import CONCURRENCY, STAGES, DataflowScheduler
+from models.instrumentation import instrumented_shard, timed
+from models.pipeline_run import PipelineRun
+
+LOGGER = logging.getLogger()
+
+class RunPipelineJob:
+  def __init__(self, pipeline_run, concurrency=CONCURRENCY, stages=STAGES, results_file=True):
+    self.pipeline_run = pipeline_run
+    self.concurrency = concurrency
+    self.stages = stages
+    self.results_file = results_file
+
+  def run(self):
+    with instrumented_shard("run_pipeline"):
+      with timed("run"):
+        summary = DataflowScheduler(
+          self.pipeline_run,
+          concurrency=self.concurrency,
+          stages=self.stages,
+          results_file=self.results_file
+        ).run()
+    LOGGER.warning("pipeline run finished: %s", json.dumps(summary))
+    return summary
+
+def parse_stages(stages):
+  if stages == None:
+    return STAGES
+  requested_stages = stages.split(",")
+  unknown_stages = set(requested_stages) - set(STAGES)
+  if len(unknown_stages) > 0:
+    raise Exception("unknown stages: %s" % ", ".join(sorted(unknown_stages)))
+  return [stage for stage in STAGES if stage in requested_stages]
+
+@cli.log.LoggingApp
+def run_pipeline_cli(app):
+  try:
+    with open(app.params.pipeline_run) as pipeline_run_file:
+      pipeline_run = PipelineRun.from_json_params(json.load(pipeline_run_file))
+    if app.params.submit:
+      ChainedSubmission(
+        pipeline_run,
+        stages=parse_stages(app.params.stages),
+        results_file=not app.params.no_results_file,
+        fields_per_command=app.params.fields_per_command
+      ).submit()
+      return 0
+    summary = RunPipelineJob(
+      pipeline_run,
+      concurrency=app.params.concurrency,
+      stages=parse_stages(app.params.stages),
+      results_file=not app.params.no_results_file
+    ).run()
+    return 1 if summary["failed_tasks_count"] > 0 else 0
+  except Exception as exception:
+    traceback.print_exc()
+    return 1
+
+run_pipeline_cli.add_param("pipeline_run")
+run_pipeline_cli.add_param("--concurrency", type=int, default=CONCURRENCY)
+run_pipeline_cli.add_param("--stages")
+run_pipeline_cli.add_param("--no_results_file", action="store_true")
+run_pipeline_cli.add_param("--submit", action="store_true")
+run_pipeline_cli.add_param("--fields_per_command", type=int, default=FIELDS_PER_COMMAND_COUNT)
+
+if __name__ == "__main__":
+  run_pipeline_cli.run()
@@ -0,0 +1,67 @@
+import json
+import logging
+import shlex
+import traceback
+
+import cli.log
+
+from models.dataflow import STAGES, FieldCommands, run_commands
+from models.instrumentation import instrumented_shard, timed
+from models.pipeline_command import pipeline_command
+from models.pipeline_run import PipelineRun
+
+LOGGER = logging.getLogger()
+
+class RunPipelineFieldsJob:
+  def __init__(self, pipeline_run, stage, field_names):
+    if not stage in STAGES:
+      raise Exception("unknown stage %s" % stage)
+    self.pipeline_run = pipeline_run
+    self.stage = stage
+    self.field_names = field_names
+
+  def run(self):
+    with instrumented_shard("run_pipeline_fields"):
+      with timed("plan"):
+        commands = self.field_commands.commands(self.stage, self.fields)
+      with timed("run"):
+        run_commands("%s for %i fields" % (self.stage, len(self.fields)), commands)
+
+  @property
+  def field_commands(self):
+    if not hasattr(self, "_field_commands"):
+      self._field_commands = FieldCommands(self.pipeline_run, self.field_names)
+    return self._field_commands
+
+  @property
+  def fields(self):
+    if not hasattr(self, "_fields"):
+      self._fields = [field for field in self.field_commands.fields if str(field) in self.field_names]
+      if len(self._fields) < len(self.field_names):
+        LOGGER.warning("%i of %i fields have no images", len(self.field_names) - len(self._fields), len(self.field_names))
+    return self._fields
+
+def run_pipeline_fields_cli_str(pipeline_run_path, stage, field_names):
+  return shlex.join([
+    *pipeline_command("run_pipeline_fields"),
+    "--stage=%s" % stage,
+    str(pipeline_run_path),
+    *[str(field_name) for field_name in field_names]
+  ])
+
+@cli.log.LoggingApp
+def run_pipeline_fields_cli(app):
+  try:
+    with open(app.params.pipeline_run) as pipeline_run_file:
+      pipeline_run = PipelineRun.from_json_params(json.load(pipeline_run_file))
+    RunPipelineFieldsJob(pipeline_run, app.params.stage, app.params.field_names).run()
+  except Exception as exception:
+    traceback.print_exc()
+    return 1
+
+run_pipeline_fields_cli.add_param("pipeline_run")
+run_pipeline_fields_cli.add_param("field_names", nargs="*")
+run_pipeline_fields_cli.add_param("--stage", required=True)
+
+if __name__ == "__main__":
+  run_pipeline_fields_cli.run()